@@ -0,0 +1,136 @@
+import os
+from flask import jsonify, request
+from db.postgresql.postgresql_connection import postgresql_connection
+
+ANALYTICS_DEFAULT_LIMIT = int(os.getenv("ANALYTICS_DEFAULT_LIMIT", "20"))
+ANALYTICS_MAX_LIMIT = int(os.getenv("ANALYTICS_MAX_LIMIT", "200"))
+# Days of sales the stock velocity is averaged over
+SALES_VELOCITY_DAYS = int(os.getenv("SALES_VELOCITY_DAYS", "30"))
+
+# The top sellers come straight off a summary index and their velocity from
+# at most SALES_VELOCITY_DAYS daily rows each, so the cost depends on the
+# limit and the window, not on how many orders were ever placed.
+# {order} is one of SORT_COLUMNS, never user input.
+TOP_PRODUCTS_SQL = """
+    SELECT s.product_id, p.name, p.stock_count, s.units_sold, s.revenue, s.order_count,
+           s.first_sold_at, s.last_sold_at, COALESCE(recent.units_sold, 0)
+    FROM (
+        SELECT * FROM product_sales_summary
+        ORDER BY {order} DESC, product_id
+        LIMIT %(limit)s
+    ) s
+    JOIN products p ON p.id = s.product_id
+    LEFT JOIN LATERAL (
+        SELECT SUM(d.units_sold) AS units_sold FROM product_sales_daily d
+        WHERE d.product_id = s.product_id
+          AND d.day > (now() AT TIME ZONE 'UTC')::date - %(days)s
+    ) recent ON true
+    ORDER BY s.{order} DESC, s.product_id
+"""
+
+# One row per product that ever sold, however many orders there are
+TOTALS_SQL = """
+    SELECT COUNT(*), COALESCE(SUM(units_sold), 0), COALESCE(SUM(revenue), 0), MAX(last_sold_at)
+    FROM product_sales_summary
+"""
+
+SORT_COLUMNS = {"units_sold": "units_sold", "revenue": "revenue"}
+
+# Rebuild the summaries from the order history, see
+# db/postgresql/rebuild_sales_summaries.py. An order's total is shared
+# between its lines by quantity.
+REBUILD_SALES_SUMMARIES_SQL = """
+    LOCK TABLE product_sales_summary, product_sales_daily IN EXCLUSIVE MODE;
+    DELETE FROM product_sales_summary;
+    DELETE FROM product_sales_daily;
+
+    INSERT INTO product_sales_summary (product_id, units_sold, revenue, order_count, first_sold_at, last_sold_at)
+    SELECT sm.product_id, SUM(sm.quantity), COALESCE(SUM(o.total * sm.quantity / NULLIF(t.quantity, 0)), 0),
+           COUNT(DISTINCT sm.order_id), MIN(o.created_at), MAX(o.created_at)
+    FROM stock_movements sm
+    JOIN orders o ON o.id = sm.order_id
+    JOIN (SELECT order_id, SUM(quantity) AS quantity FROM stock_movements GROUP BY order_id) t
+        ON t.order_id = sm.order_id
+    WHERE sm.product_id IS NOT NULL
+    GROUP BY sm.product_id;
+
+    INSERT INTO product_sales_daily (product_id, day, units_sold, revenue)
+    SELECT sm.product_id, (o.created_at AT TIME ZONE 'UTC')::date, SUM(sm.quantity),
+           COALESCE(SUM(o.total * sm.quantity / NULLIF(t.quantity, 0)), 0)
+    FROM stock_movements sm
+    JOIN orders o ON o.id = sm.order_id
+    JOIN (SELECT order_id, SUM(quantity) AS quantity FROM stock_movements GROUP BY order_id) t
+        ON t.order_id = sm.order_id
+    WHERE sm.product_id IS NOT NULL
+    GROUP BY sm.product_id, (o.created_at AT TIME ZONE 'UTC')::date;
+"""
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+def build_product_sales(row, days):
+    """
+    Turn a TOP_PRODUCTS_SQL row into an analytics entry with stock velocity
+    """
+    product_id, name, stock_count, units_sold, revenue, order_count, first_sold_at, last_sold_at, recent_units = row
+    units_per_day = float(recent_units) / days
+    return {
+        "product_id": product_id,
+        "product_name": name,
+        "stock_count": stock_count,
+        "units_sold": units_sold,
+        "revenue": float(revenue),
+        "order_count": order_count,
+        "first_sold_at": _isoformat(first_sold_at),
+        "last_sold_at": _isoformat(last_sold_at),
+        # SUM() over bigint comes back as a Decimal
+        "recent_units_sold": int(recent_units),
+        "units_per_day": round(units_per_day, 3),
+        # None when nothing sold in the window
+        "days_of_stock_left": round(stock_count / units_per_day, 1) if units_per_day else None,
+    }
+
+def get_sales_analytics(sort="units_sold", limit=ANALYTICS_DEFAULT_LIMIT, days=SALES_VELOCITY_DAYS):
+    """
+    Top products by units sold or revenue with their stock velocity, and the
+    overall totals, read only from the sales summaries
+    """
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(TOP_PRODUCTS_SQL.format(order=SORT_COLUMNS[sort]), {"limit": limit, "days": days})
+        products = [build_product_sales(row, days) for row in cur.fetchall()]
+        cur.execute(TOTALS_SQL)
+        products_sold, units_sold, revenue, last_sold_at = cur.fetchone()
+        cur.close()
+
+    return {
+        "sort": sort,
+        "velocity_days": days,
+        "products": products,
+        "totals": {
+            "products_sold": products_sold,
+            "units_sold": int(units_sold),
+            "revenue": float(revenue),
+            "last_sold_at": _isoformat(last_sold_at),
+        },
+    }
+
+def handle_sales_analytics():
+    """
+    GET /analytics/sales?sort=units_sold|revenue&limit=20&days=30
+    """
+    sort = request.args.get('sort', 'units_sold')
+    if sort not in SORT_COLUMNS:
+        return jsonify({"message": f"sort must be one of {', '.join(SORT_COLUMNS)}", "success": False}), 400
+
+    try:
+        limit = int(request.args.get('limit', ANALYTICS_DEFAULT_LIMIT))
+        days = int(request.args.get('days', SALES_VELOCITY_DAYS))
+    except ValueError:
+        return jsonify({"message": "limit and days must be integers", "success": False}), 400
+    if not 1 <= limit <= ANALYTICS_MAX_LIMIT:
+        return jsonify({"message": f"limit must be between 1 and {ANALYTICS_MAX_LIMIT}", "success": False}), 400
+    if not 1 <= days <= 366:
+        return jsonify({"message": "days must be between 1 and 366", "success": False}), 400
+
+    return jsonify(get_sales_analytics(sort, limit, days))
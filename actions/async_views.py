@@ -0,0 +1,430 @@
+"""
+Async versions of the main routes, for the ASGI app in async_main.py.
+They return the same templates and JSON shapes as their sync counterparts
+and share the pure helpers (cursors, joins, cache policy) with them.
+"""
+import os
+import stat
+import asyncio
+import mimetypes
+from decimal import Decimal
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import aiofiles
+import aiofiles.os
+import asyncpg
+from bson import ObjectId
+from quart import url_for, request, render_template, jsonify, redirect, flash, make_response, Response
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+
+from db.postgresql.async_postgresql_connection import async_postgresql_connection
+from db.mongodb.async_mongodb_connection import get_async_mongodb_collection
+from actions.utils import (IMAGE_PROJECTION, FILE_SERVING_MODE, X_ACCEL_REDIRECT_PREFIX,
+                           build_image_indexes, product_images_query, set_upload_cache_policy)
+from actions.storage import is_content_addressed, store_upload_stream
+from actions.view_images import (GALLERY_PAGE_SIZE, UNASSOCIATED_CURSOR_PREFIX, InvalidCursor, parse_cursor,
+                                 parse_page_size, build_gallery, unassociated_card)
+from actions.create_order import UNIT_PRICE, RECENT_ORDERS_SQL, build_order_products, build_recent_orders
+from actions.thumbnails import THUMBNAIL_WIDTHS, THUMBNAIL_WEBP, prepare_thumbnail, schedule_derivatives
+from actions.cache import invalidate_listings
+from actions.file_cache import FILE_CACHE_ACCEL_PREFIX, local_copy, observe_lookup
+from actions.validation import UploadRejected, allowed_file, validated_stream
+from jobs.queue import enqueue
+
+FILE_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Same statement as PLACE_ORDER_SQL, with asyncpg's positional parameters.
+# The casts are needed because asyncpg infers parameter types server-side.
+PLACE_ORDER_SQL = """
+    WITH updated AS (
+        UPDATE products
+        SET stock_count = stock_count - $3
+        WHERE id = $1 AND stock_count >= $3
+        RETURNING id, name, stock_count
+    ), new_order AS (
+        INSERT INTO orders (customer_name, total, tax, pretax_amount)
+        SELECT $2::varchar, $4::numeric, 0, $4::numeric FROM updated
+        RETURNING id
+    ), movement AS (
+        INSERT INTO stock_movements (product_id, order_id, quantity)
+        SELECT updated.id, new_order.id, $3 FROM updated, new_order
+    ), summary AS (
+        INSERT INTO product_sales_summary AS s
+            (product_id, units_sold, revenue, order_count, first_sold_at, last_sold_at)
+        SELECT updated.id, $3, $4::numeric, 1, now(), now() FROM updated, new_order
+        ON CONFLICT (product_id) DO UPDATE SET
+            units_sold = s.units_sold + EXCLUDED.units_sold,
+            revenue = s.revenue + EXCLUDED.revenue,
+            order_count = s.order_count + 1,
+            last_sold_at = EXCLUDED.last_sold_at
+    ), daily AS (
+        INSERT INTO product_sales_daily AS d (product_id, day, units_sold, revenue)
+        SELECT updated.id, (now() AT TIME ZONE 'UTC')::date, $3, $4::numeric FROM updated, new_order
+        ON CONFLICT (product_id, day) DO UPDATE SET
+            units_sold = d.units_sold + EXCLUDED.units_sold,
+            revenue = d.revenue + EXCLUDED.revenue
+    )
+    SELECT new_order.id, updated.name, updated.stock_count FROM updated, new_order
+"""
+
+async def get_uploaded_images(after=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Get one page of uploaded images with product details,
+    see actions.view_images.get_uploaded_images
+    """
+    phase, key = parse_cursor(after)
+    collection = get_async_mongodb_collection("file-uploads")
+
+    parsed = []
+
+    if phase == "products":
+        async with async_postgresql_connection() as conn:
+            products = await conn.fetch("""
+                SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path
+                FROM products p
+                WHERE p.id > $1
+                ORDER BY p.id
+                LIMIT $2
+            """, key, limit + 1)
+
+        has_more = len(products) > limit
+        products = products[:limit]
+
+        page_images = []
+        missing = [product for product in products if not product[4]]
+        if missing:
+            page_images = await collection.find(product_images_query(missing), IMAGE_PROJECTION).to_list(None)
+        parsed = build_gallery(products, page_images, include_unassociated=False, url_for=url_for)
+
+        if has_more:
+            return parsed, str(products[-1][0])
+
+        key = None
+        limit -= len(products)
+        if limit <= 0:
+            return parsed, UNASSOCIATED_CURSOR_PREFIX
+
+    unassociated, next_cursor = await get_unassociated_images(collection, key, limit)
+    parsed.extend(unassociated)
+    return parsed, next_cursor
+
+async def get_unassociated_images(collection, after_id, limit):
+    """
+    Get one page of images that no product points to, in _id order
+    """
+    query = {"product_id": {"$exists": False}, "file_path": {"$exists": True}}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+
+    candidates = await collection.find(query, IMAGE_PROJECTION).sort("_id", 1).limit(limit + 1).to_list(None)
+    has_more = len(candidates) > limit
+    candidates = candidates[:limit]
+    if not candidates:
+        return [], None
+
+    async with async_postgresql_connection() as conn:
+        rows = await conn.fetch(
+            "SELECT image_mongodb_id FROM products WHERE image_mongodb_id = ANY($1::varchar[])",
+            [str(img['_id']) for img in candidates]
+        )
+    referenced = {row[0] for row in rows}
+
+    parsed = []
+    included_paths = set()
+    for img in candidates:
+        if str(img['_id']) in referenced or img['file_path'] in included_paths:
+            continue
+        parsed.append(unassociated_card(img['file_path'], url_for))
+        included_paths.add(img['file_path'])
+
+    next_cursor = UNASSOCIATED_CURSOR_PREFIX + str(candidates[-1]['_id']) if has_more else None
+    return parsed, next_cursor
+
+async def render_images_page():
+    limit = parse_page_size(request.args.get('limit'))
+    try:
+        images, next_cursor = await get_uploaded_images(request.args.get('after'), limit)
+    except InvalidCursor:
+        return "Invalid cursor", 400
+
+    next_url = url_for('show_uploaded_images', after=next_cursor, limit=limit) if next_cursor else None
+
+    if os.getenv("ENV_MODE") == "backend":
+        response = jsonify(images)
+    else:
+        response = await make_response(await render_template('view_images.html', images=images, next_url=next_url))
+
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+async def get_products_and_orders(logger):
+    """
+    Get products and recent orders for the order page
+    """
+    collection = get_async_mongodb_collection("file-uploads")
+
+    try:
+        async with async_postgresql_connection() as conn:
+            products = await conn.fetch(
+                "SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path FROM products p"
+            )
+            try:
+                recent_orders = await conn.fetch(RECENT_ORDERS_SQL)
+            except asyncpg.PostgresError as e:
+                logger.error(f"Error fetching orders: {e}")
+                recent_orders = []
+
+        # Only products created before image_file_path was added need MongoDB
+        all_images = []
+        missing = [product for product in products if not product[4]]
+        if missing:
+            all_images = await collection.find(product_images_query(missing), IMAGE_PROJECTION).to_list(None)
+    except Exception as e:
+        logger.error(f"Error loading products: {e}")
+        return [], []
+
+    images_by_product_id, images_by_id = build_image_indexes(all_images)
+    return (build_order_products(products, images_by_product_id, images_by_id, url_for),
+            build_recent_orders(recent_orders, images_by_product_id, images_by_id, url_for))
+
+async def render_order_page(app):
+    products, orders = await get_products_and_orders(app.logger)
+    return await render_template('create_order.html', products=products, orders=orders)
+
+async def process_order(app):
+    """
+    Process an order submission, see actions.create_order.process_order
+    """
+    form = await request.form
+
+    try:
+        product_id = int(form.get('product_id', ''))
+    except ValueError:
+        await flash('Product ID is required')
+        return redirect(request.url)
+
+    customer_name = form.get('customer_name', '').strip()
+    if not customer_name:
+        await flash('Customer name is required')
+        return redirect(request.url)
+
+    try:
+        order_quantity = int(form.get('order_quantity', 1))
+    except ValueError:
+        await flash('Invalid order quantity')
+        return redirect(request.url)
+    if order_quantity <= 0:
+        await flash('Order quantity must be positive')
+        return redirect(request.url)
+
+    try:
+        async with async_postgresql_connection() as conn:
+            async with conn.transaction():
+                result = await conn.fetchrow(PLACE_ORDER_SQL, product_id, customer_name, order_quantity,
+                                             Decimal(str(UNIT_PRICE * order_quantity)))
+            if result is None:
+                product = await conn.fetchrow("SELECT name, stock_count FROM products WHERE id = $1", product_id)
+    except asyncio.TimeoutError:
+        # No pooled connection freed up within POSTGRESQL_POOL_WAIT_TIMEOUT
+        app.logger.error("Database busy: timed out waiting for a PostgreSQL connection")
+        await flash('The database is busy, please try again')
+        return redirect(request.url)
+    except asyncpg.PostgresError as e:
+        app.logger.error(f"Database error: {e}")
+        await flash(f'Error creating order: {str(e)}')
+        return redirect(request.url)
+
+    if result is None:
+        if product is None:
+            await flash('Product not found')
+        else:
+            await flash(f'Not enough stock available for {product[0]}. Available: {product[1]}')
+    else:
+        await asyncio.to_thread(invalidate_listings)
+        await flash(f'Order #{result[0]} created successfully for {result[1]}')
+    return redirect(url_for('create_order'))
+
+async def handle_upload_file(upload_folder):
+    """
+    Handle a form upload, see actions.upload_image.handle_upload_file
+    """
+    files = await request.files
+    form = await request.form
+
+    if 'file' not in files:
+        await flash('No file part')
+        return redirect(request.url)
+
+    file = files['file']
+    if file.filename == '':
+        await flash('No selected file')
+        return redirect(request.url)
+
+    if not allowed_file(file.filename):
+        return None
+
+    # Hashing and writing the file stays in actions.storage; it runs off the
+    # event loop so other requests keep being served meanwhile
+    filename = secure_filename(file.filename)
+    try:
+        stored_file = await asyncio.to_thread(
+            lambda: store_upload_stream(validated_stream(file.stream, filename), filename, upload_folder))
+    except UploadRejected as e:
+        if os.getenv("ENV_MODE") == "backend":
+            return {"message": e.message, "success": False}, e.status
+        await flash(e.message)
+        return redirect(request.url)
+
+    await create_product(stored_file, form.get('product_name'), int(form.get('initial_stock_count')))
+    await asyncio.to_thread(schedule_derivatives, upload_folder, stored_file)
+
+    img_url = url_for('download_file', name=stored_file['file_path'])
+    if os.getenv("ENV_MODE") == "backend":
+        return {
+            "filename": stored_file['file_path'],
+            "img_url": img_url
+        }
+    return redirect(url_for('show_uploaded_images'))
+
+async def create_product(stored_file, product_name, stock_count):
+    """
+    Record a stored file in MongoDB and create its product in PostgreSQL.
+    Returns (product_id, mongodb_id).
+    """
+    collection = get_async_mongodb_collection("file-uploads")
+    result = await collection.insert_one({
+        "file_path": stored_file["file_path"],
+        "content_hash": stored_file["content_hash"],
+        "original_filename": stored_file["original_filename"],
+        "size": stored_file["size"],
+        "mime_type": stored_file.get("mime_type"),
+        "product_name": product_name,
+        "upload_date": datetime.now()
+    })
+    mongodb_id = str(result.inserted_id)
+
+    async with async_postgresql_connection() as conn:
+        product_id = await conn.fetchval(
+            'INSERT INTO products (name, image_mongodb_id, stock_count, review, '
+            'image_file_path, image_content_hash, image_size, image_mime_type) '
+            'VALUES ($1, $2, $3, $4, $5, $6, $7, $8) RETURNING id',
+            product_name, mongodb_id, stock_count, "Sample Review", stored_file["file_path"],
+            stored_file["content_hash"], stored_file["size"], stored_file.get("mime_type")
+        )
+
+    def enqueue_follow_ups():
+        invalidate_listings()
+        enqueue("backfill_product_id",
+                {"mongodb_id": mongodb_id, "product_id": product_id},
+                idempotency_key=f"backfill_product_id:{mongodb_id}")
+        enqueue("verify_checksum",
+                {"mongodb_id": mongodb_id, "file_path": stored_file["file_path"],
+                 "content_hash": stored_file["content_hash"]},
+                idempotency_key=f"verify_checksum:{mongodb_id}")
+    await asyncio.to_thread(enqueue_follow_ups)
+
+    return product_id, mongodb_id
+
+async def _read_chunks(path):
+    async with aiofiles.open(path, "rb") as f:
+        while True:
+            buffer = await f.read(FILE_STREAM_CHUNK_SIZE)
+            if not buffer:
+                break
+            yield buffer
+
+async def send_upload(upload_folder, file_path, policy_path=None):
+    """
+    Stream an uploaded file without blocking the event loop, with the same
+    ETag, If-None-Match / If-Modified-Since handling, local file cache and
+    caching policy as actions.utils.send_upload.
+    Range requests are not supported here; use FILE_SERVING_MODE=accel
+    to have nginx serve them.
+    """
+    policy_path = policy_path or file_path
+    immutable = is_content_addressed(file_path)
+
+    if FILE_SERVING_MODE == "accel":
+        prefix = X_ACCEL_REDIRECT_PREFIX
+        if FILE_CACHE_ACCEL_PREFIX:
+            cached_path, result, cached_stat = await asyncio.to_thread(
+                local_copy, upload_folder, file_path, immutable)
+            if result:
+                observe_lookup(result, cached_stat.st_size if result == "hit" else 0)
+            if cached_path is not None:
+                prefix = FILE_CACHE_ACCEL_PREFIX
+        response = Response("", status=200)
+        response.headers['X-Accel-Redirect'] = prefix + quote(file_path)
+        response.mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        return set_upload_cache_policy(response, policy_path)
+
+    # The copy has the source's size and mtime, so the ETag is the same either way
+    path, result, file_stat = await asyncio.to_thread(local_copy, upload_folder, file_path, immutable)
+    if path is None:
+        path = safe_join(upload_folder, file_path)
+        try:
+            file_stat = await aiofiles.os.stat(path) if path else None
+        except (FileNotFoundError, NotADirectoryError):
+            file_stat = None
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        if result:
+            observe_lookup(result)
+        return "File not found", 404
+
+    if immutable:
+        etag = os.path.splitext(os.path.basename(file_path))[0]
+    else:
+        etag = f"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"
+    # HTTP dates have whole seconds
+    last_modified = datetime.fromtimestamp(int(file_stat.st_mtime), timezone.utc)
+
+    # If-None-Match wins over If-Modified-Since, as in werkzeug
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+
+    if not_modified:
+        response = Response("", status=304)
+    else:
+        response = Response(_read_chunks(path),
+                            mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream')
+        response.content_length = file_stat.st_size
+    if result:
+        observe_lookup(result, file_stat.st_size if result == "hit" and not not_modified else 0)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return set_upload_cache_policy(response, policy_path)
+
+async def serve_file(upload_folder, name):
+    if any(part.startswith('.') for part in name.split('/')):
+        return "File not found", 404
+    return await send_upload(upload_folder, name)
+
+async def serve_thumbnail(upload_folder, width, name):
+    """
+    Serve a thumbnail, generating it off the event loop on first request
+    """
+    if width not in THUMBNAIL_WIDTHS or any(part.startswith('.') for part in name.split('/')):
+        return "Thumbnail not found", 404
+
+    webp = THUMBNAIL_WEBP and request.args.get('webp') == '1'
+    relative_path = await asyncio.to_thread(prepare_thumbnail, upload_folder, name, width, webp)
+    if relative_path is None:
+        return redirect(url_for('download_file', name=name))
+    return await send_upload(upload_folder, relative_path, policy_path=name)
+
+async def get_image_by_id(upload_folder, image_id):
+    if not ObjectId.is_valid(image_id):
+        return "Image not found", 404
+
+    image_doc = await get_async_mongodb_collection("file-uploads").find_one(
+        {"_id": ObjectId(image_id)}, {"file_path": 1}
+    )
+    if image_doc and "file_path" in image_doc:
+        return await send_upload(upload_folder, image_doc["file_path"])
+    return "Image not found", 404
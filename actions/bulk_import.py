@@ -0,0 +1,307 @@
+import os
+import io
+import csv
+import json
+import zipfile
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+from psycopg2.extras import execute_values
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from flask import jsonify, request, current_app, Response, stream_with_context
+from werkzeug.utils import secure_filename
+from db.mongodb.mongodb_connection import create_mongodb_connection
+from db.postgresql.postgresql_connection import postgresql_connection
+from actions.storage import store_upload_stream
+from actions.thumbnails import schedule_derivatives
+from actions.validation import UploadRejected, allowed_file, size_limit, validated_stream
+from actions.cache import invalidate_listings
+from jobs.queue import enqueue
+
+BULK_IMPORT_MAX_ITEMS = int(os.getenv("BULK_IMPORT_MAX_ITEMS", "1000"))
+# Files are written to the upload volume by this many threads at once
+BULK_IMPORT_WORKERS = int(os.getenv("BULK_IMPORT_WORKERS", "4"))
+# With ?progress=1 a progress line is streamed after this many stored files
+BULK_IMPORT_PROGRESS_EVERY = int(os.getenv("BULK_IMPORT_PROGRESS_EVERY", "25"))
+
+MANIFEST_NAMES = ("manifest.csv", "manifest.json")
+
+class BulkImportError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def parse_manifest(name, data):
+    """
+    Read the manifest rows (filename, product_name, initial_stock_count)
+    from CSV or JSON
+    """
+    try:
+        if name.lower().endswith(".json"):
+            rows = json.loads(data)
+            if isinstance(rows, dict):
+                rows = rows.get("items")
+            if not isinstance(rows, list):
+                raise BulkImportError("The JSON manifest must be a list of items")
+            return rows
+        return list(csv.DictReader(io.StringIO(data.decode("utf-8-sig"))))
+    except (ValueError, csv.Error) as e:
+        raise BulkImportError(f"Could not read the manifest: {e}")
+
+def _fail(item, message):
+    item["status"] = "error"
+    item["error"] = message
+
+def build_items(rows, sources):
+    """
+    Validate the manifest rows against the files in the request.
+    sources maps a file name to (open_function, size or None).
+    """
+    if len(rows) > BULK_IMPORT_MAX_ITEMS:
+        raise BulkImportError(f"At most {BULK_IMPORT_MAX_ITEMS} items per import", 413)
+
+    items = []
+    stored_names = set()
+    for index, row in enumerate(rows):
+        item = {"index": index, "filename": None, "status": "pending"}
+        items.append(item)
+        if not isinstance(row, dict):
+            _fail(item, "Invalid manifest row")
+            continue
+
+        item["filename"] = source_name = str(row.get("filename") or "").strip()
+        product_name = str(row.get("product_name") or "").strip()
+        try:
+            stock_count = int(row.get("initial_stock_count"))
+        except (TypeError, ValueError):
+            _fail(item, "initial_stock_count must be a number")
+            continue
+
+        filename = secure_filename(os.path.basename(source_name))
+        if not source_name or not product_name:
+            _fail(item, "filename and product_name are required")
+        elif stock_count < 0:
+            _fail(item, "initial_stock_count can't be negative")
+        elif not allowed_file(filename):
+            _fail(item, "File type not allowed")
+        elif source_name not in sources:
+            _fail(item, "File not found in the upload")
+        elif sources[source_name][1] is not None and sources[source_name][1] > size_limit(filename):
+            _fail(item, "File is too large")
+        elif filename in stored_names:
+            _fail(item, "Duplicate filename")
+        else:
+            stored_names.add(filename)
+            item.update(stored_name=filename, product_name=product_name,
+                        stock_count=stock_count, open=sources[source_name][0])
+    return items
+
+def read_import_request():
+    """
+    Collect the manifest rows and the files of an import request: either a zip
+    `archive` with a manifest.csv/manifest.json at its root, or several `files`
+    plus a `manifest` file
+    """
+    archive_file = request.files.get('archive')
+    if archive_file is not None and archive_file.filename:
+        try:
+            archive = zipfile.ZipFile(archive_file.stream)
+        except zipfile.BadZipFile:
+            raise BulkImportError("The archive is not a valid zip file")
+
+        sources = {}
+        manifest = None
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.filename in MANIFEST_NAMES:
+                manifest = info
+                continue
+            sources[info.filename] = (lambda info=info: archive.open(info), info.file_size)
+        if manifest is None:
+            raise BulkImportError("The archive has no manifest.csv or manifest.json")
+        return parse_manifest(manifest.filename, archive.read(manifest)), sources
+
+    manifest_file = request.files.get('manifest')
+    if manifest_file is None or not manifest_file.filename:
+        raise BulkImportError("Send an archive, or files and a manifest")
+    sources = {
+        file.filename: (lambda file=file: file.stream, None)
+        for file in request.files.getlist('files') if file.filename
+    }
+    return parse_manifest(manifest_file.filename, manifest_file.read()), sources
+
+def _store(item, upload_folder):
+    with item["open"]() as stream:
+        return store_upload_stream(validated_stream(stream, item["stored_name"]),
+                                   item["stored_name"], upload_folder)
+
+def store_items(items, upload_folder):
+    """
+    Write the files of all valid items in parallel.
+    Yields (stored, total) as files complete.
+    """
+    pending = [item for item in items if item["status"] == "pending"]
+    stored = 0
+    with ThreadPoolExecutor(max_workers=BULK_IMPORT_WORKERS) as executor:
+        futures = {executor.submit(_store, item, upload_folder): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                item["stored_file"] = future.result()
+            except UploadRejected as e:
+                _fail(item, e.message)
+            except Exception as e:
+                current_app.logger.warning(f"Bulk import could not store {item['filename']}: {e}")
+                _fail(item, "Could not store the file")
+            stored += 1
+            yield stored, len(pending)
+
+def record_items(items):
+    """
+    Create the MongoDB records and products of all stored items with one
+    insert_many, one multi-row INSERT and one bulk_write
+    """
+    stored = [item for item in items if item["status"] == "pending"]
+    if not stored:
+        return
+
+    upload_date = datetime.now()
+    documents = [{
+        "file_path": item["stored_file"]["file_path"],
+        "content_hash": item["stored_file"]["content_hash"],
+        "original_filename": item["stored_file"]["original_filename"],
+        "size": item["stored_file"]["size"],
+        "mime_type": item["stored_file"]["mime_type"],
+        "product_name": item["product_name"],
+        "upload_date": upload_date
+    } for item in stored]
+
+    client, database, collection = create_mongodb_connection("file-uploads")
+    try:
+        try:
+            collection.insert_many(documents, ordered=False)
+            failed = {}
+        except BulkWriteError as e:
+            failed = {error["index"]: error.get("errmsg") for error in e.details.get("writeErrors", [])}
+
+        inserted = []
+        for position, (item, document) in enumerate(zip(stored, documents)):
+            if position in failed:
+                _fail(item, "Could not record the file")
+            else:
+                item["mongodb_id"] = str(document["_id"])
+                inserted.append(item)
+        if not inserted:
+            return
+
+        try:
+            with postgresql_connection() as conn:
+                cur = conn.cursor()
+                rows = execute_values(cur, """
+                    INSERT INTO products (name, image_mongodb_id, stock_count, review, image_file_path,
+                                          image_content_hash, image_size, image_mime_type) VALUES %s
+                    RETURNING id, image_mongodb_id
+                    """,
+                    [(item["product_name"], item["mongodb_id"], item["stock_count"], "Sample Review",
+                      item["stored_file"]["file_path"], item["stored_file"]["content_hash"],
+                      item["stored_file"]["size"], item["stored_file"]["mime_type"])
+                     for item in inserted],
+                    page_size=len(inserted), fetch=True)
+                conn.commit()
+                cur.close()
+        except psycopg2.Error as e:
+            current_app.logger.error(f"Bulk import could not create products: {e}")
+            # Don't leave records behind that no product points at
+            collection.delete_many({"_id": {"$in": [ObjectId(item["mongodb_id"]) for item in inserted]}})
+            for item in inserted:
+                _fail(item, "Could not create the product")
+            return
+
+        product_ids = {mongodb_id: product_id for product_id, mongodb_id in rows}
+        for item in inserted:
+            item["product_id"] = product_ids[item["mongodb_id"]]
+            item["status"] = "created"
+        invalidate_listings()
+
+        try:
+            collection.bulk_write([
+                UpdateOne({"_id": ObjectId(item["mongodb_id"])}, {"$set": {"product_id": item["product_id"]}})
+                for item in inserted
+            ], ordered=False)
+        except PyMongoError as e:
+            # The products exist, leave the back-fill to the job queue
+            current_app.logger.warning(f"Bulk import back-fill failed, queueing it instead: {e}")
+            for item in inserted:
+                enqueue("backfill_product_id",
+                        {"mongodb_id": item["mongodb_id"], "product_id": item["product_id"]},
+                        idempotency_key=f"backfill_product_id:{item['mongodb_id']}")
+    finally:
+        client.close()
+
+def run_import(items, upload_folder):
+    """
+    Import all valid items, yielding progress events along the way
+    """
+    for stored, total in store_items(items, upload_folder):
+        if stored % BULK_IMPORT_PROGRESS_EVERY == 0 or stored == total:
+            yield {"stage": "store", "done": stored, "total": total}
+
+    yield {"stage": "record"}
+    record_items(items)
+
+    for item in items:
+        if item["status"] != "created":
+            continue
+        enqueue("verify_checksum",
+                {"mongodb_id": item["mongodb_id"], "file_path": item["stored_file"]["file_path"],
+                 "content_hash": item["stored_file"]["content_hash"]},
+                idempotency_key=f"verify_checksum:{item['mongodb_id']}")
+        schedule_derivatives(upload_folder, item["stored_file"])
+
+def import_summary(items):
+    results = []
+    for item in items:
+        result = {"index": item["index"], "filename": item["filename"], "status": item["status"]}
+        if item["status"] == "created":
+            result["product_id"] = item["product_id"]
+            result["file_path"] = item["stored_file"]["file_path"]
+        else:
+            result["error"] = item.get("error")
+        results.append(result)
+
+    created = sum(1 for result in results if result["status"] == "created")
+    return {
+        "total": len(results),
+        "created": created,
+        "failed": len(results) - created,
+        "items": results,
+        "success": created == len(results)
+    }
+
+def handle_bulk_import(upload_folder):
+    """
+    Import many products with their images in one request.
+    With ?progress=1 the response is streamed as JSON lines, one per
+    progress event, followed by the summary.
+    """
+    try:
+        rows, sources = read_import_request()
+        items = build_items(rows, sources)
+    except BulkImportError as e:
+        return jsonify({"message": e.message, "success": False}), e.status
+
+    if request.args.get('progress'):
+        def generate():
+            for event in run_import(items, upload_folder):
+                yield json.dumps(event) + "\n"
+            yield json.dumps(import_summary(items)) + "\n"
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    for event in run_import(items, upload_folder):
+        pass
+    summary = import_summary(items)
+    return jsonify(summary), 201 if summary["created"] else 422
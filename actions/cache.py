@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import tempfile
+import threading
+from decimal import Decimal
+from datetime import datetime
+from collections import OrderedDict
+
+from actions.metrics import observe_listing_cache
+
+# Product and gallery listings are cached for this long at most; writes
+# invalidate them right away, so the TTL only bounds missed invalidations
+LISTING_CACHE_TTL = float(os.getenv("LISTING_CACHE_TTL", "60"))
+LISTING_CACHE_MAX_ENTRIES = int(os.getenv("LISTING_CACHE_MAX_ENTRIES", "256"))
+LISTING_CACHE_ENABLED = os.getenv("LISTING_CACHE_ENABLED", "true").lower() == "true"
+# Shared backend, so every instance behind the ALB sees the same generation
+LISTING_CACHE_REDIS_URL = os.getenv("LISTING_CACHE_REDIS_URL") or None
+
+# The client library is only loaded when the shared backend is configured
+redis = None
+if LISTING_CACHE_REDIS_URL:
+    try:
+        import redis
+    except ImportError:  # the shared backend is optional
+        redis = None
+# Without Redis, the generation is the mtime of this file, which keeps the
+# gunicorn workers of one instance coherent with each other
+LISTING_CACHE_GENERATION_PATH = os.getenv(
+    "LISTING_CACHE_GENERATION_PATH", os.path.join(tempfile.gettempdir(), "file-upload-flask-listings.generation")
+)
+
+# After a Redis error the cache runs locally for this long before retrying
+LISTING_CACHE_REDIS_RETRY_SECONDS = float(os.getenv("LISTING_CACHE_REDIS_RETRY_SECONDS", "30"))
+
+REDIS_KEY_PREFIX = "listing-cache:"
+REDIS_GENERATION_KEY = REDIS_KEY_PREFIX + "generation"
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_redis_client = None
+_redis_pid = None
+_redis_down_until = 0.0
+
+_stats = {
+    "hits": 0,
+    "shared_hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+    "errors": 0,
+}
+
+# Prometheus names of the _stats counters
+_EVENTS = {
+    "hits": "hit",
+    "shared_hits": "shared_hit",
+    "misses": "miss",
+    "invalidations": "invalidation",
+    "errors": "error",
+}
+
+def _redis():
+    global _redis_client, _redis_pid
+
+    if LISTING_CACHE_REDIS_URL is None or redis is None or time.monotonic() < _redis_down_until:
+        return None
+    if _redis_client is None or _redis_pid != os.getpid():
+        _redis_client = redis.Redis.from_url(LISTING_CACHE_REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+        _redis_pid = os.getpid()
+    return _redis_client
+
+def _redis_failed():
+    global _redis_down_until
+
+    _count("errors")
+    _redis_down_until = time.monotonic() + LISTING_CACHE_REDIS_RETRY_SECONDS
+
+def _generation():
+    client = _redis()
+    if client is not None:
+        try:
+            return int(client.get(REDIS_GENERATION_KEY) or 0)
+        except redis.RedisError:
+            _redis_failed()
+    try:
+        return os.stat(LISTING_CACHE_GENERATION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+    observe_listing_cache(_EVENTS[name])
+
+def _encode(value):
+    # Listings hold order dates and totals besides JSON types
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {"__decimal__": str(value)}
+    raise TypeError(f"Cannot cache a {type(value).__name__}")
+
+def _decode(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if "__decimal__" in obj:
+        return Decimal(obj["__decimal__"])
+    return obj
+
+def _dumps(value):
+    return json.dumps(value, default=_encode)
+
+def _loads(data):
+    # JSON, not pickle: whoever can write to Redis must not be able to run code here.
+    # Loaders return tuples, which JSON turns into lists.
+    value = json.loads(data, object_hook=_decode)
+    return tuple(value) if isinstance(value, list) else value
+
+def cached(namespace, key, loader):
+    """
+    Return the cached result of loader() for (namespace, key), calling it on
+    a miss. Results are dropped after LISTING_CACHE_TTL or on invalidation.
+    """
+    if not LISTING_CACHE_ENABLED:
+        return loader()
+
+    generation = _generation()
+    local_key = (generation, namespace, key)
+    now = time.monotonic()
+
+    with _lock:
+        entry = _entries.get(local_key)
+        fresh = entry is not None and entry[0] > now
+        if fresh:
+            _entries.move_to_end(local_key)
+    if fresh:
+        _count("hits")
+        return entry[1]
+
+    client = _redis()
+    shared_key = f"{REDIS_KEY_PREFIX}{generation}:{namespace}:{key}"
+    if client is not None:
+        try:
+            data = client.get(shared_key)
+        except redis.RedisError:
+            _redis_failed()
+            data = None
+        if data is not None:
+            try:
+                value = _loads(data)
+            except ValueError:
+                # Not written by this version of the app, load it again
+                value = None
+            if value is not None:
+                _store(local_key, value, now)
+                _count("shared_hits")
+                return value
+
+    _count("misses")
+    value = loader()
+    _store(local_key, value, now)
+    if client is not None:
+        try:
+            client.setex(shared_key, max(1, int(LISTING_CACHE_TTL)), _dumps(value))
+        except redis.RedisError:
+            _redis_failed()
+    return value
+
+def _store(local_key, value, now):
+    with _lock:
+        _entries[local_key] = (now + LISTING_CACHE_TTL, value)
+        _entries.move_to_end(local_key)
+        while len(_entries) > LISTING_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+def invalidate_listings():
+    """
+    Drop every cached listing, here and on the other workers and instances.
+    Call after any write that changes products, orders or images.
+    """
+    with _lock:
+        _entries.clear()
+    _count("invalidations")
+
+    client = _redis()
+    if client is not None:
+        try:
+            client.incr(REDIS_GENERATION_KEY)
+            return
+        except redis.RedisError:
+            _redis_failed()
+
+    # Touching the file moves the generation forward for every local worker
+    with open(LISTING_CACHE_GENERATION_PATH, "a"):
+        pass
+    os.utime(LISTING_CACHE_GENERATION_PATH, ns=(time.time_ns(), time.time_ns()))
+
+def get_cache_stats():
+    """
+    Return hit/miss counters of the listing cache for this process
+    """
+    with _lock:
+        stats = dict(_stats)
+        stats["entries"] = len(_entries)
+    lookups = stats["hits"] + stats["shared_hits"] + stats["misses"]
+    stats["hit_ratio"] = (stats["hits"] + stats["shared_hits"]) / lookups if lookups else 0.0
+    stats["pid"] = os.getpid()
+    stats["backend"] = "redis" if LISTING_CACHE_REDIS_URL and redis is not None else "local"
+    stats["redis_available"] = _redis() is not None
+    stats["enabled"] = LISTING_CACHE_ENABLED
+    return stats
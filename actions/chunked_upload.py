@@ -0,0 +1,323 @@
+import os
+import re
+import json
+import time
+import glob
+import fcntl
+import secrets
+from contextlib import contextmanager
+from flask import url_for, jsonify, request
+from werkzeug.utils import secure_filename
+from actions.upload_image import create_product
+from actions.storage import store_upload_file
+from actions.validation import UploadRejected, check_size, size_limit, validated_stream
+from actions.thumbnails import schedule_derivatives
+
+# Sessions live on the upload volume, so any instance behind the ALB can
+# continue an upload that another one started
+SESSION_DIRECTORY_NAME = ".upload-sessions"
+SESSION_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+UPLOAD_CHUNK_MAX_BYTES = int(os.getenv("UPLOAD_CHUNK_MAX_BYTES", str(8 * 1024 * 1024)))
+# Sessions idle for longer are removed by the reconciler, finished or not
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+STREAM_BUFFER_SIZE = 64 * 1024
+
+class UploadSessionError(Exception):
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+def _session_directory(upload_folder):
+    directory = os.path.join(upload_folder, SESSION_DIRECTORY_NAME)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def _session_paths(upload_folder, session_id):
+    if not SESSION_ID_PATTERN.match(session_id):
+        raise UploadSessionError("Upload session not found", 404)
+    directory = _session_directory(upload_folder)
+    return (os.path.join(directory, session_id + ".json"),
+            os.path.join(directory, session_id + ".part"))
+
+@contextmanager
+def _session_lock(upload_folder, session_id, message, **extra):
+    # One chunk, finalize or abort per session at a time, on any instance.
+    # A lock file of its own, since finalize moves the part file away.
+    lock_path = os.path.join(_session_directory(upload_folder), session_id + ".lock")
+    with open(lock_path, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadSessionError(message, 409, **extra)
+        yield
+
+def _write_json_atomically(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _load_session(upload_folder, session_id):
+    meta_path, part_path = _session_paths(upload_folder, session_id)
+    try:
+        with open(meta_path) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise UploadSessionError("Upload session not found", 404)
+    session["offset"] = os.path.getsize(part_path) if os.path.exists(part_path) else session["size"]
+    return session, meta_path, part_path
+
+def _session_response(session, status=200):
+    body = {
+        "session_id": session["session_id"],
+        "filename": session["filename"],
+        "size": session["size"],
+        "offset": session["offset"],
+        "chunk_max_bytes": UPLOAD_CHUNK_MAX_BYTES,
+        "upload_url": url_for('upload_session', session_id=session["session_id"]),
+        "finalize_url": url_for('finalize_upload', session_id=session["session_id"]),
+    }
+    if session.get("result"):
+        body.update(session["result"])
+    return jsonify(body), status
+
+def _error_response(error):
+    body = {"message": error.message, "success": False}
+    body.update(error.extra)
+    return jsonify(body), error.status
+
+def init_upload_session(upload_folder):
+    """
+    Start a resumable upload: POST {filename, size} returns a session
+    """
+    payload = request.get_json(silent=True) or request.form
+    filename = secure_filename(payload.get("filename", ""))
+
+    try:
+        size = int(payload.get("size", -1))
+    except (TypeError, ValueError):
+        size = -1
+
+    if not filename:
+        return _error_response(UploadSessionError("File type not allowed"))
+    if size < 0:
+        return _error_response(UploadSessionError("A non-negative size is required"))
+    try:
+        check_size(filename, size)
+    except UploadRejected as e:
+        return _error_response(UploadSessionError(e.message, e.status, max_bytes=size_limit(filename)))
+
+    session_id = secrets.token_hex(16)
+    meta_path, part_path = _session_paths(upload_folder, session_id)
+    session = {
+        "session_id": session_id,
+        "filename": filename,
+        "size": size,
+        "created_at": time.time(),
+    }
+    # Create the empty part file first so the offset is always derivable
+    open(part_path, "wb").close()
+    _write_json_atomically(meta_path, session)
+
+    session["offset"] = 0
+    return _session_response(session, 201)
+
+def get_upload_session(upload_folder, session_id):
+    """
+    Report how many bytes of an upload have been received so a client can resume
+    """
+    try:
+        session, _, _ = _load_session(upload_folder, session_id)
+    except UploadSessionError as e:
+        return _error_response(e)
+    return _session_response(session)
+
+def _requested_offset():
+    # Accept either ?offset=N or a standard "Content-Range: bytes N-M/T" header
+    content_range = request.headers.get("Content-Range")
+    if content_range:
+        match = re.match(r"^bytes (\d+)-(\d+)/(\d+|\*)$", content_range.strip())
+        if not match:
+            raise UploadSessionError("Invalid Content-Range header")
+        return int(match.group(1))
+    try:
+        return int(request.args.get("offset", ""))
+    except ValueError:
+        raise UploadSessionError("An offset is required")
+
+def upload_session_chunk(upload_folder, session_id):
+    """
+    Append one chunk (PUT body) at the given offset, streaming it straight
+    to the part file without buffering the request
+    """
+    try:
+        session, _, part_path = _load_session(upload_folder, session_id)
+        if session.get("result"):
+            raise UploadSessionError("Upload session is already finalized", 409)
+
+        offset = _requested_offset()
+        content_length = request.content_length
+        remaining = session["size"] - offset
+
+        # Reject what we can before reading a single byte of the body
+        if content_length is not None and content_length > min(UPLOAD_CHUNK_MAX_BYTES, remaining):
+            raise UploadSessionError(
+                "Chunk is too large", 413,
+                max_bytes=min(UPLOAD_CHUNK_MAX_BYTES, remaining), offset=session["offset"])
+
+        with _session_lock(upload_folder, session_id, "Another request is using this session",
+                           offset=session["offset"]):
+            # A finalize may have run since the session was read
+            session, _, part_path = _load_session(upload_folder, session_id)
+            if session.get("result") or session.get("stored_file"):
+                raise UploadSessionError("Upload session is already finalized", 409)
+            _write_chunk(session, part_path, offset, remaining)
+    except UploadSessionError as e:
+        return _error_response(e)
+
+    return _session_response(session)
+
+def _write_chunk(session, part_path, offset, remaining):
+    """
+    Stream the request body into the part file at offset
+    """
+    with open(part_path, "r+b") as part:
+        current_offset = os.fstat(part.fileno()).st_size
+        if offset != current_offset:
+            raise UploadSessionError("Offset does not match", 409, offset=current_offset)
+
+        part.seek(offset)
+        limit = min(UPLOAD_CHUNK_MAX_BYTES, remaining)
+        stream = request.stream
+        if offset == 0:
+            # The first chunk carries the file's magic bytes and dimensions
+            try:
+                stream = validated_stream(stream, session["filename"])
+            except UploadRejected as e:
+                raise UploadSessionError(e.message, e.status, offset=0)
+        received = 0
+        try:
+            while True:
+                # The validated stream rejects the file while reading its head
+                buffer = stream.read(STREAM_BUFFER_SIZE)
+                if not buffer:
+                    break
+                received += len(buffer)
+                if received > limit:
+                    raise UploadSessionError(
+                        "Chunk is too large", 413, max_bytes=limit, offset=offset)
+                part.write(buffer)
+        except UploadRejected as e:
+            # Drop what this request wrote, the client can retry the chunk
+            part.truncate(offset)
+            raise UploadSessionError(e.message, e.status, offset=offset)
+        except UploadSessionError:
+            part.truncate(offset)
+            raise
+
+        part.flush()
+        os.fsync(part.fileno())
+        session["offset"] = offset + received
+
+def finalize_upload_session(upload_folder, session_id):
+    """
+    Move a complete upload into place and create its product
+    """
+    try:
+        session, meta_path, part_path = _load_session(upload_folder, session_id)
+
+        # Finalizing twice returns the first result
+        if session.get("result"):
+            return _session_response(session)
+
+        payload = request.get_json(silent=True) or request.form
+        product_name = payload.get("product_name")
+        try:
+            stock_count = int(payload.get("initial_stock_count"))
+        except (TypeError, ValueError):
+            raise UploadSessionError("initial_stock_count must be an integer")
+        if not product_name:
+            raise UploadSessionError("product_name is required")
+
+        with _session_lock(upload_folder, session_id, "Upload is being finalized"):
+            # Another finalize may have finished while we waited for the lock
+            session, meta_path, part_path = _load_session(upload_folder, session_id)
+            if session.get("result"):
+                return _session_response(session)
+            if session["offset"] != session["size"]:
+                raise UploadSessionError(
+                    "Upload is incomplete", 409, offset=session["offset"], size=session["size"])
+
+            # Remember where the file went before creating the product, so a retried
+            # finalize after a failure does not need the part file any more
+            if not session.get("stored_file"):
+                session["stored_file"] = store_upload_file(part_path, session["filename"], upload_folder)
+                _write_json_atomically(meta_path, session)
+
+            stored_file = session["stored_file"]
+            product_id, mongodb_id = create_product(stored_file, product_name, stock_count)
+            schedule_derivatives(upload_folder, stored_file)
+
+            session["result"] = {
+                "product_id": product_id,
+                "img_url": url_for('download_file', name=stored_file["file_path"]),
+                "success": True,
+            }
+            _write_json_atomically(meta_path, session)
+    except UploadSessionError as e:
+        return _error_response(e)
+
+    return _session_response(session)
+
+def _remove_session_files(upload_folder, session_id):
+    # The part, metadata and lock file, and temporary files of interrupted writes
+    for path in glob.glob(os.path.join(_session_directory(upload_folder), session_id + ".*")):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def abort_upload_session(upload_folder, session_id):
+    """
+    Throw away an unfinished upload
+    """
+    try:
+        _load_session(upload_folder, session_id)
+        with _session_lock(upload_folder, session_id, "Another request is using this session"):
+            _remove_session_files(upload_folder, session_id)
+    except UploadSessionError as e:
+        return _error_response(e)
+    return "", 204
+
+def upload_session_activity(upload_folder):
+    """
+    Map each session id to the time of its last activity, the newest
+    modification time of its files
+    """
+    last_activity = {}
+    try:
+        with os.scandir(os.path.join(upload_folder, SESSION_DIRECTORY_NAME)) as entries:
+            for entry in entries:
+                session_id = entry.name.split(".", 1)[0]
+                if not SESSION_ID_PATTERN.match(session_id):
+                    continue
+                mtime = entry.stat(follow_symlinks=False).st_mtime
+                last_activity[session_id] = max(mtime, last_activity.get(session_id, 0))
+    except FileNotFoundError:
+        pass
+    return last_activity
+
+def expire_upload_session(upload_folder, session_id):
+    """
+    Remove a session idle for longer than UPLOAD_SESSION_TTL_SECONDS.
+    Returns False if a request is using it right now.
+    """
+    try:
+        with _session_lock(upload_folder, session_id, "Another request is using this session"):
+            _remove_session_files(upload_folder, session_id)
+    except UploadSessionError:
+        return False
+    return True
@@ -1,7 +1,71 @@
 import os
 import psycopg2
-from flask import url_for, flash, redirect, request, render_template
+from psycopg2.extras import execute_values
+from flask import (url_for, flash, redirect, request, render_template, stream_template, get_flashed_messages,
+                   current_app, jsonify)
 from db.mongodb.mongodb_connection import create_mongodb_connection
+from db.postgresql.postgresql_connection import (create_postgresql_connection, release_postgresql_connection,
+                                                 postgresql_connection, iter_server_side, PoolTimeoutError)
+from actions.utils import (build_image_indexes, find_product_image, fetch_product_images,
+                           stream_requested, streamed_response)
+from actions.cache import cached, invalidate_listings
+
+# Simple flat price until products get a price column
+UNIT_PRICE = 10.00
+
+# The conditional UPDATE takes the row lock and re-checks stock_count, so
+# concurrent orders for the same product can't oversell or lose updates.
+# The order, stock movement and sales summaries are only written if the
+# UPDATE matched. The summary rows belong to the locked product, so keeping
+# them in the same transaction adds no contention between products.
+PLACE_ORDER_SQL = """
+    WITH updated AS (
+        UPDATE products
+        SET stock_count = stock_count - %(quantity)s
+        WHERE id = %(product_id)s AND stock_count >= %(quantity)s
+        RETURNING id, name, stock_count
+    ), new_order AS (
+        INSERT INTO orders (customer_name, total, tax, pretax_amount)
+        SELECT %(customer_name)s, %(total)s, 0, %(total)s FROM updated
+        RETURNING id
+    ), movement AS (
+        INSERT INTO stock_movements (product_id, order_id, quantity)
+        SELECT updated.id, new_order.id, %(quantity)s FROM updated, new_order
+    ), summary AS (
+        INSERT INTO product_sales_summary AS s
+            (product_id, units_sold, revenue, order_count, first_sold_at, last_sold_at)
+        SELECT updated.id, %(quantity)s, %(total)s, 1, now(), now() FROM updated, new_order
+        ON CONFLICT (product_id) DO UPDATE SET
+            units_sold = s.units_sold + EXCLUDED.units_sold,
+            revenue = s.revenue + EXCLUDED.revenue,
+            order_count = s.order_count + 1,
+            last_sold_at = EXCLUDED.last_sold_at
+    ), daily AS (
+        INSERT INTO product_sales_daily AS d (product_id, day, units_sold, revenue)
+        SELECT updated.id, (now() AT TIME ZONE 'UTC')::date, %(quantity)s, %(total)s FROM updated, new_order
+        ON CONFLICT (product_id, day) DO UPDATE SET
+            units_sold = d.units_sold + EXCLUDED.units_sold,
+            revenue = d.revenue + EXCLUDED.revenue
+    )
+    SELECT new_order.id, updated.name, updated.stock_count FROM updated, new_order
+"""
+
+def place_order(cur, product_id, customer_name, order_quantity):
+    """
+    Place an order in a single round trip.
+    Returns (order_id, product_name, remaining_stock), or None when the
+    product does not exist or does not have enough stock.
+    The caller owns the transaction.
+    """
+    # Tax is 0, pretax_amount equals total
+    total = UNIT_PRICE * order_quantity
+    cur.execute(PLACE_ORDER_SQL, {
+        "product_id": product_id,
+        "customer_name": customer_name,
+        "quantity": order_quantity,
+        "total": total,
+    })
+    return cur.fetchone()
 
 def process_order(request, app):
     """
@@ -30,69 +94,34 @@ def process_order(request, app):
             flash('Invalid order quantity')
             return redirect(request.url)
             
-        # Connect to PostgreSQL with error handling
-        conn = psycopg2.connect(
-            host=os.environ["POSTGRESQL_DB_HOST"],
-            database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
-            user=os.environ['POSTGRESQL_DB_USERNAME'],
-            password=os.environ['POSTGRESQL_DB_PASSWORD']
-        )
+        # Borrow a pooled PostgreSQL connection
+        conn = create_postgresql_connection()
         conn.autocommit = False  # Start transaction mode
         cur = conn.cursor()
         
         try:
-            # First check if there's enough stock
-            cur.execute("SELECT name, stock_count FROM products WHERE id = %s", (product_id,))
-            result = cur.fetchone()
+            # Decrement stock, create the order and its stock movement in one statement
+            result = place_order(cur, product_id, customer_name, order_quantity)
             
             if not result:
                 conn.rollback()
-                cur.close()
-                conn.close()
-                flash('Product not found')
+                # Only the failure path needs a second look to explain why
+                cur.execute("SELECT name, stock_count FROM products WHERE id = %s", (product_id,))
+                product = cur.fetchone()
+                if not product:
+                    flash('Product not found')
+                else:
+                    flash(f'Not enough stock available for {product[0]}. Available: {product[1]}')
                 return redirect(url_for('create_order'))
-                
-            product_name, current_stock = result
-            
-            if current_stock < order_quantity:
-                conn.rollback()
-                cur.close()
-                conn.close()
-                flash(f'Not enough stock available for {product_name}. Available: {current_stock}')
-                return redirect(url_for('create_order'))
-            
-            # Calculate order total (simple example)
-            unit_price = 10.00  # You might want to add a price column to products
-            total = unit_price * order_quantity
-            
-            # Create order record - simplified without tax
-            cur.execute("""
-                INSERT INTO orders (customer_name, total, tax, pretax_amount) 
-                VALUES (%s, %s, %s, %s) RETURNING id
-                """, (customer_name, total, 0, total))  # Tax is 0, pretax_amount equals total
-            
-            order_id = cur.fetchone()[0]
             
-            # Create stock movement record
-            cur.execute("""
-                INSERT INTO stock_movements (product_id, order_id, quantity) 
-                VALUES (%s, %s, %s)
-                """, (product_id, order_id, order_quantity))
-            
-            # Update product stock
-            new_stock = current_stock - order_quantity
-            cur.execute("UPDATE products SET stock_count = %s WHERE id = %s", 
-                       (new_stock, product_id))
+            order_id, product_name, remaining_stock = result
             
             # Commit the transaction
             conn.commit()
+            invalidate_listings()
             
             flash(f'Order #{order_id} created successfully for {product_name}')
             
-            # Close the current connection
-            cur.close()
-            conn.close()
-            
             # Return to the GET part of the function to fetch fresh data
             return redirect(url_for('create_order'))
             
@@ -102,167 +131,386 @@ def process_order(request, app):
             flash(f'Error creating order: {str(e)}')
             return redirect(request.url)
         finally:
-            if cur and not cur.closed:
+            if not cur.closed:
                 cur.close()
-            if conn and not conn.closed:
-                conn.close()
+            release_postgresql_connection(conn)
             
     except Exception as e:
         app.logger.error(f"Unexpected error in create_order: {e}")
         flash('An unexpected error occurred')
         return redirect(request.url)
 
+BULK_ORDER_MAX_LINES = int(os.getenv("BULK_ORDER_MAX_LINES", "1000"))
+
+# The bulk order's share of the sales summaries, one row per product
+RECORD_SALES_SQL = """
+    WITH sales (product_id, units_sold, revenue) AS (VALUES %s), summary AS (
+        INSERT INTO product_sales_summary AS s
+            (product_id, units_sold, revenue, order_count, first_sold_at, last_sold_at)
+        SELECT product_id, units_sold, revenue, 1, now(), now() FROM sales
+        ON CONFLICT (product_id) DO UPDATE SET
+            units_sold = s.units_sold + EXCLUDED.units_sold,
+            revenue = s.revenue + EXCLUDED.revenue,
+            order_count = s.order_count + 1,
+            last_sold_at = EXCLUDED.last_sold_at
+    )
+    INSERT INTO product_sales_daily AS d (product_id, day, units_sold, revenue)
+    SELECT product_id, (now() AT TIME ZONE 'UTC')::date, units_sold, revenue FROM sales
+    ON CONFLICT (product_id, day) DO UPDATE SET
+        units_sold = d.units_sold + EXCLUDED.units_sold,
+        revenue = d.revenue + EXCLUDED.revenue
+"""
+
+def place_bulk_order(cur, customer_name, lines):
+    """
+    Place one order with many lines in the caller's transaction.
+    lines is a list of (product_id, quantity). Lines that can't be fulfilled
+    are reported and skipped, the others are placed together.
+    Returns (order_id, line_results); order_id is None if nothing was placed.
+    """
+    product_ids = sorted({product_id for product_id, quantity in lines})
+
+    # Lock every product of the order in id order, so two bulk orders
+    # touching the same products can't deadlock each other
+    cur.execute("""
+        SELECT id, name, stock_count FROM products
+        WHERE id = ANY(%s)
+        ORDER BY id
+        FOR UPDATE
+    """, (product_ids,))
+    products = {row[0]: {"name": row[1], "stock_count": row[2]} for row in cur.fetchall()}
+
+    line_results = []
+    decrements = {}
+    for product_id, quantity in lines:
+        product = products.get(product_id)
+        result = {"product_id": product_id, "quantity": quantity}
+        if product is None:
+            result["status"] = "not_found"
+        elif product["stock_count"] < quantity:
+            result["status"] = "insufficient_stock"
+            result["available"] = product["stock_count"]
+        else:
+            product["stock_count"] -= quantity
+            decrements[product_id] = decrements.get(product_id, 0) + quantity
+            result["status"] = "placed"
+            result["product_name"] = product["name"]
+            result["remaining_stock"] = product["stock_count"]
+        line_results.append(result)
+
+    placed = [result for result in line_results if result["status"] == "placed"]
+    if not placed:
+        return None, line_results
+
+    total = UNIT_PRICE * sum(result["quantity"] for result in placed)
+    cur.execute("""
+        INSERT INTO orders (customer_name, total, tax, pretax_amount)
+        VALUES (%s, %s, %s, %s) RETURNING id
+        """, (customer_name, total, 0, total))
+    order_id = cur.fetchone()[0]
+
+    execute_values(cur, """
+        INSERT INTO stock_movements (product_id, order_id, quantity) VALUES %s
+        """, [(result["product_id"], order_id, result["quantity"]) for result in placed])
+
+    execute_values(cur, """
+        UPDATE products AS p SET stock_count = p.stock_count - v.quantity
+        FROM (VALUES %s) AS v (id, quantity)
+        WHERE p.id = v.id
+        """, list(decrements.items()))
+
+    # In product id order, like the locks above
+    execute_values(cur, RECORD_SALES_SQL, [
+        (product_id, quantity, UNIT_PRICE * quantity) for product_id, quantity in sorted(decrements.items())
+    ], template="(%s::integer, %s::bigint, %s::decimal)")
+
+    return order_id, line_results
+
+def process_bulk_order(request, app):
+    """
+    Process a JSON order with many lines:
+    {"customer_name": "...", "lines": [{"product_id": 1, "quantity": 2}, ...]}
+    """
+    payload = request.get_json(silent=True) or {}
+
+    customer_name = str(payload.get('customer_name', '')).strip()
+    if not customer_name:
+        return jsonify({"message": "Customer name is required", "success": False}), 400
+
+    raw_lines = payload.get('lines')
+    if not isinstance(raw_lines, list) or not raw_lines:
+        return jsonify({"message": "At least one order line is required", "success": False}), 400
+    if len(raw_lines) > BULK_ORDER_MAX_LINES:
+        return jsonify({"message": f"At most {BULK_ORDER_MAX_LINES} lines per order", "success": False}), 413
+
+    lines = []
+    for number, line in enumerate(raw_lines):
+        try:
+            product_id = int(line['product_id'])
+            quantity = int(line.get('quantity', 1))
+        except (TypeError, KeyError, ValueError, AttributeError):
+            return jsonify({"message": f"Line {number} is invalid", "success": False}), 400
+        if quantity <= 0:
+            return jsonify({"message": f"Line {number}: quantity must be positive", "success": False}), 400
+        lines.append((product_id, quantity))
+
+    try:
+        with postgresql_connection() as conn:
+            cur = conn.cursor()
+            try:
+                order_id, line_results = place_bulk_order(cur, customer_name, lines)
+                # Nothing was placed, so there is no order to keep
+                if order_id is None:
+                    conn.rollback()
+                else:
+                    conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+    except PoolTimeoutError as e:
+        app.logger.error(f"Database busy: {e}")
+        return jsonify({"message": "The database is busy, try again", "success": False}), 503
+    except psycopg2.Error as e:
+        app.logger.error(f"Database error: {e}")
+        return jsonify({"message": f"Error creating order: {str(e)}", "success": False}), 500
+
+    if order_id is not None:
+        invalidate_listings()
+
+    return jsonify({
+        "order_id": order_id,
+        "lines": line_results,
+        "placed_lines": sum(1 for result in line_results if result["status"] == "placed"),
+        "success": order_id is not None
+    }), 201 if order_id is not None else 409
+
+ORDER_PRODUCTS_SQL = """
+    SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path
+    FROM products p
+"""
+
+RECENT_ORDERS_SQL = """
+    SELECT o.id, sm.product_id, p.name, sm.quantity, o.created_at, p.image_mongodb_id, o.total, o.customer_name,
+           p.image_file_path
+    FROM orders o
+    JOIN stock_movements sm ON o.id = sm.order_id
+    JOIN products p ON sm.product_id = p.id
+    ORDER BY o.created_at DESC, o.id DESC
+    LIMIT 10
+"""
+
 def get_products_and_orders():
     """
     Get products and recent orders for the order page
     """
     try:
-        conn = psycopg2.connect(
-            host=os.environ["POSTGRESQL_DB_HOST"],
-            database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
-            user=os.environ['POSTGRESQL_DB_USERNAME'],
-            password=os.environ['POSTGRESQL_DB_PASSWORD']
-        )
+        return cached("order-page", "", load_products_and_orders)
+    except Exception as e:
+        current_app.logger.error(f"Error loading products: {e}")
+        return [], []
+
+def load_products_and_orders():
+    """
+    Read products and recent orders from the databases, bypassing the cache
+    """
+    conn = None
+    try:
+        conn = create_postgresql_connection()
         cur = conn.cursor()
         
         # Get all products with their details including MongoDB image ID
-        cur.execute("""
-            SELECT p.id, p.name, p.stock_count, p.image_mongodb_id 
-            FROM products p
-        """)
+        cur.execute(ORDER_PRODUCTS_SQL)
         products = cur.fetchall()
         
-        # Get all images from MongoDB
+        # Only products created before image_file_path was added need their
+        # image looked up in MongoDB
         client, database, collection = create_mongodb_connection("file-uploads")
-        all_images = list(collection.find({}))
+        all_images = fetch_product_images(collection, [product for product in products if not product[4]])
+        images_by_product_id, images_by_id = build_image_indexes(all_images)
         
-        # Prepare data for template
-        parsed_products = []
-        
-        # Process products with their images
-        for product in products:
-            product_id = product[0]
-            product_name = product[1]
-            stock_count = product[2]
-            image_mongodb_id = product[3]
-            
-            # Find matching image for this product
-            matching_image = None
-            
-            # Try to find by product_id in MongoDB
-            for img in all_images:
-                if 'product_id' in img and str(img['product_id']) == str(product_id):
-                    matching_image = img
-                    break
-            
-            # If no match by product_id, try by image_mongodb_id
-            if not matching_image and image_mongodb_id:
-                for img in all_images:
-                    if '_id' in img and str(img['_id']) == image_mongodb_id:
-                        matching_image = img
-                        break
-            
-            # If we found a matching image
-            if matching_image and 'file_path' in matching_image:
-                img_url = url_for('download_file', name=matching_image['file_path'])
-                
-                product_data = {
-                    "product_id": product_id,
-                    "product_name": product_name,
-                    "stock_count": stock_count,
-                    "image_url": img_url,
-                    "file_path": matching_image['file_path']
-                }
-            else:
-                # No matching image found
-                product_data = {
-                    "product_id": product_id,
-                    "product_name": product_name,
-                    "stock_count": stock_count,
-                    "image_url": "",
-                    "file_path": ""
-                }
-            
-            parsed_products.append(product_data)
+        parsed_products = build_order_products(products, images_by_product_id, images_by_id)
         
         # Fetch recent orders for display
         orders = []
         try:
             # Get recent orders with product details through stock_movements
-            cur.execute("""
-                SELECT o.id, sm.product_id, p.name, sm.quantity, o.created_at, p.image_mongodb_id, o.total, o.customer_name 
-                FROM orders o
-                JOIN stock_movements sm ON o.id = sm.order_id
-                JOIN products p ON sm.product_id = p.id
-                ORDER BY o.created_at DESC
-                LIMIT 10
-            """)
-            
-            recent_orders = cur.fetchall()
-            
-            # Process orders with product images
-            for order in recent_orders:
-                order_id = order[0]
-                product_id = order[1]
-                product_name = order[2]
-                quantity = order[3]
-                order_date = order[4]
-                image_mongodb_id = order[5]
-                total = order[6]
-                customer_name = order[7]
-                
-                # Find matching image for this product
-                image_url = ""
-                
-                # Try to find by product_id in MongoDB
-                for img in all_images:
-                    if 'product_id' in img and str(img['product_id']) == str(product_id):
-                        if 'file_path' in img:
-                            image_url = url_for('download_file', name=img['file_path'])
-                        break
-                
-                # If no match by product_id, try by image_mongodb_id
-                if not image_url and image_mongodb_id:
-                    for img in all_images:
-                        if '_id' in img and str(img['_id']) == image_mongodb_id:
-                            if 'file_path' in img:
-                                image_url = url_for('download_file', name=img['file_path'])
-                            break
-                
-                order_data = {
-                    "order_id": order_id,
-                    "product_id": product_id,
-                    "product_name": product_name,
-                    "quantity": quantity,
-                    "order_date": order_date,
-                    "image_url": image_url,
-                    "total": total,
-                    "customer_name": customer_name
-                }
-                
-                orders.append(order_data)
+            cur.execute(RECENT_ORDERS_SQL)
+            orders = build_recent_orders(cur.fetchall(), images_by_product_id, images_by_id)
         except Exception as e:
-            app.logger.error(f"Error fetching orders: {e}")
+            current_app.logger.error(f"Error fetching orders: {e}")
             # Continue without orders if there's an error
         
         client.close()
         cur.close()
-        conn.close()
         
         return parsed_products, orders
         
-    except Exception as e:
-        app.logger.error(f"Error loading products: {e}")
-        return [], []
+    finally:
+        if conn is not None:
+            release_postgresql_connection(conn)
+
+def stream_order_products():
+    """
+    Yield the order form's products as they are read from a server-side
+    cursor, looking up MongoDB images one chunk at a time
+    """
+    client, database, collection = create_mongodb_connection("file-uploads")
+    try:
+        for products in iter_server_side(ORDER_PRODUCTS_SQL):
+            images = fetch_product_images(collection, [product for product in products if not product[4]])
+            images_by_product_id, images_by_id = build_image_indexes(images)
+            yield from build_order_products(products, images_by_product_id, images_by_id)
+    finally:
+        client.close()
+
+def load_recent_orders():
+    """
+    Recent orders with their images, looking up only their own products'
+    images in MongoDB
+    """
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(RECENT_ORDERS_SQL)
+        recent_orders = cur.fetchall()
+        cur.close()
+
+    # (id, name, stock_count, image_mongodb_id, image_file_path) like a product row
+    missing = [(order[1], order[2], None, order[5], order[8]) for order in recent_orders if not order[8]]
+    images = []
+    if missing:
+        client, database, collection = create_mongodb_connection("file-uploads")
+        images = fetch_product_images(collection, missing)
+        client.close()
+
+    images_by_product_id, images_by_id = build_image_indexes(images)
+    return build_recent_orders(recent_orders, images_by_product_id, images_by_id)
+
+def build_order_products(products, images_by_product_id, images_by_id, url_for=url_for):
+    """
+    Join product rows with their images for the order form.
+    url_for is the URL builder of the app rendering the page.
+    """
+    parsed_products = []
+    
+    # Process products with their images
+    for product in products:
+        product_id = product[0]
+        product_name = product[1]
+        stock_count = product[2]
+        image_mongodb_id = product[3]
+        
+        # Use the denormalized path, else find the image by product_id, then by image_mongodb_id
+        if product[4]:
+            matching_image = {"file_path": product[4]}
+        else:
+            matching_image = find_product_image(product_id, image_mongodb_id, images_by_product_id, images_by_id)
+        
+        # If we found a matching image
+        if matching_image and 'file_path' in matching_image:
+            img_url = url_for('download_file', name=matching_image['file_path'])
+            
+            product_data = {
+                "product_id": product_id,
+                "product_name": product_name,
+                "stock_count": stock_count,
+                "image_url": img_url,
+                "file_path": matching_image['file_path']
+            }
+        else:
+            # No matching image found
+            product_data = {
+                "product_id": product_id,
+                "product_name": product_name,
+                "stock_count": stock_count,
+                "image_url": "",
+                "file_path": ""
+            }
+        
+        parsed_products.append(product_data)
+    
+    return parsed_products
+
+def build_recent_orders(recent_orders, images_by_product_id, images_by_id, url_for=url_for):
+    """
+    Turn RECENT_ORDERS_SQL rows into order entries with product images
+    """
+    orders = []
+    
+    # Process orders with product images
+    for order in recent_orders:
+        order_id = order[0]
+        product_id = order[1]
+        product_name = order[2]
+        quantity = order[3]
+        order_date = order[4]
+        image_mongodb_id = order[5]
+        total = order[6]
+        customer_name = order[7]
+        image_file_path = order[8]
+        
+        # Find matching image for this product
+        image_url = ""
+        if image_file_path:
+            image_url = url_for('download_file', name=image_file_path)
+        
+        # Try to find by product_id in MongoDB
+        img = images_by_product_id.get(str(product_id)) if not image_url else None
+        if img and 'file_path' in img:
+            image_url = url_for('download_file', name=img['file_path'])
+        
+        # If no match by product_id, try by image_mongodb_id
+        if not image_url and image_mongodb_id:
+            img = images_by_id.get(image_mongodb_id)
+            if img and 'file_path' in img:
+                image_url = url_for('download_file', name=img['file_path'])
+        
+        order_data = {
+            "order_id": order_id,
+            "product_id": product_id,
+            "product_name": product_name,
+            "quantity": quantity,
+            "order_date": order_date,
+            "image_url": image_url,
+            "total": total,
+            "customer_name": customer_name
+        }
+        
+        orders.append(order_data)
+    
+    return orders
 
 def render_order_page(app):
     """
     Render the order page with products and recent orders
     """
+    if stream_requested():
+        return render_order_stream(app)
+
     try:
         products, orders = get_products_and_orders()
         return render_template('create_order.html', products=products, orders=orders)
     except Exception as e:
         app.logger.error(f"Error loading products: {e}")
         flash('Error loading products')
-        return render_template('create_order.html', products=[], orders=[])
\ No newline at end of file
+        return render_template('create_order.html', products=[], orders=[])
+
+def render_order_stream(app):
+    """
+    Stream the order page, sending the product options as they are read.
+    The recent orders are few and loaded up front; the listing cache is not
+    used.
+    """
+    # Pop the flashed messages now: the session cookie goes out with the
+    # headers, before the template gets to them
+    get_flashed_messages()
+
+    try:
+        orders = load_recent_orders()
+    except Exception as e:
+        app.logger.error(f"Error fetching orders: {e}")
+        orders = []
+
+    return streamed_response(
+        stream_template('create_order.html', products=stream_order_products(), orders=orders), "text/html")
@@ -0,0 +1,282 @@
+"""
+Read-through cache of uploads on the instance's local disk, in front of the
+upload volume (EFS), for the files served by send_upload.
+
+Copies are kept under FILE_CACHE_DIRECTORY with the same relative paths.
+Each gets the modification time of its source. For files stored by name,
+which a later upload can replace, each read compares the source's size and
+mtime with the copy's. Content-addressed files never change, so their
+copies are used without touching the upload volume. Processes fill the
+cache under a striped flock and publish copies with an atomic rename. The
+least recently used copies are evicted once the cache grows past
+FILE_CACHE_MAX_BYTES.
+"""
+import os
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import safe_join
+
+from actions.metrics import observe_file_cache, observe_file_cache_size
+
+# Unset disables the cache
+FILE_CACHE_DIRECTORY = os.getenv("FILE_CACHE_DIRECTORY") or None
+FILE_CACHE_MAX_BYTES = int(os.getenv("FILE_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Larger files are always served from the upload volume
+FILE_CACHE_MAX_FILE_BYTES = int(os.getenv("FILE_CACHE_MAX_FILE_BYTES", str(64 * 1024 * 1024)))
+# A copy's atime is bumped at most this often, eviction goes by atime
+FILE_CACHE_TOUCH_INTERVAL = int(os.getenv("FILE_CACHE_TOUCH_INTERVAL", "60"))
+# Run an eviction pass after this many copies, or a tenth of the cap
+FILE_CACHE_EVICT_EVERY = int(os.getenv("FILE_CACHE_EVICT_EVERY", "50"))
+# nginx location serving FILE_CACHE_DIRECTORY, for FILE_SERVING_MODE=accel
+FILE_CACHE_ACCEL_PREFIX = os.getenv("FILE_CACHE_ACCEL_PREFIX") or None
+
+LOCK_DIRECTORY_NAME = ".locks"
+# Fills of different files share one of this many lock files
+LOCK_STRIPES = 256
+COPY_BUFFER_SIZE = 1024 * 1024
+# Temporary files older than this were left by a crashed process
+STALE_TMP_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_executor = None
+_filled_since_eviction = 0
+_bytes_since_eviction = 0
+
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "stale": 0,
+    "bypassed": 0,
+    "bytes_saved": 0,
+}
+
+def cached_file_path(file_path):
+    return safe_join(FILE_CACHE_DIRECTORY, file_path)
+
+def local_copy(upload_folder, file_path, immutable):
+    """
+    Find or make the local copy of an upload.
+    Returns (path, result, stat): result is "hit", "miss", "stale" or
+    "bypass" (None when the cache is off), path and stat describe the copy
+    and are None unless it can be served. immutable is True for
+    content-addressed files.
+    """
+    if FILE_CACHE_DIRECTORY is None:
+        return None, None, None
+
+    source = safe_join(upload_folder, file_path)
+    target = cached_file_path(file_path)
+    if source is None or target is None:
+        return None, "bypass", None
+
+    source_stat = None
+    if not immutable:
+        try:
+            source_stat = os.stat(source)
+        except FileNotFoundError:
+            return None, "bypass", None
+        if source_stat.st_size > FILE_CACHE_MAX_FILE_BYTES:
+            return None, "bypass", None
+
+    cached_stat, result = _check(target, source_stat)
+    if cached_stat is not None:
+        _touch(target, cached_stat)
+        return target, "hit", cached_stat
+
+    try:
+        with _fill_lock(file_path):
+            # Another process may have copied it while we waited
+            cached_stat, _ = _check(target, source_stat)
+            if cached_stat is not None:
+                return target, "hit", cached_stat
+            cached_stat = _fill(source, target)
+    except OSError as e:
+        # A full or broken local disk must not break serving
+        logger.warning("could not cache %s: %s", file_path, e)
+        return None, "bypass", None
+
+    if cached_stat is None:
+        return None, "bypass", None
+    _schedule_eviction(cached_stat.st_size)
+    return target, result, cached_stat
+
+def _check(target, source_stat):
+    """
+    Stat the copy; returns (stat, None) if it can be served, else
+    (None, "miss") or (None, "stale")
+    """
+    try:
+        cached_stat = os.stat(target)
+    except FileNotFoundError:
+        return None, "miss"
+    if source_stat is None or (cached_stat.st_size == source_stat.st_size
+                               and cached_stat.st_mtime_ns == source_stat.st_mtime_ns):
+        return cached_stat, None
+    return None, "stale"
+
+@contextmanager
+def _fill_lock(file_path):
+    directory = os.path.join(FILE_CACHE_DIRECTORY, LOCK_DIRECTORY_NAME)
+    os.makedirs(directory, exist_ok=True)
+    stripe = int(hashlib.sha1(file_path.encode()).hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(directory, f"{stripe:02x}"), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _fill(source, target):
+    """
+    Copy source to target through a temporary file and a rename, so readers
+    never see a partial copy. Returns the copy's stat, or None if the
+    source is gone or too large.
+    """
+    try:
+        src = open(source, "rb")
+    except FileNotFoundError:
+        return None
+
+    with src:
+        # The open file, not the path: an upload may replace the path meanwhile
+        source_stat = os.fstat(src.fileno())
+        if source_stat.st_size > FILE_CACHE_MAX_FILE_BYTES:
+            return None
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_target = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_target, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            # The source's mtime marks which version this is a copy of
+            os.utime(tmp_target, ns=(time.time_ns(), source_stat.st_mtime_ns))
+            os.replace(tmp_target, target)
+        except BaseException:
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+            raise
+    return os.stat(target)
+
+def _touch(path, cached_stat):
+    # Mark as recently used; atime is set explicitly since local disks are
+    # usually mounted relatime or noatime
+    if time.time() - cached_stat.st_atime > FILE_CACHE_TOUCH_INTERVAL:
+        try:
+            os.utime(path, ns=(time.time_ns(), cached_stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+def invalidate_cached_file(file_path):
+    """
+    Drop the local copy of an upload that was replaced. Other instances
+    notice the new mtime on their next read.
+    """
+    target = cached_file_path(file_path) if FILE_CACHE_DIRECTORY is not None else None
+    if target is None:
+        return
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+
+def _schedule_eviction(size):
+    global _executor, _filled_since_eviction, _bytes_since_eviction
+    with _lock:
+        _filled_since_eviction += 1
+        _bytes_since_eviction += size
+        if (_filled_since_eviction < FILE_CACHE_EVICT_EVERY
+                and _bytes_since_eviction < FILE_CACHE_MAX_BYTES // 10):
+            return
+        _filled_since_eviction = 0
+        _bytes_since_eviction = 0
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-cache")
+    _executor.submit(evict_files)
+
+def _walk_files(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != LOCK_DIRECTORY_NAME:
+                    yield from _walk_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+def evict_files():
+    """
+    Delete the least recently used copies until the cache fits in
+    FILE_CACHE_MAX_BYTES. One process evicts at a time. Copies used within
+    the last two touch intervals are kept, since nginx may be about to send
+    them after an X-Accel-Redirect.
+    """
+    if FILE_CACHE_DIRECTORY is None or not os.path.isdir(FILE_CACHE_DIRECTORY):
+        return 0
+
+    os.makedirs(os.path.join(FILE_CACHE_DIRECTORY, LOCK_DIRECTORY_NAME), exist_ok=True)
+    with open(os.path.join(FILE_CACHE_DIRECTORY, LOCK_DIRECTORY_NAME, "evict"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+
+        now = time.time()
+        files = []
+        total_bytes = 0
+        for entry in _walk_files(FILE_CACHE_DIRECTORY):
+            stat = entry.stat(follow_symlinks=False)
+            if entry.name.endswith(".tmp"):
+                if now - stat.st_mtime > STALE_TMP_SECONDS:
+                    _remove(entry.path)
+                continue
+            files.append((stat.st_atime, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+
+        removed = 0
+        files.sort()
+        for atime, size, path in files:
+            if total_bytes <= FILE_CACHE_MAX_BYTES or now - atime < 2 * FILE_CACHE_TOUCH_INTERVAL:
+                break
+            _remove(path)
+            total_bytes -= size
+            removed += 1
+
+    observe_file_cache_size(total_bytes)
+    return removed
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def observe_lookup(result, bytes_saved=0):
+    """
+    Count a lookup and the bytes it kept off the upload volume
+    """
+    key = {"hit": "hits", "miss": "misses", "stale": "stale", "bypass": "bypassed"}[result]
+    with _lock:
+        _stats[key] += 1
+        _stats["bytes_saved"] += bytes_saved
+    observe_file_cache(result, bytes_saved)
+
+def get_file_cache_stats():
+    """
+    Return hit/miss counters of the local file cache for this process
+    """
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"] + stats["stale"] + stats["bypassed"]
+    stats["pid"] = os.getpid()
+    stats["enabled"] = FILE_CACHE_DIRECTORY is not None
+    stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+    stats["max_bytes"] = FILE_CACHE_MAX_BYTES
+    return stats
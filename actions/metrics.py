@@ -0,0 +1,142 @@
+import os
+import time
+
+from flask import g, has_request_context, request, Response
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST,
+                               generate_latest, multiprocess)
+
+# With gunicorn every worker writes its samples to files in this directory
+# and /metrics aggregates them. It must be set (and emptied) before the
+# workers start, see the README.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time spent handling a request",
+    ["method", "endpoint", "status"], buckets=LATENCY_BUCKETS)
+DB_CONNECT_SECONDS = Histogram(
+    "db_connect_duration_seconds", "Time spent getting a database connection, pool wait included",
+    ["database"], buckets=DB_BUCKETS)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Time spent running a database query or command",
+    ["database", "operation"], buckets=DB_BUCKETS)
+DB_CALLS_PER_REQUEST = Histogram(
+    "db_calls_per_request", "Database round trips made while handling one request",
+    ["database", "endpoint"], buckets=COUNT_BUCKETS)
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes of uploaded files stored")
+UPLOAD_SAVE_SECONDS = Histogram(
+    "upload_save_duration_seconds", "Time spent storing an uploaded file",
+    ["storage_mode"], buckets=LATENCY_BUCKETS)
+SERVED_BYTES = Counter("served_bytes_total", "Bytes of uploaded files and thumbnails sent", ["mode"])
+FILE_CACHE_LOOKUPS = Counter(
+    "file_cache_lookups_total", "Uploads looked up in the local file cache", ["result"])
+FILE_CACHE_BYTES_SAVED = Counter(
+    "file_cache_bytes_saved_total", "Bytes served from the local file cache instead of the upload volume")
+LISTING_CACHE_LOOKUPS = Counter(
+    "listing_cache_lookups_total", "Listing cache lookups, by where they were answered from", ["result"])
+LISTING_CACHE_INVALIDATIONS = Counter("listing_cache_invalidations_total", "Listing cache invalidations")
+LISTING_CACHE_ERRORS = Counter("listing_cache_errors_total", "Failed requests to the shared listing cache")
+FILE_CACHE_BYTES = Gauge("file_cache_bytes", "Size of the local file cache at the last eviction pass",
+                         multiprocess_mode="mostrecent")
+STARTUP_SECONDS = Gauge("app_startup_seconds", "Time from the first import of main to a ready app",
+                        multiprocess_mode="max")
+
+
+# The driver hooks (a psycopg2 cursor class and a pymongo command listener)
+# live with the connection code, so this module doesn't import the drivers.
+
+def count_db_call(database):
+    if has_request_context():
+        calls = g.setdefault("db_calls", {})
+        calls[database] = calls.get(database, 0) + 1
+
+
+def observe_query(database, operation, seconds):
+    DB_QUERY_SECONDS.labels(database, operation).observe(seconds)
+
+
+def observe_db_connect(database, seconds):
+    DB_CONNECT_SECONDS.labels(database).observe(seconds)
+
+
+def observe_upload(size, seconds, storage_mode):
+    UPLOAD_BYTES.inc(size)
+    UPLOAD_SAVE_SECONDS.labels(storage_mode).observe(seconds)
+
+
+def observe_served_file(response, mode):
+    """
+    Count the bytes of a file response; with X-Accel-Redirect nginx sends
+    the file, so only what is known up front is counted
+    """
+    if response.status_code in (200, 206) and response.content_length:
+        SERVED_BYTES.labels(mode).inc(response.content_length)
+    return response
+
+
+def observe_file_cache(result, bytes_saved=0):
+    FILE_CACHE_LOOKUPS.labels(result).inc()
+    if bytes_saved:
+        FILE_CACHE_BYTES_SAVED.inc(bytes_saved)
+
+
+def observe_listing_cache(event):
+    """
+    Count a listing cache event: a "hit", "shared_hit" or "miss" lookup,
+    an "invalidation" or a Redis "error"
+    """
+    if event == "invalidation":
+        LISTING_CACHE_INVALIDATIONS.inc()
+    elif event == "error":
+        LISTING_CACHE_ERRORS.inc()
+    else:
+        LISTING_CACHE_LOOKUPS.labels(event).inc()
+
+
+def observe_file_cache_size(size):
+    FILE_CACHE_BYTES.set(size)
+
+
+def observe_startup(seconds):
+    STARTUP_SECONDS.set(seconds)
+
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def observe_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_SECONDS.labels(request.method, endpoint, str(response.status_code)).observe(
+        time.perf_counter() - started)
+    calls = g.pop("db_calls", {})
+    for database in ("postgresql", "mongodb"):
+        DB_CALLS_PER_REQUEST.labels(database, endpoint).observe(calls.get(database, 0))
+    return response
+
+
+def render_metrics():
+    """
+    Prometheus text exposition of the metrics of every worker
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def mark_worker_dead(pid):
+    """
+    Drop the live samples of a worker that exited, for gunicorn's child_exit hook
+    """
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,29 @@
+from flask import jsonify, request, url_for, current_app
+from jobs.reconcile import MODES, start_run, load_run
+
+def handle_reconcile():
+    """
+    Start a reconcile run in the background; mode is report (the default),
+    quarantine or delete
+    """
+    payload = request.get_json(silent=True) or request.form
+    mode = payload.get("mode", "report")
+    if mode not in MODES:
+        return jsonify({"message": f"mode must be one of {', '.join(MODES)}", "success": False}), 400
+
+    run = start_run(current_app.config['UPLOAD_FOLDER'], mode=mode)
+    return jsonify({
+        "run_id": run["run_id"],
+        "mode": mode,
+        "status_url": url_for('reconcile_status', run_id=run["run_id"]),
+        "success": True,
+    }), 202
+
+def get_reconcile_run(run_id):
+    """
+    Progress and findings of a reconcile or purge run
+    """
+    run = load_run(current_app.config['UPLOAD_FOLDER'], run_id)
+    if run is None:
+        return jsonify({"message": "Run not found", "success": False}), 404
+    return jsonify(run)
@@ -0,0 +1,161 @@
+import os
+import time
+import shutil
+import hashlib
+import mimetypes
+import tempfile
+import threading
+from actions.metrics import observe_upload
+from actions.file_cache import invalidate_cached_file
+
+# "filename" keeps the historical layout (UPLOAD_FOLDER/<secure filename>),
+# "content" stores each file once under UPLOAD_FOLDER/ab/cd/<sha256><ext>
+UPLOAD_STORAGE_MODE = os.getenv("UPLOAD_STORAGE_MODE", "filename")
+
+# Content-addressed uploads are spooled here (ideally local disk) while they
+# are hashed, so duplicates never cause a write to the upload volume
+UPLOAD_SPOOL_DIRECTORY = os.getenv("UPLOAD_SPOOL_DIRECTORY") or None
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+def content_addressed_path(content_hash, filename):
+    """
+    Relative path of a file stored by content, fanned out over two levels
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return os.path.join(content_hash[:2], content_hash[2:4], content_hash + extension)
+
+def is_content_addressed(file_path):
+    """
+    Whether a stored file_path was produced by content_addressed_path
+    """
+    parts = file_path.split("/")
+    if len(parts) != 3:
+        return False
+    content_hash = os.path.splitext(parts[2])[0]
+    return (len(content_hash) == 64 and parts[0] == content_hash[:2]
+            and parts[1] == content_hash[2:4])
+
+def _tmp_path(target):
+    # Unique per thread as well, bulk imports store several files at once
+    return f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def _copy_and_hash(stream, destination):
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        buffer = stream.read(COPY_BUFFER_SIZE)
+        if not buffer:
+            break
+        digest.update(buffer)
+        destination.write(buffer)
+        size += len(buffer)
+    return digest.hexdigest(), size
+
+def _sync(f):
+    # The upload is reported as stored once this returns, so make it durable
+    f.flush()
+    os.fsync(f.fileno())
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buffer in iter(lambda: f.read(COPY_BUFFER_SIZE), b""):
+            digest.update(buffer)
+    return digest.hexdigest()
+
+def _publish(source_path, upload_folder, file_path, move):
+    """
+    Atomically place source_path at upload_folder/file_path.
+    Returns False if a file with that content was already stored.
+    """
+    target = os.path.join(upload_folder, file_path)
+    try:
+        # The file is about to be referenced again: a fresh mtime keeps the
+        # reconciler's grace period from treating it as an old orphan
+        os.utime(target)
+        return False
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if move:
+        os.replace(source_path, target)
+    else:
+        tmp_target = _tmp_path(target)
+        shutil.copyfile(source_path, tmp_target)
+        with open(tmp_target, "rb+") as f:
+            _sync(f)
+        os.replace(tmp_target, target)
+    return True
+
+def _stored_file(file_path, content_hash, filename, size):
+    # Recorded in MongoDB and denormalized into the product row
+    return {
+        "file_path": file_path,
+        "content_hash": content_hash,
+        "original_filename": filename,
+        "size": size,
+        "mime_type": mimetypes.guess_type(filename)[0] or "application/octet-stream",
+    }
+
+def store_upload_stream(stream, filename, upload_folder):
+    """
+    Store an uploaded file from a readable stream, hashing it as it is copied.
+    Returns the metadata recorded next to the file in MongoDB.
+    """
+    started = time.perf_counter()
+    if UPLOAD_STORAGE_MODE != "content":
+        # Write next to the final name and rename, so readers never see a partial file
+        target = os.path.join(upload_folder, filename)
+        tmp_target = _tmp_path(target)
+        try:
+            with open(tmp_target, "wb") as f:
+                content_hash, size = _copy_and_hash(stream, f)
+                _sync(f)
+            os.replace(tmp_target, target)
+        except BaseException:
+            # e.g. the upload was rejected part way through
+            if os.path.exists(tmp_target):
+                os.remove(tmp_target)
+            raise
+        # The upload may have replaced an older file with this name
+        invalidate_cached_file(filename)
+        observe_upload(size, time.perf_counter() - started, UPLOAD_STORAGE_MODE)
+        return _stored_file(filename, content_hash, filename, size)
+
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIRECTORY, delete=False) as spool:
+        try:
+            content_hash, size = _copy_and_hash(stream, spool)
+        except BaseException:
+            os.remove(spool.name)
+            raise
+    try:
+        file_path = content_addressed_path(content_hash, filename)
+        _publish(spool.name, upload_folder, file_path, move=False)
+    finally:
+        os.remove(spool.name)
+
+    observe_upload(size, time.perf_counter() - started, UPLOAD_STORAGE_MODE)
+    return _stored_file(file_path, content_hash, filename, size)
+
+def store_upload_file(source_path, filename, upload_folder):
+    """
+    Store a file that is already complete on the upload volume (e.g. the
+    part file of a resumable upload), moving it into place
+    """
+    started = time.perf_counter()
+    size = os.path.getsize(source_path)
+    content_hash = _hash_file(source_path)
+
+    if UPLOAD_STORAGE_MODE != "content":
+        os.replace(source_path, os.path.join(upload_folder, filename))
+        invalidate_cached_file(filename)
+        file_path = filename
+    else:
+        file_path = content_addressed_path(content_hash, filename)
+        if not _publish(source_path, upload_folder, file_path, move=True):
+            os.remove(source_path)
+
+    observe_upload(size, time.perf_counter() - started, UPLOAD_STORAGE_MODE)
+    return _stored_file(file_path, content_hash, filename, size)
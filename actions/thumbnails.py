@@ -0,0 +1,232 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import url_for, redirect, request
+from actions.utils import send_upload
+from actions.storage import is_content_addressed
+from jobs.queue import enqueue
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails fall back to the original image
+    Image = None
+
+# Derivatives live on the upload volume next to the originals, so every
+# instance behind the ALB shares them
+THUMBNAIL_DIRECTORY_NAME = ".thumbnails"
+THUMBNAIL_WIDTHS = [int(width) for width in os.getenv("THUMBNAIL_WIDTHS", "320,640").split(",")]
+THUMBNAIL_WEBP = os.getenv("THUMBNAIL_WEBP", "true").lower() == "true"
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+THUMBNAIL_TOUCH_INTERVAL = int(os.getenv("THUMBNAIL_TOUCH_INTERVAL", "3600"))
+# Run an eviction pass after this many thumbnails have been generated
+THUMBNAIL_EVICT_EVERY = int(os.getenv("THUMBNAIL_EVICT_EVERY", "50"))
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+# Output format used when WebP is not requested
+FALLBACK_FORMATS = {'jpg': 'jpeg', 'jpeg': 'jpeg', 'png': 'png', 'gif': 'png'}
+
+_executor = None
+_executor_lock = threading.Lock()
+_generated_since_eviction = 0
+
+def is_image(file_path):
+    return file_path.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS
+
+def _output_format(file_path, webp):
+    if webp:
+        return 'webp'
+    return FALLBACK_FORMATS[file_path.rsplit('.', 1)[-1].lower()]
+
+def thumbnail_path(file_path, width, output_format):
+    """
+    Path of a derivative relative to the upload folder
+    """
+    return os.path.join(THUMBNAIL_DIRECTORY_NAME, str(width), f"{file_path}.{output_format}")
+
+def thumbnail_urls(file_path, url_for=url_for):
+    """
+    URLs and srcset attributes pointing at the thumbnails of an upload,
+    or an empty dict when the upload is not an image.
+    url_for is the URL builder of the app rendering the page.
+    """
+    if Image is None or not is_image(file_path):
+        return {}
+
+    def srcset(webp):
+        return ", ".join(
+            f"{url_for('get_thumbnail', width=width, name=file_path, webp=1 if webp else None)} {width}w"
+            for width in THUMBNAIL_WIDTHS
+        )
+
+    urls = {
+        "thumbnail_url": url_for('get_thumbnail', width=THUMBNAIL_WIDTHS[0], name=file_path),
+        "thumbnail_srcset": srcset(False),
+    }
+    if THUMBNAIL_WEBP:
+        urls["thumbnail_webp_srcset"] = srcset(True)
+    return urls
+
+def generate_thumbnail(upload_folder, file_path, width, webp=False):
+    """
+    Create one derivative of an upload if it does not exist yet.
+    Returns its path relative to the upload folder, or None if the
+    upload can't be thumbnailed.
+    """
+    global _generated_since_eviction
+
+    if Image is None or not is_image(file_path):
+        return None
+
+    output_format = _output_format(file_path, webp)
+    relative_path = thumbnail_path(file_path, width, output_format)
+    target = os.path.join(upload_folder, relative_path)
+    if os.path.exists(target):
+        return relative_path
+
+    source = os.path.join(upload_folder, file_path)
+    try:
+        with Image.open(source) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((width, width * 4))
+            if output_format == 'jpeg' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            elif output_format in ('png', 'webp') and img.mode == 'P':
+                img = img.convert('RGBA')
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Concurrent generators on other workers race harmlessly on the rename
+            tmp_target = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                img.save(tmp_target, format=output_format.upper(), quality=THUMBNAIL_QUALITY)
+                os.replace(tmp_target, target)
+            except BaseException:
+                # e.g. a truncated source or a full disk
+                if os.path.exists(tmp_target):
+                    os.remove(tmp_target)
+                raise
+    except (OSError, ValueError, KeyError):
+        return None
+
+    _generated_since_eviction += 1
+    if _generated_since_eviction >= THUMBNAIL_EVICT_EVERY:
+        _generated_since_eviction = 0
+        _get_executor().submit(evict_thumbnails, upload_folder)
+    return relative_path
+
+def generate_derivatives(upload_folder, file_path):
+    """
+    Create every configured derivative of an upload
+    """
+    for width in THUMBNAIL_WIDTHS:
+        generate_thumbnail(upload_folder, file_path, width)
+        if THUMBNAIL_WEBP:
+            generate_thumbnail(upload_folder, file_path, width, webp=True)
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS,
+                                           thread_name_prefix="thumbnails")
+    return _executor
+
+def invalidate_derivatives(upload_folder, file_path):
+    """
+    Remove the derivatives of an upload whose file was replaced
+    """
+    for width in THUMBNAIL_WIDTHS:
+        for output_format in {'webp', _output_format(file_path, False)}:
+            try:
+                os.remove(os.path.join(upload_folder, thumbnail_path(file_path, width, output_format)))
+            except FileNotFoundError:
+                pass
+
+def schedule_derivatives(upload_folder, stored_file):
+    """
+    Queue the derivatives of a new upload (as returned by actions.storage)
+    for the background workers
+    """
+    file_path = stored_file["file_path"]
+    if Image is None or not is_image(file_path):
+        return None
+    if not is_content_addressed(file_path):
+        # Uploads stored by name may have replaced an older file
+        invalidate_derivatives(upload_folder, file_path)
+    return enqueue("generate_derivatives", {"file_path": file_path},
+                   idempotency_key=f"generate_derivatives:{file_path}:{stored_file['content_hash']}")
+
+def _walk_files(directory):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+def evict_thumbnails(upload_folder):
+    """
+    Delete the least recently used derivatives until the cache fits in
+    THUMBNAIL_CACHE_MAX_BYTES. Serving a thumbnail bumps its mtime, since
+    EFS mounts usually don't track atime.
+    """
+    directory = os.path.join(upload_folder, THUMBNAIL_DIRECTORY_NAME)
+    if not os.path.isdir(directory):
+        return 0
+
+    files = []
+    total_bytes = 0
+    for entry in _walk_files(directory):
+        stat = entry.stat(follow_symlinks=False)
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes += stat.st_size
+
+    removed = 0
+    files.sort()
+    for mtime, size, path in files:
+        if total_bytes <= THUMBNAIL_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        removed += 1
+    return removed
+
+def serve_thumbnail(upload_folder, width, name):
+    """
+    Serve a thumbnail, generating it on first request.
+    Falls back to the original when it can't be thumbnailed.
+    """
+    if width not in THUMBNAIL_WIDTHS or any(part.startswith('.') for part in name.split('/')):
+        return "Thumbnail not found", 404
+
+    webp = THUMBNAIL_WEBP and request.args.get('webp') == '1'
+    relative_path = prepare_thumbnail(upload_folder, name, width, webp)
+    if relative_path is None:
+        return redirect(url_for('download_file', name=name))
+
+    return send_upload(upload_folder, relative_path, policy_path=name)
+
+def prepare_thumbnail(upload_folder, file_path, width, webp=False):
+    """
+    Generate a thumbnail if needed and mark it as used.
+    Returns its path relative to the upload folder, or None.
+    """
+    relative_path = generate_thumbnail(upload_folder, file_path, width, webp)
+    if relative_path is not None:
+        _touch(os.path.join(upload_folder, relative_path))
+    return relative_path
+
+def _touch(path):
+    # Mark as recently used for eviction, at most once per interval to
+    # keep metadata writes on EFS down
+    try:
+        if time.time() - os.stat(path).st_mtime > THUMBNAIL_TOUCH_INTERVAL:
+            os.utime(path)
+    except FileNotFoundError:
+        pass
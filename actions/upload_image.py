@@ -1,18 +1,26 @@
 import os
 from datetime import datetime
-import psycopg2
 from flask import url_for, flash, redirect, request, render_template
 from werkzeug.utils import secure_filename
 from db.mongodb.mongodb_connection import create_mongodb_connection
-
-def allowed_file(filename, allowed_extensions):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+from db.postgresql.postgresql_connection import postgresql_connection
+from actions.storage import store_upload_stream
+from actions.validation import UPLOAD_FORM_MAX_BYTES, UploadRejected, allowed_file, validated_stream
+from actions.thumbnails import schedule_derivatives
+from actions.cache import invalidate_listings
+from jobs.queue import enqueue
 
 def handle_upload_file(request, app):
     """
     Handle file upload logic
     """
+    # Refuse a body no accepted file fits in before Werkzeug reads any of it
+    if request.content_length is not None and request.content_length > UPLOAD_FORM_MAX_BYTES:
+        if os.getenv("ENV_MODE") == "backend":
+            return {"message": "File is too large", "success": False}, 413
+        flash('File is too large')
+        return redirect(request.url)
+
     if 'file' not in request.files:
         flash('No file part')
         return redirect(request.url)
@@ -25,75 +33,100 @@ def handle_upload_file(request, app):
         flash('No selected file')
         return redirect(request.url)
     
-    allowed_extensions = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
-    if file and allowed_file(file.filename, allowed_extensions):
-        # Upload the file
+    if file and allowed_file(file.filename):
+        # Upload the file, hashing it while it is written. The type, dimensions
+        # and size are checked from the first chunk, before anything is stored.
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-
-        # save image_metadata to MongoDB
-        client, database, collection = create_mongodb_connection("file-uploads")
+        try:
+            stored_file = store_upload_stream(validated_stream(file.stream, filename),
+                                              filename, app.config['UPLOAD_FOLDER'])
+        except UploadRejected as e:
+            if os.getenv("ENV_MODE") == "backend":
+                return {"message": e.message, "success": False}, e.status
+            flash(e.message)
+            return redirect(request.url)
 
         product_name = request.form.get('product_name')
         stock_count = int(request.form.get('initial_stock_count'))
 
-        # Insert MongoDB record with product details
-        result = collection.insert_one({
-            "file_path": filename,
-            "product_name": product_name,
-            "upload_date": datetime.now()
-        })
-
-        mongodb_id = str(result.inserted_id)
-        client.close()
-
-        # save product_data to PostgreSQL
-        conn = psycopg2.connect(
-            host=os.environ["POSTGRESQL_DB_HOST"],
-            database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
-            user=os.environ['POSTGRESQL_DB_USERNAME'],
-            password=os.environ['POSTGRESQL_DB_PASSWORD']
-        )
+        create_product(stored_file, product_name, stock_count)
+        schedule_derivatives(app.config['UPLOAD_FOLDER'], stored_file)
+
+        img_url = url_for('download_file', name=stored_file['file_path'])
+
+        env_mode = os.getenv("ENV_MODE")
+        if env_mode == "backend":
+            return {
+                "filename": stored_file['file_path'],
+                "img_url": img_url
+            }
+        else:
+            return redirect(url_for('show_uploaded_images'))
+    
+    return None
+
+def create_product(stored_file, product_name, stock_count):
+    """
+    Record a stored file (as returned by actions.storage) in MongoDB and
+    create its product in PostgreSQL.
+    Returns (product_id, mongodb_id).
+    """
+    # save image_metadata to MongoDB
+    client, database, collection = create_mongodb_connection("file-uploads")
+
+    # Insert MongoDB record with product details
+    result = collection.insert_one({
+        "file_path": stored_file["file_path"],
+        "content_hash": stored_file["content_hash"],
+        "original_filename": stored_file["original_filename"],
+        "size": stored_file["size"],
+        "mime_type": stored_file.get("mime_type"),
+        "product_name": product_name,
+        "upload_date": datetime.now()
+    })
+
+    mongodb_id = str(result.inserted_id)
+    client.close()
+
+    # save product_data to PostgreSQL
+    with postgresql_connection() as conn:
         cur = conn.cursor()
 
         review = "Sample Review"
 
-        cur.execute('INSERT INTO products (name, image_mongodb_id, stock_count, review)'
-                    'VALUES (%s, %s, %s, %s) RETURNING id',
+        # The file columns let listings skip MongoDB entirely
+        cur.execute('INSERT INTO products (name, image_mongodb_id, stock_count, review,'
+                    ' image_file_path, image_content_hash, image_size, image_mime_type)'
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id',
                     (product_name,
                     mongodb_id,
                     stock_count,
-                    review)
+                    review,
+                    stored_file["file_path"],
+                    stored_file["content_hash"],
+                    stored_file["size"],
+                    stored_file.get("mime_type"))
         )
         
         # Get the newly created product ID
         product_id = cur.fetchone()[0]
-        
-        # Update MongoDB record with the product ID
-        client, database, collection = create_mongodb_connection("file-uploads")
-        collection.update_one(
-            {"_id": result.inserted_id},
-            {"$set": {"product_id": product_id}}
-        )
-        client.close()
 
         conn.commit()
         cur.close()
-        conn.close()
 
-        img_url = url_for('download_file', name=filename)
+    invalidate_listings()
 
-        env_mode = os.getenv("ENV_MODE")
-        if env_mode == "backend":
-            return {
-                "filename": filename,
-                "img_url": img_url
-            }
-        else:
-            return redirect(url_for('show_uploaded_images'))
-    
-    return None
+    # Point the MongoDB record at the product and double-check the stored
+    # bytes in the background, the upload is already durable at this point
+    enqueue("backfill_product_id",
+            {"mongodb_id": mongodb_id, "product_id": product_id},
+            idempotency_key=f"backfill_product_id:{mongodb_id}")
+    enqueue("verify_checksum",
+            {"mongodb_id": mongodb_id, "file_path": stored_file["file_path"],
+             "content_hash": stored_file["content_hash"]},
+            idempotency_key=f"verify_checksum:{mongodb_id}")
+
+    return product_id, mongodb_id
 
 def render_upload_page():
     """
@@ -1,56 +1,253 @@
 import os
-from bson import ObjectId
-from flask import send_file, send_from_directory, jsonify
-from db.mongodb.mongodb_connection import create_mongodb_connection
+import mimetypes
+from urllib.parse import quote
+from flask import send_from_directory, jsonify, current_app, url_for, request, stream_with_context
+from actions.storage import is_content_addressed
+from actions.metrics import observe_served_file
+from actions.file_cache import FILE_CACHE_DIRECTORY, FILE_CACHE_ACCEL_PREFIX, local_copy, observe_lookup
 
-def allowed_file(filename, allowed_extensions=None):
+# "direct" streams uploads through the worker with send_file, "accel" lets
+# nginx serve them from an internal location via X-Accel-Redirect
+FILE_SERVING_MODE = os.getenv("FILE_SERVING_MODE", "direct")
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "/protected-uploads/")
+
+# Cache lifetime of uploads served by name, which can be overwritten
+UPLOAD_CACHE_MAX_AGE = int(os.getenv("UPLOAD_CACHE_MAX_AGE", "300"))
+# Cache lifetime of content-addressed uploads
+IMMUTABLE_MAX_AGE = 31536000
+
+# Render the gallery and order pages as they are read from the databases,
+# see stream_requested. ?stream=1 or ?stream=0 overrides it per request.
+STREAM_RENDERING = os.getenv("STREAM_RENDERING", "false").lower() == "true"
+# Streamed output is sent in pieces of about this size rather than per card
+STREAM_BUFFER_BYTES = int(os.getenv("STREAM_BUFFER_BYTES", "16384"))
+
+# Fields of a file-uploads document needed to join it with a product
+IMAGE_PROJECTION = {"file_path": 1, "product_id": 1}
+
+def build_image_indexes(images):
     """
-    Check if a file has an allowed extension
+    Index MongoDB image documents by product_id and by _id.
+    Keeps the first document per product_id, like the linear scan it replaces.
     """
-    if allowed_extensions is None:
-        allowed_extensions = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
-    
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+    images_by_product_id = {}
+    images_by_id = {}
+    for img in images:
+        if 'product_id' in img:
+            images_by_product_id.setdefault(str(img['product_id']), img)
+        if '_id' in img:
+            images_by_id[str(img['_id'])] = img
+    return images_by_product_id, images_by_id
+
+def find_product_image(product_id, image_mongodb_id, images_by_product_id, images_by_id):
+    """
+    Find the image of a product by product_id, falling back to image_mongodb_id
+    """
+    matching_image = images_by_product_id.get(str(product_id))
+    if not matching_image and image_mongodb_id:
+        matching_image = images_by_id.get(image_mongodb_id)
+    return matching_image
+
+def fetch_product_images(collection, products):
+    """
+    Fetch only the image documents belonging to the given product rows,
+    matched by product_id or by the product's image_mongodb_id
+    """
+    if not products:
+        return []
+    return list(collection.find(product_images_query(products), IMAGE_PROJECTION))
+
+def product_images_query(products):
+    """
+    MongoDB query matching the image documents of the given product rows
+    """
+    from bson import ObjectId
+
+    product_ids = [product[0] for product in products]
+    image_ids = [ObjectId(product[3]) for product in products
+                 if product[3] and ObjectId.is_valid(product[3])]
+
+    # product_id is normally stored as an int, but match its string form too
+    return {"$or": [
+        {"product_id": {"$in": product_ids + [str(product_id) for product_id in product_ids]}},
+        {"_id": {"$in": image_ids}}
+    ]}
 
 def add_cache_headers(response):
     """
-    Add cache control headers to a response
+    Add cache control headers to a response.
+    Responses that already set their own policy (uploaded files) are left alone.
     """
+    if 'Cache-Control' in response.headers:
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '-1'
     return response
 
+def stream_requested():
+    """
+    Whether this request should get a streamed page
+    """
+    stream = request.args.get('stream')
+    if stream is None:
+        return STREAM_RENDERING
+    return stream.lower() in ("1", "true", "yes")
+
+def stream_json_array(items):
+    """
+    Encode an iterable as a JSON array one element at a time
+    """
+    dumps = current_app.json.dumps
+    yield "["
+    for index, item in enumerate(items):
+        yield ("," if index else "") + dumps(item)
+    yield "]"
+
+def buffer_stream(pieces, size=STREAM_BUFFER_BYTES):
+    """
+    Join the small pieces a template or encoder yields into writes of
+    about size characters
+    """
+    buffered = []
+    length = 0
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield "".join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield "".join(buffered)
+
+def streamed_response(pieces, mimetype):
+    """
+    Response sending pieces as they are produced, with the request context
+    kept for url_for. nginx would otherwise buffer the whole body before
+    passing it on.
+    """
+    response = current_app.response_class(stream_with_context(buffer_stream(pieces)), mimetype=mimetype)
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def send_upload(upload_folder, file_path, policy_path=None):
+    """
+    Send an uploaded file with its caching policy.
+    send_file answers If-None-Match / If-Modified-Since with 304 and
+    serves Range requests with 206.
+    policy_path is the upload whose caching policy applies, when sending
+    a file derived from it such as a thumbnail.
+    """
+    policy_path = policy_path or file_path
+    immutable = is_content_addressed(file_path)
+
+    if FILE_SERVING_MODE == "accel":
+        if FILE_CACHE_ACCEL_PREFIX:
+            cached_path, result, cached_stat = local_copy(upload_folder, file_path, immutable)
+            if result:
+                observe_lookup(result, cached_stat.st_size if result == "hit" else 0)
+            if cached_path is not None:
+                return accel_redirect(file_path, policy_path, prefix=FILE_CACHE_ACCEL_PREFIX)
+        return accel_redirect(file_path, policy_path)
+
+    cached_path, result, cached_stat = local_copy(upload_folder, file_path, immutable)
+    if immutable:
+        # The name is the SHA-256 of the bytes, so it is a strong ETag by itself
+        etag = os.path.splitext(os.path.basename(file_path))[0]
+    elif cached_stat is not None:
+        # The copy has the source's size and mtime; werkzeug's own ETag would
+        # also hash the directory, and differ between the copy and the source
+        etag = f"{cached_stat.st_mtime_ns:x}-{cached_stat.st_size:x}"
+    else:
+        etag = True
+
+    if cached_path is not None:
+        response = send_from_directory(FILE_CACHE_DIRECTORY, file_path, etag=etag)
+        if result == "hit":
+            observe_lookup(result, (response.content_length or 0) if response.status_code in (200, 206) else 0)
+        else:
+            observe_lookup(result)
+    else:
+        if result:
+            observe_lookup(result)
+        response = send_from_directory(upload_folder, file_path, etag=etag)
+    observe_served_file(response, FILE_SERVING_MODE)
+    return set_upload_cache_policy(response, policy_path)
+
+def set_upload_cache_policy(response, file_path):
+    """
+    Set Cache-Control for an uploaded file
+    """
+    # send_file defaults to no-cache when it is not given a max_age
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    if is_content_addressed(file_path):
+        # Content-addressed files can never change
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        # A later upload with the same name replaces the file, so browsers
+        # revalidate with the ETag once max-age has passed
+        response.cache_control.max_age = UPLOAD_CACHE_MAX_AGE
+    return response
+
+def accel_redirect(file_path, policy_path=None, prefix=X_ACCEL_REDIRECT_PREFIX):
+    """
+    Hand the file over to nginx with X-Accel-Redirect so the worker is freed
+    immediately. nginx does the sendfile, ETag/Last-Modified and Range handling,
+    and keeps the Content-Type and Cache-Control set here.
+    prefix is the internal location serving the upload folder, or the local
+    file cache.
+    """
+    response = current_app.response_class(status=200)
+    response.headers['X-Accel-Redirect'] = prefix + quote(file_path)
+    response.mimetype = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    return set_upload_cache_policy(response, policy_path or file_path)
+
 def serve_file(app_config, name):
     """
-    Serve a file from the upload folder
+    Serve a file from the upload folder.
+    name is a file_path as stored in MongoDB, which may include the
+    fan-out directories of content-addressed storage.
     """
-    return send_from_directory(app_config["UPLOAD_FOLDER"], name)
+    # Never serve internal state such as .upload-sessions
+    if any(part.startswith('.') for part in name.split('/')):
+        return "File not found", 404
+    return send_upload(app_config["UPLOAD_FOLDER"], name)
 
 def get_image_by_id(image_id):
     """
     Get an image by its MongoDB ID
     """
+    from bson import ObjectId
+    from db.mongodb.mongodb_connection import create_mongodb_connection
+
+    if not ObjectId.is_valid(image_id):
+        return "Image not found", 404
+
     client, database, collection = create_mongodb_connection("file-uploads")
-    image_doc = collection.find_one({"_id": ObjectId(image_id)})
+    image_doc = collection.find_one({"_id": ObjectId(image_id)}, {"file_path": 1})
     client.close()
     
     if image_doc and "file_path" in image_doc:
-        file_path = os.path.join(os.environ["UPLOAD_DIRECTORY"], image_doc["file_path"])
-        return send_file(file_path)
+        return send_upload(os.environ["UPLOAD_DIRECTORY"], image_doc["file_path"])
     else:
         return "Image not found", 404
 
 def clear_mongodb_collection():
     """
-    Clear all documents from the MongoDB collection
+    Clear all documents from the MongoDB collection, in batches in the background
     """
+    from jobs.reconcile import start_run
+
     try:
-        client, database, collection = create_mongodb_connection("file-uploads")
-        result = collection.delete_many({})
-        deleted_count = result.deleted_count
-        client.close()
-        return jsonify({"message": f"Deleted {deleted_count} documents from MongoDB", "success": True})
+        run = start_run(current_app.config['UPLOAD_FOLDER'], kind="purge_mongodb", mode="delete")
+        return jsonify({
+            "message": "Deleting MongoDB documents in the background",
+            "success": True,
+            "run_id": run["run_id"],
+            "status_url": url_for('reconcile_status', run_id=run["run_id"]),
+        }), 202
     except Exception as e:
         return jsonify({"message": f"Error: {str(e)}", "success": False})
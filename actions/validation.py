@@ -0,0 +1,182 @@
+import os
+import struct
+
+ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
+
+# Extension -> the type its content has to sniff as
+UPLOAD_TYPES = {'png': 'png', 'jpg': 'jpeg', 'jpeg': 'jpeg', 'gif': 'gif', 'pdf': 'pdf', 'txt': 'txt'}
+
+# Hard cap for any upload, the per-type limits below can only be lower
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(512 * 1024 * 1024)))
+UPLOAD_TYPE_MAX_BYTES = {
+    "png": int(os.getenv("UPLOAD_MAX_BYTES_PNG", str(50 * 1024 * 1024))),
+    "jpeg": int(os.getenv("UPLOAD_MAX_BYTES_JPEG", str(50 * 1024 * 1024))),
+    "gif": int(os.getenv("UPLOAD_MAX_BYTES_GIF", str(20 * 1024 * 1024))),
+    "pdf": int(os.getenv("UPLOAD_MAX_BYTES_PDF", str(100 * 1024 * 1024))),
+    "txt": int(os.getenv("UPLOAD_MAX_BYTES_TXT", str(10 * 1024 * 1024))),
+}
+# A form upload carries one file plus a few fields
+UPLOAD_FORM_MAX_BYTES = min(UPLOAD_MAX_BYTES, max(UPLOAD_TYPE_MAX_BYTES.values())) + 1024 * 1024
+# Width * height; a small file can still decode to a huge bitmap in the thumbnailer
+UPLOAD_MAX_IMAGE_PIXELS = int(os.getenv("UPLOAD_MAX_IMAGE_PIXELS", str(50_000_000)))
+
+# The type and dimensions are read from this much of the start of the file.
+# JPEG dimensions come after the EXIF block, which fits in 64 KiB.
+SNIFF_BYTES = 64 * 1024
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Start-of-frame markers, the ones carrying the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+class UploadRejected(Exception):
+    def __init__(self, message, status=415):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def allowed_file(filename, allowed_extensions=ALLOWED_EXTENSIONS):
+    """
+    Check if a file has an allowed extension
+    """
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+
+def upload_type(filename):
+    if not allowed_file(filename):
+        return None
+    return UPLOAD_TYPES.get(filename.rsplit('.', 1)[1].lower())
+
+def size_limit(filename):
+    """
+    Largest accepted size in bytes for a file with this name
+    """
+    return min(UPLOAD_MAX_BYTES, UPLOAD_TYPE_MAX_BYTES.get(upload_type(filename), UPLOAD_MAX_BYTES))
+
+def check_size(filename, size):
+    """
+    Reject a declared size before any of the file is read
+    """
+    if upload_type(filename) is None:
+        raise UploadRejected("File type not allowed")
+    if size is not None and size > size_limit(filename):
+        raise UploadRejected("File is too large", 413)
+
+def _jpeg_dimensions(head):
+    # Walk the marker segments up to the first start-of-frame
+    i = 2
+    while i + 4 <= len(head):
+        if head[i] != 0xFF:
+            return None
+        marker = head[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(head):
+                return None
+            height, width = struct.unpack(">HH", head[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+    return None
+
+def _is_text(head):
+    if b"\x00" in head:
+        return False
+    # The head may end in the middle of a multi-byte character
+    for cut in range(4):
+        try:
+            head[:len(head) - cut].decode("utf-8")
+            return True
+        except UnicodeDecodeError:
+            continue
+    return False
+
+def sniff(head):
+    """
+    Identify a file from its first bytes.
+    Returns (type, (width, height) or None); type is None if unrecognized.
+    """
+    if head.startswith(PNG_SIGNATURE):
+        if head[12:16] == b"IHDR" and len(head) >= 24:
+            return "png", struct.unpack(">II", head[16:24])
+        return "png", None
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        if len(head) >= 10:
+            return "gif", struct.unpack("<HH", head[6:10])
+        return "gif", None
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg", _jpeg_dimensions(head)
+    if head.startswith(b"%PDF-"):
+        return "pdf", None
+    if _is_text(head):
+        return "txt", None
+    return None, None
+
+def validate_head(head, filename):
+    """
+    Check that the start of a file matches its extension and that an
+    image's dimensions are acceptable
+    """
+    expected = upload_type(filename)
+    if expected is None:
+        raise UploadRejected("File type not allowed")
+
+    detected, dimensions = sniff(head)
+    if detected != expected:
+        raise UploadRejected("File content does not match its type")
+    if dimensions is not None:
+        width, height = dimensions
+        if width == 0 or height == 0:
+            raise UploadRejected("Image has no pixels")
+        if width * height > UPLOAD_MAX_IMAGE_PIXELS:
+            raise UploadRejected("Image dimensions are too large", 413)
+
+class ValidatedStream:
+    """
+    Replays the sniffed head, then reads through to the wrapped stream,
+    rejecting the upload as soon as it goes over its size limit
+    """
+
+    def __init__(self, stream, head, limit):
+        self._stream = stream
+        self._head = head
+        self._limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        if self._head:
+            if size is None or size < 0:
+                buffer, self._head = self._head + self._stream.read(), b""
+            else:
+                buffer, self._head = self._head[:size], self._head[size:]
+        else:
+            buffer = self._stream.read(size)
+
+        self.size += len(buffer)
+        if self.size > self._limit:
+            raise UploadRejected("File is too large", 413)
+        return buffer
+
+def validated_stream(stream, filename, declared_size=None):
+    """
+    Validate an upload from the first chunk of its stream, before anything
+    is written. Returns a stream to store from, which keeps enforcing the
+    size limit while the rest is read.
+    """
+    check_size(filename, declared_size)
+    limit = size_limit(filename)
+
+    head = b""
+    while len(head) < SNIFF_BYTES:
+        buffer = stream.read(SNIFF_BYTES - len(head))
+        if not buffer:
+            break
+        head += buffer
+    if len(head) > limit:
+        raise UploadRejected("File is too large", 413)
+    validate_head(head, filename)
+
+    return ValidatedStream(stream, head, limit)
@@ -1,67 +1,217 @@
 import os
-import psycopg2
-from flask import url_for, render_template, jsonify
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import url_for, render_template, stream_template, jsonify, request, make_response
 from db.mongodb.mongodb_connection import create_mongodb_connection
+from db.postgresql.postgresql_connection import postgresql_connection, iter_server_side
+from actions.utils import (IMAGE_PROJECTION, build_image_indexes, find_product_image, fetch_product_images,
+                           stream_requested, stream_json_array, streamed_response)
+from actions.thumbnails import thumbnail_urls
+from actions.cache import cached
 
-def get_uploaded_images():
-    """
-    Get all uploaded images with product details
-    """
-    # Connect to PostgreSQL to get all product details
-    conn = psycopg2.connect(
-        host=os.environ["POSTGRESQL_DB_HOST"],
-        database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
-        user=os.environ['POSTGRESQL_DB_USERNAME'],
-        password=os.environ['POSTGRESQL_DB_PASSWORD']
-    )
-    cur = conn.cursor()
-    
-    # Get all products with their details
-    cur.execute("""
-        SELECT p.id, p.name, p.stock_count, p.image_mongodb_id 
-        FROM products p
-    """)
-    products = cur.fetchall()
-    
-    # Get all images from MongoDB
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "48"))
+GALLERY_MAX_PAGE_SIZE = int(os.getenv("GALLERY_MAX_PAGE_SIZE", "200"))
+
+GALLERY_STREAM_SQL = """
+    SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path
+    FROM products p
+    ORDER BY p.id
+"""
+
+# Cursors for the second phase of the gallery, after the last product,
+# which walks unassociated images by their MongoDB _id
+UNASSOCIATED_CURSOR_PREFIX = "u:"
+
+class InvalidCursor(ValueError):
+    pass
+
+def parse_cursor(after):
+    """
+    Split an ?after= token into (phase, key)
+    """
+    if not after:
+        return "products", 0
+    if after.startswith(UNASSOCIATED_CURSOR_PREFIX):
+        image_id = after[len(UNASSOCIATED_CURSOR_PREFIX):]
+        if not image_id:
+            return "unassociated", None
+        try:
+            return "unassociated", ObjectId(image_id)
+        except InvalidId:
+            raise InvalidCursor(after)
+    try:
+        return "products", int(after)
+    except ValueError:
+        raise InvalidCursor(after)
+
+def parse_page_size(limit):
+    """
+    Clamp a ?limit= value to the allowed page size
+    """
+    try:
+        limit = int(limit) if limit else GALLERY_PAGE_SIZE
+    except ValueError:
+        limit = GALLERY_PAGE_SIZE
+    return max(1, min(limit, GALLERY_MAX_PAGE_SIZE))
+
+def get_uploaded_images(after=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Get one page of uploaded images with product details.
+    Products come first in id order, then images without a product.
+    Returns (images, next_cursor); next_cursor is None on the last page.
+    """
+    return cached("gallery", f"{after or ''}:{limit}", lambda: load_uploaded_images(after, limit))
+
+def load_uploaded_images(after=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Read one page of the gallery from the databases, bypassing the cache
+    """
+    phase, key = parse_cursor(after)
     client, database, collection = create_mongodb_connection("file-uploads")
-    all_images = list(collection.find({}))
-    
-    # Create a lookup dictionary for MongoDB images by file_path
-    image_lookup = {}
-    for img in all_images:
-        if 'file_path' in img:
-            image_lookup[img['file_path']] = img
-    
+
+    parsed = []
+
+    if phase == "products":
+        # Borrow a pooled PostgreSQL connection to get one page of products
+        with postgresql_connection() as conn:
+            cur = conn.cursor()
+
+            # Fetch one extra row to know whether there is a next page
+            cur.execute("""
+                SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path
+                FROM products p
+                WHERE p.id > %s
+                ORDER BY p.id
+                LIMIT %s
+            """, (key, limit + 1))
+            products = cur.fetchall()
+            cur.close()
+
+        has_more = len(products) > limit
+        products = products[:limit]
+
+        # Only products created before image_file_path was added need MongoDB
+        page_images = fetch_product_images(collection, [product for product in products if not product[4]])
+        parsed = build_gallery(products, page_images, include_unassociated=False)
+
+        if has_more:
+            client.close()
+            return parsed, str(products[-1][0])
+
+        # Out of products: fill the rest of the page with unassociated images
+        key = None
+        limit -= len(products)
+        if limit <= 0:
+            client.close()
+            return parsed, UNASSOCIATED_CURSOR_PREFIX
+
+    unassociated, next_cursor = get_unassociated_images(collection, key, limit)
+    parsed.extend(unassociated)
+    client.close()
+
+    return parsed, next_cursor
+
+def stream_uploaded_images():
+    """
+    Yield the whole gallery, products then unassociated images, in the
+    order of the paged gallery. Products are read from a server-side cursor
+    and their MongoDB images looked up one chunk at a time.
+    """
+    client, database, collection = create_mongodb_connection("file-uploads")
+    try:
+        for products in iter_server_side(GALLERY_STREAM_SQL):
+            page_images = fetch_product_images(collection, [product for product in products if not product[4]])
+            yield from build_gallery(products, page_images, include_unassociated=False)
+
+        after_id = None
+        while True:
+            unassociated, next_cursor = get_unassociated_images(collection, after_id, GALLERY_MAX_PAGE_SIZE)
+            yield from unassociated
+            if next_cursor is None:
+                break
+            after_id = parse_cursor(next_cursor)[1]
+    finally:
+        client.close()
+
+def get_unassociated_images(collection, after_id, limit):
+    """
+    Get one page of images that no product points to, in _id order
+    """
+    # Images of deleted products get their product_id unset by the reconciler
+    query = {"product_id": {"$exists": False}, "file_path": {"$exists": True}}
+    if after_id is not None:
+        query["_id"] = {"$gt": after_id}
+
+    candidates = list(collection.find(query, IMAGE_PROJECTION).sort("_id", 1).limit(limit + 1))
+    has_more = len(candidates) > limit
+    candidates = candidates[:limit]
+    if not candidates:
+        return [], None
+
+    # Products created before the product_id back-fill only reference their
+    # image through image_mongodb_id, so those are not unassociated
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT image_mongodb_id FROM products WHERE image_mongodb_id = ANY(%s)",
+            ([str(img['_id']) for img in candidates],)
+        )
+        referenced = {row[0] for row in cur.fetchall()}
+        cur.close()
+
+    parsed = []
+    included_paths = set()
+    for img in candidates:
+        if str(img['_id']) in referenced or img['file_path'] in included_paths:
+            continue
+        parsed.append(unassociated_card(img['file_path']))
+        included_paths.add(img['file_path'])
+
+    next_cursor = UNASSOCIATED_CURSOR_PREFIX + str(candidates[-1]['_id']) if has_more else None
+    return parsed, next_cursor
+
+def unassociated_card(file_path, url_for=url_for):
+    """
+    Gallery entry of an image that no product points to
+    """
+    image_data = {
+        "image_url": url_for('download_file', name=file_path),
+        "file_path": file_path,
+        "product_name": "Unassociated Image",
+        "stock_count": 0
+    }
+    image_data.update(thumbnail_urls(file_path, url_for))
+    return image_data
+
+def build_gallery(products, all_images, include_unassociated=True, url_for=url_for):
+    """
+    Join product rows (id, name, stock_count, image_mongodb_id, image_file_path)
+    with their MongoDB image documents, which are only needed for products
+    without an image_file_path.
+    url_for is the URL builder of the app rendering the page.
+    """
+    images_by_product_id, images_by_id = build_image_indexes(all_images)
+
     # Prepare data for template
     parsed = []
-    
+    included_paths = set()
+
     # First, add products with their images
     for product in products:
         product_id = product[0]
         product_name = product[1]
         stock_count = product[2]
-        
-        # Find matching image for this product
-        matching_image = None
-        
-        # Try to find by product_id in MongoDB
-        for img in all_images:
-            if 'product_id' in img and str(img['product_id']) == str(product_id):
-                matching_image = img
-                break
-        
-        # If no match by product_id, try by image_mongodb_id
-        if not matching_image and product[3]:  # If product has image_mongodb_id
-            for img in all_images:
-                if '_id' in img and str(img['_id']) == product[3]:
-                    matching_image = img
-                    break
-        
+
+        # Use the denormalized path, else find the image by product_id, then by image_mongodb_id
+        if product[4]:
+            matching_image = {"file_path": product[4]}
+        else:
+            matching_image = find_product_image(product_id, product[3], images_by_product_id, images_by_id)
+
         # If we found a matching image
         if matching_image and 'file_path' in matching_image:
             img_url = url_for('download_file', name=matching_image['file_path'])
-            
+
             image_data = {
                 "image_url": img_url,
                 "product_id": product_id,
@@ -69,45 +219,57 @@ def get_uploaded_images():
                 "stock_count": stock_count,
                 "file_path": matching_image['file_path']
             }
-            
+            image_data.update(thumbnail_urls(matching_image['file_path'], url_for))
+
             parsed.append(image_data)
-    
+            included_paths.add(matching_image['file_path'])
+
+    if not include_unassociated:
+        return parsed
+
     # Now add any remaining images that don't have product associations
     for img in all_images:
-        if 'file_path' in img:
-            # Check if this image is already included
-            already_included = False
-            for p in parsed:
-                if p['file_path'] == img['file_path']:
-                    already_included = True
-                    break
-            
-            if not already_included:
-                img_url = url_for('download_file', name=img['file_path'])
-                
-                image_data = {
-                    "image_url": img_url,
-                    "file_path": img['file_path'],
-                    "product_name": "Unassociated Image",
-                    "stock_count": 0
-                }
-                
-                parsed.append(image_data)
-    
-    client.close()
-    cur.close()
-    conn.close()
-    
+        if 'file_path' in img and img['file_path'] not in included_paths:
+            parsed.append(unassociated_card(img['file_path'], url_for))
+            included_paths.add(img['file_path'])
+
     return parsed
 
 def render_images_page():
     """
-    Render the images gallery page
+    Render one page of the images gallery.
+    The next page is linked through ?after=<cursor>&limit=N and the
+    X-Next-Cursor / Link response headers.
     """
-    images = get_uploaded_images()
+    if stream_requested():
+        return render_images_stream()
+
+    limit = parse_page_size(request.args.get('limit'))
+    try:
+        images, next_cursor = get_uploaded_images(request.args.get('after'), limit)
+    except InvalidCursor:
+        return "Invalid cursor", 400
+
+    next_url = url_for('show_uploaded_images', after=next_cursor, limit=limit) if next_cursor else None
     env_mode = os.getenv("ENV_MODE")
-    
+
     if env_mode == "backend":
-        return jsonify(images)
+        response = jsonify(images)
     else:
-        return render_template('view_images.html', images=images)
\ No newline at end of file
+        response = make_response(render_template('view_images.html', images=images, next_url=next_url))
+
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+def render_images_stream():
+    """
+    Stream the whole gallery as HTML or as a JSON array, starting with the
+    first chunk of products. There is no next page, and the listing cache
+    is not used.
+    """
+    images = stream_uploaded_images()
+    if os.getenv("ENV_MODE") == "backend":
+        return streamed_response(stream_json_array(images), "application/json")
+    return streamed_response(stream_template('view_images.html', images=images, next_url=None), "text/html")
@@ -0,0 +1,100 @@
+"""
+ASGI variant of main.py, for serving with an async worker:
+
+    hypercorn async_main:app --workers 4 --bind 0.0.0.0:5000
+
+It serves the gallery, uploads, thumbnails, images and orders with asyncpg,
+Motor and aiofiles, so a worker keeps serving other requests while one waits
+on RDS, DocumentDB or EFS. Resumable uploads, bulk endpoints and the admin
+routes stay on the sync app.
+"""
+import os
+
+from quart import Quart, request, redirect, url_for, render_template
+
+from actions import async_views
+from actions.utils import add_cache_headers
+from actions.validation import UPLOAD_MAX_BYTES
+from db.postgresql.async_postgresql_connection import close_async_postgresql_pool
+from db.mongodb.async_mongodb_connection import close_async_mongodb_client
+from jobs.queue import JOB_WORKER_MODE
+from jobs.worker import ensure_worker_threads
+
+UPLOAD_FOLDER = os.getenv("UPLOAD_DIRECTORY")
+
+app = Quart(__name__)
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 1024 * 1024
+app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")
+
+@app.before_serving
+async def startup():
+    # Pick up jobs left in the queue by a previous run
+    if JOB_WORKER_MODE == "thread":
+        ensure_worker_threads()
+
+@app.after_serving
+async def shutdown():
+    await close_async_postgresql_pool()
+    close_async_mongodb_client()
+
+@app.after_request
+async def after_request_handler(response):
+    return add_cache_headers(response)
+
+@app.route("/")
+async def index():
+    return await render_template('index.html')
+
+@app.route('/upload-file', methods=['GET', 'POST'])
+async def upload_file():
+    if request.method == 'POST':
+        result = await async_views.handle_upload_file(app.config['UPLOAD_FOLDER'])
+        if result:
+            return result
+
+    return await render_template('upload_image.html')
+
+@app.route('/images', methods=['GET'])
+async def show_uploaded_images():
+    return await async_views.render_images_page()
+
+@app.route('/uploads/<path:name>')
+async def download_file(name):
+    return await async_views.serve_file(app.config['UPLOAD_FOLDER'], name)
+
+@app.route('/thumbnails/<int:width>/<path:name>')
+async def get_thumbnail(width, name):
+    return await async_views.serve_thumbnail(app.config['UPLOAD_FOLDER'], width, name)
+
+@app.route('/create-order', methods=['GET', 'POST'])
+async def create_order():
+    if request.method == 'POST':
+        return await async_views.process_order(app)
+
+    return await async_views.render_order_page(app)
+
+@app.route('/image/<image_id>')
+async def get_image(image_id):
+    return await async_views.get_image_by_id(app.config['UPLOAD_FOLDER'], image_id)
+
+# Simple redirect routes for better navigation
+@app.route('/home')
+async def home():
+    return redirect(url_for('index'))
+
+@app.route('/gallery')
+async def gallery():
+    return redirect(url_for('show_uploaded_images'))
+
+@app.route('/upload')
+async def upload():
+    return redirect(url_for('upload_file'))
+
+@app.route('/order')
+async def order():
+    return redirect(url_for('create_order'))
+
+@app.route("/health")
+async def health():
+    return "OK", 200
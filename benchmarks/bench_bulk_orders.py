@@ -0,0 +1,104 @@
+"""
+Compare placing many order lines as single orders with one bulk order.
+
+    python benchmarks/bench_bulk_orders.py --products 50 --lines 10,100,500
+
+Uses the POSTGRESQL_DB_* environment variables. Each run creates its own
+products with plenty of stock and places the same lines twice: once through
+place_order, one transaction per line, and once through place_bulk_order,
+one transaction for all lines. The rows created by a run are deleted
+afterwards.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from actions.create_order import place_order, place_bulk_order  # noqa: E402
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.environ["POSTGRESQL_DB_HOST"],
+        database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
+        user=os.environ['POSTGRESQL_DB_USERNAME'],
+        password=os.environ['POSTGRESQL_DB_PASSWORD']
+    )
+
+
+def create_products(conn, count, stock):
+    cur = conn.cursor()
+    product_ids = []
+    for n in range(count):
+        cur.execute("INSERT INTO products (name, image_mongodb_id, stock_count, review) "
+                    "VALUES (%s, %s, %s, %s) RETURNING id", (f"bench-bulk-{n}", "", stock, "benchmark"))
+        product_ids.append(cur.fetchone()[0])
+    conn.commit()
+    return product_ids
+
+
+def cleanup(conn, product_ids):
+    cur = conn.cursor()
+    cur.execute("SELECT DISTINCT order_id FROM stock_movements WHERE product_id = ANY(%s)", (product_ids,))
+    order_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("DELETE FROM stock_movements WHERE product_id = ANY(%s)", (product_ids,))
+    cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (order_ids,))
+    cur.execute("DELETE FROM products WHERE id = ANY(%s)", (product_ids,))
+    conn.commit()
+
+
+def single_orders(conn, lines):
+    cur = conn.cursor()
+    for product_id, quantity in lines:
+        place_order(cur, product_id, "bench-single", quantity)
+        conn.commit()
+
+
+def bulk_order(conn, lines):
+    cur = conn.cursor()
+    place_bulk_order(cur, "bench-bulk", lines)
+    conn.commit()
+
+
+def run(func, product_count, line_count, repeat):
+    conn = connect()
+    product_ids = create_products(conn, product_count, stock=line_count * repeat * 10)
+    lines = [(random.choice(product_ids), random.randint(1, 3)) for _ in range(line_count)]
+
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(conn, lines)
+    elapsed = time.perf_counter() - started
+
+    cleanup(conn, product_ids)
+    conn.close()
+    return {
+        "lines": line_count,
+        "repeat": repeat,
+        "seconds": round(elapsed, 3),
+        "lines_per_second": round(line_count * repeat / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--lines", default="10,100,500")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for line_count in [int(n) for n in args.lines.split(",")]:
+        for name, func in (("single", single_orders), ("bulk", bulk_order)):
+            row = {"variant": name}
+            row.update(run(func, args.products, line_count, args.repeat))
+            print(json.dumps(row), flush=True)
+
+
+if __name__ == "__main__":
+    main()
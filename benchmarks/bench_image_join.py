@@ -0,0 +1,141 @@
+"""
+Benchmark the product/image join behind /images, before and after indexing.
+
+    python benchmarks/bench_image_join.py --sizes 100,1000,5000,20000
+
+The "before" variant is the original nested-loop join and is skipped above
+--max-legacy-size because it grows quadratically.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+os.environ.setdefault("UPLOAD_DIRECTORY", "/tmp")
+
+from flask import Flask, url_for  # noqa: E402
+import actions.view_images  # noqa: E402
+from actions.view_images import build_gallery  # noqa: E402
+
+# Measure the join itself, not the thumbnail URLs added to each card
+actions.view_images.thumbnail_urls = lambda file_path, url_for=None: {}
+
+app = Flask(__name__)
+
+
+@app.route('/uploads/<path:name>')
+def download_file(name):
+    return name
+
+
+
+def make_dataset(size, unassociated_ratio=0.1):
+    """
+    Build `size` products, each with an image, plus some unassociated images
+    """
+    products = []
+    images = []
+    for product_id in range(1, size + 1):
+        image_id = ObjectId()
+        # Half the images are linked by product_id, half only by image_mongodb_id
+        image = {"_id": image_id, "file_path": f"image-{product_id}.jpg"}
+        if product_id % 2:
+            image["product_id"] = product_id
+        images.append(image)
+        # image_file_path is left NULL to measure the MongoDB join
+        products.append((product_id, f"Product {product_id}", 10, str(image_id), None))
+
+    for n in range(int(size * unassociated_ratio)):
+        images.append({"_id": ObjectId(), "file_path": f"orphan-{n}.jpg"})
+
+    # Newest products first, like an unordered table scan would likely return
+    products.reverse()
+    return products, images
+
+
+def legacy_gallery(products, all_images):
+    """
+    The nested-loop join used before hash indexes were introduced
+    """
+    parsed = []
+    for product in products:
+        matching_image = None
+        for img in all_images:
+            if 'product_id' in img and str(img['product_id']) == str(product[0]):
+                matching_image = img
+                break
+        if not matching_image and product[3]:
+            for img in all_images:
+                if '_id' in img and str(img['_id']) == product[3]:
+                    matching_image = img
+                    break
+        if matching_image and 'file_path' in matching_image:
+            parsed.append({
+                "image_url": url_for('download_file', name=matching_image['file_path']),
+                "product_id": product[0],
+                "product_name": product[1],
+                "stock_count": product[2],
+                "file_path": matching_image['file_path']
+            })
+
+    for img in all_images:
+        if 'file_path' in img:
+            already_included = False
+            for p in parsed:
+                if p['file_path'] == img['file_path']:
+                    already_included = True
+                    break
+            if not already_included:
+                parsed.append({
+                    "image_url": url_for('download_file', name=img['file_path']),
+                    "file_path": img['file_path'],
+                    "product_name": "Unassociated Image",
+                    "stock_count": 0
+                })
+    return parsed
+
+
+def time_it(func, products, images, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(products, images)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,2000,5000,20000,50000")
+    parser.add_argument("--max-legacy-size", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    with app.test_request_context():
+        for size in [int(s) for s in args.sizes.split(",")]:
+            products, images = make_dataset(size)
+            row = {"products": size, "images": len(images)}
+
+            indexed_seconds, indexed = time_it(build_gallery, products, images, args.repeat)
+            row["indexed_seconds"] = round(indexed_seconds, 6)
+
+            if size <= args.max_legacy_size:
+                legacy_seconds, legacy = time_it(legacy_gallery, products, images, 1)
+                assert legacy == indexed, "indexed join returned different rows"
+                row["legacy_seconds"] = round(legacy_seconds, 6)
+                row["speedup"] = round(legacy_seconds / indexed_seconds, 1)
+
+            results.append(row)
+            print(json.dumps(row), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Benchmark N parallel buyers of one SKU against a real PostgreSQL database.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/bench_order_contention.py --buyers 1,8,32 --stock 2000 --output contention.json
+
+The POSTGRESQL_DB_* variables default to the PostgreSQL of docker-compose.yml,
+whose schema is migrated first. Each run creates its own
+product, lets every buyer place quantity-1 orders until the product is sold
+out, then checks that stock never went negative and that the final stock
+matches the recorded stock movements. The "legacy" variant is the old
+SELECT / check / UPDATE sequence, which loses updates under contention.
+The rows created by a run are deleted afterwards.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import psycopg2
+
+BENCH_ENV = {
+    "POSTGRESQL_DB_HOST": "127.0.0.1",
+    "POSTGRESQL_DB_PORT": "55432",
+    "POSTGRESQL_DB_DATABASE_NAME": "bench",
+    "POSTGRESQL_DB_USERNAME": "bench",
+    "POSTGRESQL_DB_PASSWORD": "bench",
+}
+for name, value in BENCH_ENV.items():
+    os.environ.setdefault(name, value)
+# libpq reads the port from the environment, the app only passes the host
+os.environ.setdefault("PGPORT", os.environ["POSTGRESQL_DB_PORT"])
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from actions.create_order import place_order, UNIT_PRICE  # noqa: E402
+from db.postgresql.migrate import connect, migrate  # noqa: E402
+
+
+def legacy_place_order(cur, product_id, customer_name, quantity):
+    """
+    The read-check-write sequence process_order used before
+    """
+    cur.execute("SELECT name, stock_count FROM products WHERE id = %s", (product_id,))
+    name, stock = cur.fetchone()
+    if stock < quantity:
+        return None
+    total = UNIT_PRICE * quantity
+    cur.execute("INSERT INTO orders (customer_name, total, tax, pretax_amount) "
+                "VALUES (%s, %s, %s, %s) RETURNING id", (customer_name, total, 0, total))
+    order_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO stock_movements (product_id, order_id, quantity) VALUES (%s, %s, %s)",
+                (product_id, order_id, quantity))
+    cur.execute("UPDATE products SET stock_count = %s WHERE id = %s", (stock - quantity, product_id))
+    return order_id, name, stock - quantity
+
+
+def create_product(stock):
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO products (name, image_mongodb_id, stock_count, review) "
+                "VALUES (%s, %s, %s, %s) RETURNING id", ("bench-contention", "", stock, "benchmark"))
+    product_id = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return product_id
+
+
+def cleanup(product_id):
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("SELECT order_id FROM stock_movements WHERE product_id = %s", (product_id,))
+    order_ids = [row[0] for row in cur.fetchall()]
+    cur.execute("DELETE FROM stock_movements WHERE product_id = %s", (product_id,))
+    cur.execute("DELETE FROM orders WHERE id = ANY(%s)", (order_ids,))
+    cur.execute("DELETE FROM products WHERE id = %s", (product_id,))
+    conn.commit()
+    conn.close()
+
+
+def buyer(func, product_id, results, index, negative_seen):
+    conn = connect()
+    cur = conn.cursor()
+    placed = 0
+    errors = 0
+    while True:
+        try:
+            result = func(cur, product_id, f"bench-buyer-{index}", 1)
+            conn.commit()
+        except psycopg2.Error:
+            # e.g. the stock_nonnegative check constraint rejecting a stale write
+            conn.rollback()
+            errors += 1
+            continue
+        if result is None:
+            break
+        placed += 1
+        if result[2] < 0:
+            negative_seen.set()
+    conn.close()
+    results[index] = (placed, errors)
+
+
+def run(func, buyers, stock):
+    product_id = create_product(stock)
+    results = [None] * buyers
+    negative_seen = threading.Event()
+    threads = [threading.Thread(target=buyer, args=(func, product_id, results, n, negative_seen))
+               for n in range(buyers)]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("SELECT stock_count FROM products WHERE id = %s", (product_id,))
+    final_stock = cur.fetchone()[0]
+    cur.execute("SELECT COALESCE(SUM(quantity), 0) FROM stock_movements WHERE product_id = %s", (product_id,))
+    moved = cur.fetchone()[0]
+    conn.close()
+    cleanup(product_id)
+
+    placed = sum(r[0] for r in results)
+    return {
+        "buyers": buyers,
+        "orders": placed,
+        "errors": sum(r[1] for r in results),
+        "seconds": round(elapsed, 3),
+        "orders_per_second": round(placed / elapsed, 1),
+        "final_stock": final_stock,
+        # Stock drifts when units were sold without being subtracted
+        "drift": stock - moved - final_stock,
+        "oversold": moved > stock or negative_seen.is_set(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", default="1,8,32")
+    parser.add_argument("--stock", type=int, default=2000)
+    parser.add_argument("--skip-legacy", action="store_true")
+    parser.add_argument("--output", help="also write the rows to this JSON file")
+    args = parser.parse_args()
+
+    conn = connect()
+    migrate(conn)
+    conn.close()
+
+    variants = [("atomic", place_order)]
+    if not args.skip_legacy:
+        variants.append(("legacy", legacy_place_order))
+
+    rows = []
+    for buyers in [int(b) for b in args.buyers.split(",")]:
+        for name, func in variants:
+            row = {"variant": name, "stock": args.stock}
+            row.update(run(func, buyers, args.stock))
+            rows.append(row)
+            print(json.dumps(row), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Seed the databases at several scales and load-test every main route.
+
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/bench_routes.py --scales 100,1000,10000 --concurrency 32 --duration 20 \\
+        --output results.json --baseline previous.json
+
+For each scale the products, images and orders are recreated from scratch
+(the tables and the file-uploads collection are emptied, so only point it at
+the throwaway databases of docker-compose.yml, which the POSTGRESQL_DB_* and
+MONGODB_* defaults below do). The app is then started with --server and
+every route is driven with --concurrency keep-alive clients for --duration
+seconds. Prints one JSON object per scale and route with requests/sec,
+latency percentiles and the peak resident memory of the server's process
+tree (Linux only). With --baseline the change against an earlier --output
+file is added to each row.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+from datetime import datetime
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+BENCH_ENV = {
+    "POSTGRESQL_DB_HOST": "127.0.0.1",
+    "POSTGRESQL_DB_PORT": "55432",
+    "POSTGRESQL_DB_DATABASE_NAME": "bench",
+    "POSTGRESQL_DB_USERNAME": "bench",
+    "POSTGRESQL_DB_PASSWORD": "bench",
+    "MONGODB_DB_CONNECTION_URI": "mongodb://127.0.0.1:57017",
+    "MONGODB_DB_NAME": "bench",
+    "ENV_MODE": "backend",
+    "XRAY_ENABLED": "false",
+    "SECRET_KEY": "bench",
+}
+for name, value in BENCH_ENV.items():
+    os.environ.setdefault(name, value)
+# libpq reads the port from the environment, the app only passes the host
+os.environ.setdefault("PGPORT", os.environ["POSTGRESQL_DB_PORT"])
+os.environ.setdefault("UPLOAD_DIRECTORY", tempfile.mkdtemp(prefix="bench-uploads-"))
+
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+
+from load_compare import read_response, percentile  # noqa: E402
+from db.postgresql.migrate import connect, migrate  # noqa: E402
+from db.postgresql.rebuild_sales_summaries import rebuild  # noqa: E402
+from db.mongodb.mongodb_connection import create_mongodb_connection  # noqa: E402
+from actions.storage import store_upload_stream  # noqa: E402
+
+ROUTES = ["images", "create_order_get", "create_order_post", "upload_file", "uploads", "image_by_id",
+          "analytics_sales"]
+SEED_STOCK = 1000000
+
+
+def sample_png(index, size=64):
+    """
+    A small PNG that differs per index, so content-addressed storage keeps one file each
+    """
+    image = Image.new("RGB", (size, size), (index % 256, index // 256 % 256, index // 65536 % 256))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def seed(products, orders, upload_folder):
+    """
+    Recreate products with stored images and a history of orders.
+    Returns what the request generators pick from.
+    """
+    conn = connect()
+    migrate(conn)
+    cur = conn.cursor()
+    cur.execute("TRUNCATE products, orders, stock_movements RESTART IDENTITY CASCADE")
+
+    client, database, collection = create_mongodb_connection("file-uploads")
+    collection.delete_many({})
+
+    stored_files = [store_upload_stream(io.BytesIO(sample_png(i)), f"seed-{i}.png", upload_folder)
+                    for i in range(products)]
+    result = collection.insert_many([
+        {**stored_file, "product_name": f"Product {i}", "upload_date": datetime.now()}
+        for i, stored_file in enumerate(stored_files)
+    ])
+    mongodb_ids = [str(inserted_id) for inserted_id in result.inserted_ids]
+
+    rows = execute_values(cur, """
+        INSERT INTO products (name, image_mongodb_id, stock_count, review, image_file_path,
+                              image_content_hash, image_size, image_mime_type) VALUES %s
+        RETURNING id
+        """,
+        [(f"Product {i}", mongodb_id, SEED_STOCK, "Sample Review", stored_file["file_path"],
+          stored_file["content_hash"], stored_file["size"], stored_file["mime_type"])
+         for i, (mongodb_id, stored_file) in enumerate(zip(mongodb_ids, stored_files))],
+        page_size=1000, fetch=True)
+    product_ids = [row[0] for row in rows]
+
+    if orders:
+        order_ids = [row[0] for row in execute_values(
+            cur, "INSERT INTO orders (customer_name, total, tax, pretax_amount) VALUES %s RETURNING id",
+            [(f"Customer {i}", 10, 0, 10) for i in range(orders)], page_size=1000, fetch=True)]
+        execute_values(
+            cur, "INSERT INTO stock_movements (product_id, order_id, quantity) VALUES %s",
+            [(random.choice(product_ids), order_id, 1) for order_id in order_ids], page_size=1000)
+
+    conn.commit()
+    # The seeded orders bypass the order routes that maintain the summaries
+    rebuild(conn)
+    cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    client.close()
+
+    return {
+        "product_ids": product_ids,
+        "mongodb_ids": mongodb_ids,
+        "file_paths": [stored_file["file_path"] for stored_file in stored_files],
+    }
+
+
+def multipart(fields, file_field, filename, content):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                 f'filename="{filename}"\r\nContent-Type: image/png\r\n\r\n'.encode() + content + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return f"multipart/form-data; boundary={boundary}", b"".join(parts)
+
+
+def http_request(host, method, path, body=b"", content_type=None):
+    head = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n"
+    if body:
+        head += f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+    return (head + "\r\n").encode() + body
+
+
+def request_factory(route, host, seeded):
+    """
+    Return a function building the next raw request for a route
+    """
+    counter = iter(range(10 ** 9))
+
+    if route == "images":
+        return lambda: http_request(host, "GET", "/images")
+    if route == "create_order_get":
+        return lambda: http_request(host, "GET", "/create-order")
+    if route == "create_order_post":
+        def build():
+            body = (f"product_id={random.choice(seeded['product_ids'])}"
+                    f"&customer_name=bench&order_quantity=1").encode()
+            return http_request(host, "POST", "/create-order", body, "application/x-www-form-urlencoded")
+        return build
+    if route == "upload_file":
+        def build():
+            i = next(counter)
+            content_type, body = multipart(
+                {"product_name": f"Upload {i}", "initial_stock_count": "10"},
+                "file", f"upload-{uuid.uuid4().hex}.png", sample_png(i + 10 ** 6))
+            return http_request(host, "POST", "/upload-file", body, content_type)
+        return build
+    if route == "uploads":
+        return lambda: http_request(host, "GET", f"/uploads/{random.choice(seeded['file_paths'])}")
+    if route == "image_by_id":
+        return lambda: http_request(host, "GET", f"/image/{random.choice(seeded['mongodb_ids'])}")
+    if route == "analytics_sales":
+        return lambda: http_request(host, "GET", "/analytics/sales?sort=" + random.choice(["units_sold", "revenue"]))
+    raise ValueError(f"Unknown route {route}")
+
+
+async def client(host, port, build_request, deadline, latencies, errors):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            started = time.perf_counter()
+            writer.write(build_request())
+            await writer.drain()
+            status, close = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append(status)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+def process_tree_rss(pid):
+    """
+    Resident memory in bytes of a process and all its descendants, from /proc
+    """
+    parents = {}
+    rss = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as f:
+                status = dict(line.split(":", 1) for line in f if ":" in line)
+        except OSError:
+            continue
+        parents[int(entry)] = int(status["PPid"])
+        rss[int(entry)] = int(status.get("VmRSS", "0 kB").split()[0]) * 1024
+
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        tree |= children
+        changed = bool(children)
+    return sum(rss.get(member, 0) for member in tree)
+
+
+async def sample_memory(pid, deadline, samples):
+    while time.perf_counter() < deadline:
+        samples.append(process_tree_rss(pid))
+        await asyncio.sleep(0.25)
+
+
+async def run(host, port, build_request, concurrency, duration, server_pid):
+    latencies = []
+    errors = []
+    memory = []
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(
+        sample_memory(server_pid, deadline, memory),
+        *[client(host, port, build_request, deadline, latencies, errors) for _ in range(concurrency)]
+    )
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        "rss_peak_mb": round(max(memory) / 2 ** 20, 1) if memory else None,
+    }
+
+
+def start_server(command, base_url, timeout=60):
+    server = subprocess.Popen(command, shell=True, cwd=ROOT, start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited with status {server.returncode}")
+        try:
+            urllib.request.urlopen(base_url + "/health", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.2)
+    stop_server(server)
+    raise SystemExit(f"Server did not answer {base_url}/health within {timeout}s")
+
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=30)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(server.pid, signal.SIGKILL)
+
+
+def compare(row, baseline):
+    """
+    Add the change in throughput and p95 against the same scale and route of a previous run
+    """
+    previous = baseline.get((row["scale"], row["route"]))
+    if not previous:
+        return row
+    for key in ("requests_per_second", "p95_ms"):
+        if previous.get(key) and row.get(key) is not None:
+            row[f"{key}_change_pct"] = round((row[key] - previous[key]) / previous[key] * 100, 1)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="100,1000,10000", help="number of products per run")
+    parser.add_argument("--orders-per-product", type=int, default=5)
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--server", default="gunicorn -c gunicorn.conf.py -w 4 -b 127.0.0.1:{port}")
+    parser.add_argument("--output", help="write every row to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier --output to compare against")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(row["scale"], row["route"]): row for row in json.load(f)["results"]}
+
+    host = f"127.0.0.1:{args.port}"
+    base_url = f"http://{host}"
+    results = []
+    for scale in [int(scale) for scale in args.scales.split(",")]:
+        seeded = seed(scale, scale * args.orders_per_product, os.environ["UPLOAD_DIRECTORY"])
+        server = start_server(args.server.format(port=args.port), base_url)
+        try:
+            for route in args.routes.split(","):
+                row = {"scale": scale, "route": route}
+                row.update(asyncio.run(run(
+                    "127.0.0.1", args.port, request_factory(route, host, seeded),
+                    args.concurrency, args.duration, server.pid)))
+                row["rss_after_mb"] = round(process_tree_rss(server.pid) / 2 ** 20, 1)
+                results.append(compare(row, baseline))
+                print(json.dumps(row), flush=True)
+        finally:
+            stop_server(server)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"server": args.server, "concurrency": args.concurrency,
+                       "duration": args.duration, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
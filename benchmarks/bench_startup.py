@@ -0,0 +1,90 @@
+"""
+Measure how long a fresh process takes to import main and build the app.
+
+    python benchmarks/bench_startup.py --runs 10 --budget 1.5
+    XRAY_ENABLED=false python benchmarks/bench_startup.py --preload
+
+Each run is a new interpreter, so nothing is cached in sys.modules. Prints
+one JSON object with the median and worst import, create_app and total
+times, and the slowest top-level imports taken from `python -X importtime`.
+Exits with status 1 when the median total is over the budget, so it can
+guard deploys in CI.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.create_app(start_job_workers=False, preload={preload})
+print(json.dumps({{"import": imported - started, "create_app": time.perf_counter() - imported}}))
+"""
+
+
+def probe(preload, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE.format(preload=preload)]
+    env = dict(os.environ, JOB_WORKER_MODE="external")
+    env.setdefault("UPLOAD_DIRECTORY", "/tmp")
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_output, count=10):
+    """
+    Modules imported directly by main, by cumulative import time, from
+    -X importtime output (children are listed before their parent)
+    """
+    children = []
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative) / 1000))
+        elif depth == 0:
+            if name.strip() == "main":
+                modules = children
+            children = []
+    modules.sort(key=lambda module: module[1], reverse=True)
+    return [{"module": name, "ms": round(ms, 1)} for name, ms in modules[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_BUDGET_SECONDS", "1.5")))
+    parser.add_argument("--preload", action="store_true", help="also import every view module, as gunicorn does")
+    args = parser.parse_args()
+
+    runs = [probe(args.preload)[0] for _ in range(args.runs)]
+    totals = [run["import"] + run["create_app"] for run in runs]
+    _, importtime_output = probe(args.preload, importtime=True)
+
+    median = statistics.median(totals)
+    print(json.dumps({
+        "runs": args.runs,
+        "preload": args.preload,
+        "xray_enabled": os.getenv("XRAY_ENABLED", "true").lower() == "true",
+        "import_ms": round(statistics.median(run["import"] for run in runs) * 1000, 1),
+        "create_app_ms": round(statistics.median(run["create_app"] for run in runs) * 1000, 1),
+        "total_ms": round(median * 1000, 1),
+        "worst_total_ms": round(max(totals) * 1000, 1),
+        "budget_ms": round(args.budget * 1000, 1),
+        "within_budget": median <= args.budget,
+        "slowest_imports": slowest_imports(importtime_output),
+    }, indent=2))
+    return 0 if median <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Load-test the sync (gunicorn) and async (hypercorn) apps side by side.
+
+    gunicorn -w 4 -b 127.0.0.1:5000 main:app
+    hypercorn -w 4 -b 127.0.0.1:5001 async_main:app
+    python benchmarks/load_compare.py --sync http://127.0.0.1:5000 --async http://127.0.0.1:5001 \\
+        --paths /images,/create-order,/uploads/sample.png --concurrency 500 --duration 30
+
+Each client keeps one keep-alive connection open and sends GET requests back
+to back for the duration. Prints one JSON object per target and path with
+requests/sec, error count and latency percentiles. Uses only the standard
+library, so the load generator itself is never the async part being measured.
+"""
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+
+    length = None
+    chunked = False
+    close = False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        value = value.strip()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+        elif name == "connection" and value.lower() == "close":
+            close = True
+
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length is not None:
+        await reader.readexactly(length)
+    elif status not in (204, 304):
+        await reader.read()
+        close = True
+    return status, close
+
+
+async def client(host, port, path, deadline, latencies, errors):
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode()
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            started = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            status, close = await read_response(reader)
+            latencies.append(time.perf_counter() - started)
+            if status >= 500:
+                errors.append(status)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as e:
+            errors.append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def run(base_url, path, concurrency, duration):
+    url = urlsplit(base_url)
+    host = url.hostname
+    port = url.port or 80
+    latencies = []
+    errors = []
+
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*[
+        client(host, port, path, deadline, latencies, errors) for _ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "path": path,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sync", dest="sync_url", default="http://127.0.0.1:5000")
+    parser.add_argument("--async", dest="async_url", default="http://127.0.0.1:5001")
+    parser.add_argument("--paths", default="/images,/create-order")
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    for path in args.paths.split(","):
+        for mode, base_url in (("sync", args.sync_url), ("async", args.async_url)):
+            row = {"mode": mode, "url": base_url}
+            row.update(asyncio.run(run(base_url, path, args.concurrency, args.duration)))
+            print(json.dumps(row), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+from mongodb_connection import create_mongodb_raw_connect
+import os
+
+client = create_mongodb_raw_connect()
+db_name = os.getenv("MONGODB_DB_NAME")
+database = client[db_name]
+collection = database["file-uploads"]
+
+# Product pages and the gallery look images up by product_id, and the
+# gallery walks images without one in _id order
+collection.create_index("product_id", name="product_id")
+# The reconciler looks up batches of files on the upload volume by path
+collection.create_index("file_path", name="file_path")
+
+for name, index in collection.index_information().items():
+    print(name, index["key"])
+
+client.close()
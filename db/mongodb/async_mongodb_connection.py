@@ -0,0 +1,32 @@
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from db.mongodb.mongodb_connection import _client_options
+
+# Motor binds its client to the event loop it is first used on, which is the
+# single loop of the async worker process
+_client = None
+
+
+def get_async_mongodb_client():
+    """
+    Return the Motor client shared by the current process, creating it lazily
+    """
+    global _client
+
+    if _client is None:
+        _client = AsyncIOMotorClient(os.getenv("MONGODB_DB_CONNECTION_URI"), **_client_options())
+    return _client
+
+
+def get_async_mongodb_collection(collection_name):
+    return get_async_mongodb_client()[os.getenv("MONGODB_DB_NAME")][collection_name]
+
+
+def close_async_mongodb_client():
+    global _client
+
+    if _client is not None:
+        _client.close()
+        _client = None
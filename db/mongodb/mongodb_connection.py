@@ -1,5 +1,59 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, monitoring
 import os
+import threading
+from actions.metrics import count_db_call, observe_query
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _client_options():
+    return {
+        "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "10")),
+        "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+        "connectTimeoutMS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "socketTimeoutMS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000")),
+        "maxIdleTimeMS": int(os.getenv("MONGODB_MAX_IDLE_TIME_MS", "300000")),
+    }
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Records the duration of every command and counts round trips per
+    request, see actions.metrics. pymongo calls it on the thread that runs
+    the command.
+    """
+
+    def started(self, event):
+        count_db_call("mongodb")
+
+    def succeeded(self, event):
+        observe_query("mongodb", event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        observe_query("mongodb", event.command_name, event.duration_micros / 1e6)
+
+
+class _SharedMongoClient:
+    """
+    Thin proxy around the process-wide MongoClient whose close() is a no-op,
+    so callers that still close their client after use don't tear it down
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def close(self):
+        pass
+
+    def __getitem__(self, name):
+        return self._client[name]
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
 
 def create_mongodb_raw_connect():
     db_name = os.getenv("MONGODB_DB_NAME")
@@ -13,19 +67,57 @@ def create_mongodb_raw_connect():
 
     return client
 
+def get_mongodb_client():
+    """
+    Return the MongoClient shared by the current process, creating it lazily.
+    A client inherited from a parent process (e.g. gunicorn preload) is
+    replaced, since MongoClient is not fork-safe.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _client_lock:
+        if _client is None or _client_pid != pid:
+            uri = os.getenv("MONGODB_DB_CONNECTION_URI")
+            try:
+                _client = MongoClient(uri, connect=False, event_listeners=[MongoCommandListener()],
+                                      **_client_options())
+            except Exception as e:
+                raise Exception(
+                    "The following error occurred: ", e)
+            _client_pid = pid
+    return _client
+
+def reset_mongodb_client():
+    """
+    Forget the shared client, e.g. right after a worker has been forked
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        _client = None
+        _client_pid = None
+
+def close_mongodb_client():
+    """
+    Really close the shared client, for process shutdown
+    """
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
 def create_mongodb_connection(collection_name):
     db_name = os.getenv("MONGODB_DB_NAME")
-    uri = os.getenv("MONGODB_DB_CONNECTION_URI")
 
-    try:
-        client = MongoClient(uri)
-        database = client[db_name]
-        collection = database[collection_name]
-        # start example code here
-        # end example code here
-        
-    except Exception as e:
-        raise Exception(
-            "The following error occurred: ", e)
+    client = get_mongodb_client()
+    database = client[db_name]
+    collection = database[collection_name]
 
-    return client, database, collection
+    return _SharedMongoClient(client), database, collection
@@ -0,0 +1,64 @@
+import os
+import asyncio
+
+import asyncpg
+
+from db.postgresql.postgresql_connection import POOL_MIN_SIZE, POOL_MAX_SIZE, POOL_WAIT_TIMEOUT, POOL_MAX_LIFETIME
+
+# The async app runs a single event loop per worker process, so one pool per
+# process serves every request; the sizing variables are shared with the
+# sync pool.
+_pool = None
+# Concurrent first requests must not each create a pool
+_pool_lock = asyncio.Lock()
+
+
+async def get_async_postgresql_pool():
+    """
+    Return the asyncpg pool of the current process, creating it on first use
+    """
+    global _pool
+
+    if _pool is not None:
+        return _pool
+
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await asyncpg.create_pool(
+                host=os.environ["POSTGRESQL_DB_HOST"],
+                database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
+                user=os.environ['POSTGRESQL_DB_USERNAME'],
+                password=os.environ['POSTGRESQL_DB_PASSWORD'],
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=POOL_MAX_LIFETIME,
+            )
+    return _pool
+
+
+def async_postgresql_connection():
+    """
+    Borrow a pooled connection: `async with async_postgresql_connection() as conn`
+    """
+    return _PoolConnection()
+
+
+class _PoolConnection:
+    # get_async_postgresql_pool is a coroutine, so the pool's own acquire()
+    # context manager can't be returned directly
+
+    async def __aenter__(self):
+        self._pool = await get_async_postgresql_pool()
+        self._conn = await self._pool.acquire(timeout=POOL_WAIT_TIMEOUT)
+        return self._conn
+
+    async def __aexit__(self, *exc_info):
+        await self._pool.release(self._conn)
+
+
+async def close_async_postgresql_pool():
+    global _pool
+
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
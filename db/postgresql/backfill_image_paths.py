@@ -0,0 +1,107 @@
+"""
+Copy each product's image file_path, content hash, size and MIME type from
+MongoDB into the products table, so listings can skip MongoDB.
+
+    python db/postgresql/backfill_image_paths.py --batch-size 500
+
+Adds the columns if the table predates them. Safe to run repeatedly and
+while the app is serving: only rows with a NULL image_file_path are touched,
+in id order, one batch per transaction.
+"""
+import os
+import sys
+import argparse
+import mimetypes
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from db.mongodb.mongodb_connection import create_mongodb_connection  # noqa: E402
+from actions.utils import build_image_indexes, find_product_image, product_images_query  # noqa: E402
+
+ADD_COLUMNS_SQL = """
+    ALTER TABLE products
+        ADD COLUMN IF NOT EXISTS image_file_path varchar (1024),
+        ADD COLUMN IF NOT EXISTS image_content_hash varchar (64),
+        ADD COLUMN IF NOT EXISTS image_size bigint,
+        ADD COLUMN IF NOT EXISTS image_mime_type varchar (150)
+"""
+
+IMAGE_FIELDS = {"file_path": 1, "product_id": 1, "content_hash": 1, "size": 1, "mime_type": 1}
+
+
+def backfill(conn, collection, batch_size, dry_run=False):
+    cur = conn.cursor()
+    last_id = 0
+    updated = 0
+    missing = 0
+    while True:
+        cur.execute("""
+            SELECT id, name, stock_count, image_mongodb_id FROM products
+            WHERE image_file_path IS NULL AND id > %s
+            ORDER BY id
+            LIMIT %s
+        """, (last_id, batch_size))
+        products = cur.fetchall()
+        if not products:
+            break
+        last_id = products[-1][0]
+
+        images = list(collection.find(product_images_query(products), IMAGE_FIELDS))
+        images_by_product_id, images_by_id = build_image_indexes(images)
+
+        values = []
+        for product in products:
+            image = find_product_image(product[0], product[3], images_by_product_id, images_by_id)
+            if not image or 'file_path' not in image:
+                missing += 1
+                continue
+            mime_type = image.get("mime_type") or mimetypes.guess_type(image["file_path"])[0]
+            values.append((product[0], image["file_path"], image.get("content_hash"), image.get("size"), mime_type))
+
+        if values and not dry_run:
+            execute_values(cur, """
+                UPDATE products AS p SET
+                    image_file_path = v.file_path,
+                    image_content_hash = v.content_hash,
+                    image_size = v.size::bigint,
+                    image_mime_type = v.mime_type
+                FROM (VALUES %s) AS v (id, file_path, content_hash, size, mime_type)
+                WHERE p.id = v.id AND p.image_file_path IS NULL
+            """, values)
+        conn.commit()
+        updated += len(values)
+        print(f"up to product {last_id}: {updated} updated, {missing} without an image", flush=True)
+
+    cur.close()
+    return updated, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host=os.environ["POSTGRESQL_DB_HOST"],
+        database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
+        user=os.environ['POSTGRESQL_DB_USERNAME'],
+        password=os.environ['POSTGRESQL_DB_PASSWORD'])
+
+    cur = conn.cursor()
+    cur.execute(ADD_COLUMNS_SQL)
+    conn.commit()
+    cur.close()
+
+    client, database, collection = create_mongodb_connection("file-uploads")
+    updated, missing = backfill(conn, collection, args.batch_size, args.dry_run)
+    client.close()
+    conn.close()
+    print(f"done: {updated} products updated, {missing} without an image")
+
+
+if __name__ == "__main__":
+    main()
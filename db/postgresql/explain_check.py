@@ -0,0 +1,91 @@
+"""
+Check with EXPLAIN that the hot queries can use their indexes.
+
+    python db/postgresql/explain_check.py
+    python db/postgresql/explain_check.py --planner-costs
+
+On a small database the planner rightly prefers sequential scans, so by
+default they are disabled for the session and the check shows whether each
+query *can* use its index. With --planner-costs the plans are taken as they
+are, which is what to look at on a production-sized copy.
+Exits with status 1 if any query does not use the expected index.
+"""
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from db.postgresql.migrate import connect  # noqa: E402
+from actions.create_order import RECENT_ORDERS_SQL  # noqa: E402
+from actions.analytics import TOP_PRODUCTS_SQL  # noqa: E402
+
+# (description, query, parameters, indexes the plan should use)
+HOT_QUERIES = [
+    ("recent orders", RECENT_ORDERS_SQL, (),
+     {"orders_created_at_id_idx", "stock_movements_order_id_idx"}),
+    ("gallery page",
+     "SELECT p.id, p.name, p.stock_count, p.image_mongodb_id, p.image_file_path "
+     "FROM products p WHERE p.id > %s ORDER BY p.id LIMIT %s", (0, 49),
+     {"products_pkey"}),
+    ("images referenced by products",
+     "SELECT image_mongodb_id FROM products WHERE image_mongodb_id = ANY(%s)", (["000000000000000000000000"],),
+     {"products_image_mongodb_id_idx"}),
+    ("products by image file",
+     "SELECT image_file_path FROM products WHERE image_file_path = ANY(%s)", (["ab/cd/missing.png"],),
+     {"products_image_file_path_idx"}),
+    ("stock movements of a product",
+     "SELECT COALESCE(SUM(quantity), 0) FROM stock_movements WHERE product_id = %s", (1,),
+     {"stock_movements_product_id_idx"}),
+    ("top sellers by units",
+     TOP_PRODUCTS_SQL.format(order="units_sold"), {"limit": 20, "days": 30},
+     {"product_sales_summary_units_sold_idx", "product_sales_daily_pkey"}),
+    ("top sellers by revenue",
+     TOP_PRODUCTS_SQL.format(order="revenue"), {"limit": 20, "days": 30},
+     {"product_sales_summary_revenue_idx", "product_sales_daily_pkey"}),
+]
+
+
+def plan_indexes(plan):
+    """
+    Collect the index names used anywhere in an EXPLAIN (FORMAT JSON) plan
+    """
+    indexes = set()
+    if "Index Name" in plan:
+        indexes.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        indexes |= plan_indexes(child)
+    return indexes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--planner-costs", action="store_true")
+    args = parser.parse_args()
+
+    conn = connect()
+    cur = conn.cursor()
+    if not args.planner_costs:
+        cur.execute("SET enable_seqscan = off")
+
+    failed = False
+    for description, query, parameters, expected in HOT_QUERIES:
+        cur.execute("EXPLAIN (FORMAT JSON) " + query, parameters)
+        plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        used = plan_indexes(plan[0]["Plan"])
+        missing = expected - used
+        status = "ok  " if not missing else "FAIL"
+        print(f"{status} {description}: uses {sorted(used) or 'no index'}"
+              + (f", missing {sorted(missing)}" if missing else ""))
+        failed = failed or bool(missing)
+
+    conn.rollback()
+    conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
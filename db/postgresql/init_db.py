@@ -1,70 +1,16 @@
 import os
-import psycopg2
+import sys
 
-conn = psycopg2.connect(
-        host=os.environ["POSTGRESQL_DB_HOST"],
-        database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
-        user=os.environ['POSTGRESQL_DB_USERNAME'],
-        password=os.environ['POSTGRESQL_DB_PASSWORD'])
+# This script used to drop and recreate every table. It now applies the
+# versioned migrations in db/postgresql/migrations, which never drop data,
+# so it is safe to run against a database that is already in use.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
 
-# Open a cursor to perform database operations
-cur = conn.cursor()
+from db.postgresql.migrate import connect, migrate
 
-# Execute a command: this creates a new table
-# https://stackoverflow.com/questions/28558920/postgresql-foreign-key-syntax
-cur.execute('DROP TABLE IF EXISTS products;')
-cur.execute('CREATE TABLE products (id serial PRIMARY KEY,'
-                                 'name varchar (150) NOT NULL,'
-                                 'image_mongodb_id varchar (150) NOT NULL,'
-                                 'stock_count integer NOT NULL,'
-                                 'constraint stock_nonnegative check (stock_count >= 0),'
-                                 'review text,'
-                                 'created_at date DEFAULT CURRENT_TIMESTAMP);'
-                                 )
+conn = connect()
 
+applied = migrate(conn)
+print(f"{len(applied)} migrations applied" if applied else "database is up to date")
 
-
-cur.execute('DROP TABLE IF EXISTS orders;')
-cur.execute('CREATE TABLE orders (id serial PRIMARY KEY,'
-                                 'customer_name varchar (150) NOT NULL,'
-                                 'total decimal NOT NULL,'
-                                 'constraint total_nonnegative check (total >= 0),'
-                                 'tax decimal NOT NULL,'
-                                 'constraint tax_nonnegative check (tax >= 0),'
-                                 'pretax_amount decimal NOT NULL,'
-                                 'constraint pretax_amount_nonnegative check (pretax_amount >= 0),'
-                                 'created_at date DEFAULT CURRENT_TIMESTAMP);'
-                                 )
-
-cur.execute('DROP TABLE IF EXISTS stock_movements;')
-cur.execute('CREATE TABLE stock_movements (id serial PRIMARY KEY,'
-                                 'product_id integer REFERENCES products,'
-                                 'order_id integer REFERENCES orders,'                    
-                                 'quantity integer NOT NULL,'
-                                 'constraint quantity_nonnegative check (quantity >= 0),'
-                                 'created_at date DEFAULT CURRENT_TIMESTAMP);'
-                                 )
-
-# # Insert data into the table
-
-# cur.execute('INSERT INTO books (title, author, pages_num, review)'
-#             'VALUES (%s, %s, %s, %s)',
-#             ('A Tale of Two Cities',
-#              'Charles Dickens',
-#              489,
-#              'A great classic!')
-#             )
-
-
-# cur.execute('INSERT INTO books (title, author, pages_num, review)'
-#             'VALUES (%s, %s, %s, %s)',
-#             ('Anna Karenina',
-#              'Leo Tolstoy',
-#              864,
-#              'Another great classic!')
-#             )
-
-conn.commit()
-
-cur.close()
-conn.close()
\ No newline at end of file
+conn.close()
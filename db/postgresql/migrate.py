@@ -0,0 +1,154 @@
+"""
+Apply the SQL migrations in db/postgresql/migrations that have not run yet.
+
+    python db/postgresql/migrate.py            # apply pending migrations
+    python db/postgresql/migrate.py --status   # list applied and pending ones
+
+Migrations are never destructive and each runs once; applied versions are
+recorded in schema_migrations. A migration runs in its own transaction
+unless its first line is `-- migrate: no-transaction`, which is needed for
+CREATE INDEX CONCURRENTLY. An advisory lock keeps two instances deploying
+at the same time from running them twice.
+"""
+import os
+import re
+import sys
+import hashlib
+import argparse
+
+import psycopg2
+
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_NAME_PATTERN = re.compile(r"^(\d+)_(\w+)\.sql$")
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+# Arbitrary key shared by every process running migrations
+ADVISORY_LOCK_KEY = 7320416
+
+CREATE_MIGRATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name varchar (255) NOT NULL,
+        checksum varchar (64) NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.environ["POSTGRESQL_DB_HOST"],
+        database=os.environ["POSTGRESQL_DB_DATABASE_NAME"],
+        user=os.environ['POSTGRESQL_DB_USERNAME'],
+        password=os.environ['POSTGRESQL_DB_PASSWORD'])
+
+
+def load_migrations(directory=MIGRATIONS_DIRECTORY):
+    """
+    Return [(version, name, sql, checksum)] sorted by version
+    """
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_NAME_PATTERN.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename)) as f:
+            sql = f.read()
+        migrations.append((int(match.group(1)), match.group(2), sql, hashlib.sha256(sql.encode()).hexdigest()))
+    migrations.sort()
+
+    versions = [migration[0] for migration in migrations]
+    if len(versions) != len(set(versions)):
+        raise SystemExit("Two migrations share a version number")
+    return migrations
+
+
+def split_statements(sql):
+    """
+    Split a migration into statements. Only needed outside a transaction,
+    where PostgreSQL would otherwise run a multi-statement string as one
+    implicit transaction.
+    """
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def applied_migrations(cur):
+    cur.execute("SELECT version, name, checksum FROM schema_migrations ORDER BY version")
+    return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+
+def apply_migration(conn, version, name, sql, checksum):
+    cur = conn.cursor()
+    if sql.lstrip().startswith(NO_TRANSACTION_MARKER):
+        conn.autocommit = True
+        try:
+            for statement in split_statements(sql):
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                        (version, name, checksum))
+        finally:
+            conn.autocommit = False
+    else:
+        cur.execute(sql)
+        cur.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                    (version, name, checksum))
+        conn.commit()
+    cur.close()
+
+
+def migrate(conn, status_only=False):
+    """
+    Apply pending migrations, returning the versions applied
+    """
+    cur = conn.cursor()
+    cur.execute(CREATE_MIGRATIONS_TABLE_SQL)
+    conn.commit()
+
+    # Session-level, so it is held across the per-migration transactions
+    cur.execute("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
+    try:
+        applied = applied_migrations(cur)
+        conn.commit()
+
+        done = []
+        for version, name, sql, checksum in load_migrations():
+            if version in applied:
+                if applied[version][1] != checksum:
+                    print(f"warning: migration {version}_{name} changed after it was applied")
+                if status_only:
+                    print(f"applied  {version:04d}_{name}")
+                continue
+            if status_only:
+                print(f"pending  {version:04d}_{name}")
+                continue
+
+            print(f"applying {version:04d}_{name}", flush=True)
+            try:
+                apply_migration(conn, version, name, sql, checksum)
+            except psycopg2.Error as e:
+                conn.rollback()
+                raise SystemExit(f"migration {version:04d}_{name} failed: {e}")
+            done.append(version)
+        return done
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true")
+    args = parser.parse_args()
+
+    conn = connect()
+    done = migrate(conn, status_only=args.status)
+    conn.close()
+    if not args.status:
+        print(f"{len(done)} migrations applied" if done else "database is up to date")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
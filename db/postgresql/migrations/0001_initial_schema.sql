@@ -0,0 +1,33 @@
+-- The tables as db/postgresql/init_db.py used to create them.
+-- IF NOT EXISTS leaves databases created by that script untouched.
+
+CREATE TABLE IF NOT EXISTS products (
+    id serial PRIMARY KEY,
+    name varchar (150) NOT NULL,
+    image_mongodb_id varchar (150) NOT NULL,
+    stock_count integer NOT NULL,
+    constraint stock_nonnegative check (stock_count >= 0),
+    review text,
+    created_at date DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    id serial PRIMARY KEY,
+    customer_name varchar (150) NOT NULL,
+    total decimal NOT NULL,
+    constraint total_nonnegative check (total >= 0),
+    tax decimal NOT NULL,
+    constraint tax_nonnegative check (tax >= 0),
+    pretax_amount decimal NOT NULL,
+    constraint pretax_amount_nonnegative check (pretax_amount >= 0),
+    created_at date DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS stock_movements (
+    id serial PRIMARY KEY,
+    product_id integer REFERENCES products,
+    order_id integer REFERENCES orders,
+    quantity integer NOT NULL,
+    constraint quantity_nonnegative check (quantity >= 0),
+    created_at date DEFAULT CURRENT_TIMESTAMP
+);
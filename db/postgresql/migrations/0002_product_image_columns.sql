@@ -0,0 +1,8 @@
+-- Denormalized image details, see db/postgresql/backfill_image_paths.py
+-- for filling them in on existing rows
+
+ALTER TABLE products
+    ADD COLUMN IF NOT EXISTS image_file_path varchar (1024),
+    ADD COLUMN IF NOT EXISTS image_content_hash varchar (64),
+    ADD COLUMN IF NOT EXISTS image_size bigint,
+    ADD COLUMN IF NOT EXISTS image_mime_type varchar (150);
@@ -0,0 +1,14 @@
+-- created_at was a date, so orders placed on the same day had no order.
+-- Existing rows keep their day at midnight; new rows get the full time.
+
+ALTER TABLE products
+    ALTER COLUMN created_at TYPE timestamptz USING created_at::timestamptz,
+    ALTER COLUMN created_at SET DEFAULT now();
+
+ALTER TABLE orders
+    ALTER COLUMN created_at TYPE timestamptz USING created_at::timestamptz,
+    ALTER COLUMN created_at SET DEFAULT now();
+
+ALTER TABLE stock_movements
+    ALTER COLUMN created_at TYPE timestamptz USING created_at::timestamptz,
+    ALTER COLUMN created_at SET DEFAULT now();
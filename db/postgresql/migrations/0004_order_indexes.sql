@@ -0,0 +1,19 @@
+-- migrate: no-transaction
+-- Built CONCURRENTLY so orders keep flowing while the indexes build.
+-- A failed concurrent build leaves an INVALID index behind: drop it and
+-- run the migrations again.
+
+-- Recent orders: ORDER BY o.created_at DESC, o.id DESC LIMIT 10
+CREATE INDEX CONCURRENTLY IF NOT EXISTS orders_created_at_id_idx
+    ON orders (created_at, id);
+
+-- Joins from orders and products to their stock movements
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_movements_order_id_idx
+    ON stock_movements (order_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_movements_product_id_idx
+    ON stock_movements (product_id);
+
+-- Gallery: products that reference an image through image_mongodb_id
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_image_mongodb_id_idx
+    ON products (image_mongodb_id);
@@ -0,0 +1,6 @@
+-- migrate: no-transaction
+-- The reconciler checks batches of files on the upload volume against
+-- products.image_file_path.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_image_file_path_idx
+    ON products (image_file_path);
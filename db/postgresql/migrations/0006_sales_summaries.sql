@@ -0,0 +1,53 @@
+-- Per-product sales totals and daily sales, kept up to date by the order
+-- queries in actions/create_order.py in the same transaction as the order.
+-- /analytics/sales reads only these, so it costs the same however long the
+-- order history gets. Existing orders are summarized here once; see
+-- db/postgresql/rebuild_sales_summaries.py to recompute them later.
+
+CREATE TABLE IF NOT EXISTS product_sales_summary (
+    product_id integer PRIMARY KEY REFERENCES products ON DELETE CASCADE,
+    units_sold bigint NOT NULL DEFAULT 0,
+    revenue decimal NOT NULL DEFAULT 0,
+    order_count bigint NOT NULL DEFAULT 0,
+    first_sold_at timestamptz,
+    last_sold_at timestamptz
+);
+
+-- Top sellers: ORDER BY units_sold DESC or revenue DESC LIMIT n
+CREATE INDEX IF NOT EXISTS product_sales_summary_units_sold_idx
+    ON product_sales_summary (units_sold DESC, product_id);
+
+CREATE INDEX IF NOT EXISTS product_sales_summary_revenue_idx
+    ON product_sales_summary (revenue DESC, product_id);
+
+-- One row per product and UTC day with sales, for stock velocity
+CREATE TABLE IF NOT EXISTS product_sales_daily (
+    product_id integer NOT NULL REFERENCES products ON DELETE CASCADE,
+    day date NOT NULL,
+    units_sold bigint NOT NULL DEFAULT 0,
+    revenue decimal NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, day)
+);
+
+-- An order's total is shared between its lines by quantity
+INSERT INTO product_sales_summary (product_id, units_sold, revenue, order_count, first_sold_at, last_sold_at)
+SELECT sm.product_id, SUM(sm.quantity), COALESCE(SUM(o.total * sm.quantity / NULLIF(t.quantity, 0)), 0),
+       COUNT(DISTINCT sm.order_id), MIN(o.created_at), MAX(o.created_at)
+FROM stock_movements sm
+JOIN orders o ON o.id = sm.order_id
+JOIN (SELECT order_id, SUM(quantity) AS quantity FROM stock_movements GROUP BY order_id) t
+    ON t.order_id = sm.order_id
+WHERE sm.product_id IS NOT NULL
+GROUP BY sm.product_id
+ON CONFLICT (product_id) DO NOTHING;
+
+INSERT INTO product_sales_daily (product_id, day, units_sold, revenue)
+SELECT sm.product_id, (o.created_at AT TIME ZONE 'UTC')::date, SUM(sm.quantity),
+       COALESCE(SUM(o.total * sm.quantity / NULLIF(t.quantity, 0)), 0)
+FROM stock_movements sm
+JOIN orders o ON o.id = sm.order_id
+JOIN (SELECT order_id, SUM(quantity) AS quantity FROM stock_movements GROUP BY order_id) t
+    ON t.order_id = sm.order_id
+WHERE sm.product_id IS NOT NULL
+GROUP BY sm.product_id, (o.created_at AT TIME ZONE 'UTC')::date
+ON CONFLICT (product_id, day) DO NOTHING;
@@ -0,0 +1,292 @@
+import os
+import uuid
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extensions import cursor as _cursor
+
+from actions.metrics import count_db_call, observe_db_connect, observe_query
+
+# Pool sizing is per process, so with gunicorn the total number of
+# connections opened against RDS is roughly workers * POSTGRESQL_POOL_MAX_SIZE.
+POOL_MIN_SIZE = int(os.getenv("POSTGRESQL_POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.getenv("POSTGRESQL_POOL_MAX_SIZE", "5"))
+POOL_WAIT_TIMEOUT = float(os.getenv("POSTGRESQL_POOL_WAIT_TIMEOUT", "10"))
+POOL_MAX_LIFETIME = float(os.getenv("POSTGRESQL_POOL_MAX_LIFETIME", "1800"))
+POOL_HEALTHCHECK_AFTER = float(os.getenv("POSTGRESQL_POOL_HEALTHCHECK_AFTER", "30"))
+# Rows fetched per round trip by server-side cursors, see iter_server_side
+SERVER_SIDE_ITERSIZE = int(os.getenv("POSTGRESQL_SERVER_SIDE_ITERSIZE", "200"))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_slots = None
+# Guards _stats, _connection_info and _borrowed, which every request thread updates
+_stats_lock = threading.Lock()
+
+# connection id -> {"created_at": ..., "last_used_at": ...}
+_connection_info = {}
+
+# connection id -> (conn, pool, slots) it was borrowed from. Kept across
+# reset_postgresql_pool(), so a connection borrowed before a reset is
+# handed back to its own pool and semaphore.
+_borrowed = {}
+
+_stats = {
+    "borrowed": 0,
+    "created": 0,
+    "recycled": 0,
+    "failed_healthchecks": 0,
+    "wait_timeouts": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class TimedCursor(_cursor):
+    """
+    Cursor that records how long each statement takes, see actions.metrics
+    """
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            _observe(query, time.perf_counter() - started)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            _observe(query, time.perf_counter() - started)
+
+
+def _observe(query, seconds):
+    if isinstance(query, bytes):
+        query = query.decode(errors="replace")
+    words = str(query).split(None, 1)
+    observe_query("postgresql", words[0].upper() if words else "UNKNOWN", seconds)
+    count_db_call("postgresql")
+
+
+def _connection_kwargs():
+    return {
+        "host": os.environ["POSTGRESQL_DB_HOST"],
+        "database": os.environ["POSTGRESQL_DB_DATABASE_NAME"],
+        "user": os.environ['POSTGRESQL_DB_USERNAME'],
+        "password": os.environ['POSTGRESQL_DB_PASSWORD'],
+        "cursor_factory": TimedCursor
+    }
+
+
+def get_postgresql_pool():
+    """
+    Return the connection pool for the current process, creating it on first use
+    """
+    global _pool, _pool_pid, _slots
+
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            # A pool inherited across fork shares sockets with the parent,
+            # so it is dropped without closing and rebuilt for this process.
+            with _stats_lock:
+                _connection_info.clear()
+            _pool = pool.ThreadedConnectionPool(
+                POOL_MIN_SIZE, POOL_MAX_SIZE, **_connection_kwargs()
+            )
+            _pool_pid = pid
+            _slots = threading.BoundedSemaphore(POOL_MAX_SIZE)
+    return _pool
+
+
+def reset_postgresql_pool():
+    """
+    Forget the current pool, e.g. right after a worker has been forked
+    """
+    global _pool, _pool_pid, _slots
+
+    with _pool_lock:
+        _pool = None
+        _pool_pid = None
+        _slots = None
+        with _stats_lock:
+            _connection_info.clear()
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _checkout(db_pool):
+    while True:
+        conn = db_pool.getconn()
+        now = time.monotonic()
+        with _stats_lock:
+            info = _connection_info.get(id(conn))
+            if info is None:
+                _connection_info[id(conn)] = {"created_at": now, "last_used_at": now}
+                _stats["created"] += 1
+                return conn
+            created_at, last_used_at = info["created_at"], info["last_used_at"]
+
+        if now - created_at > POOL_MAX_LIFETIME:
+            _count("recycled")
+            _discard(db_pool, conn)
+            continue
+
+        if now - last_used_at > POOL_HEALTHCHECK_AFTER and not _is_healthy(conn):
+            _count("failed_healthchecks")
+            _discard(db_pool, conn)
+            continue
+
+        return conn
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _discard(db_pool, conn):
+    with _stats_lock:
+        _connection_info.pop(id(conn), None)
+    db_pool.putconn(conn, close=True)
+
+
+def create_postgresql_connection():
+    """
+    Borrow a connection from the process-wide pool.
+    Must be handed back with release_postgresql_connection().
+    """
+    # Take the pool and its semaphore together, a reset may run meanwhile
+    db_pool = slots = None
+    while slots is None:
+        get_postgresql_pool()
+        with _pool_lock:
+            db_pool, slots = _pool, _slots
+
+    started = time.monotonic()
+    if not slots.acquire(timeout=POOL_WAIT_TIMEOUT):
+        _count("wait_timeouts")
+        raise PoolTimeoutError(
+            f"Timed out after {POOL_WAIT_TIMEOUT}s waiting for a PostgreSQL connection")
+    waited = time.monotonic() - started
+    with _stats_lock:
+        _stats["wait_seconds_total"] += waited
+        _stats["wait_seconds_max"] = max(_stats["wait_seconds_max"], waited)
+
+    try:
+        conn = _checkout(db_pool)
+    except Exception:
+        slots.release()
+        raise
+
+    with _stats_lock:
+        _borrowed[id(conn)] = (conn, db_pool, slots)
+        _stats["borrowed"] += 1
+    observe_db_connect("postgresql", time.monotonic() - started)
+    return conn
+
+
+def release_postgresql_connection(conn):
+    """
+    Hand a borrowed connection back to the pool
+    """
+    with _stats_lock:
+        borrowed = _borrowed.pop(id(conn), None)
+    if borrowed is None or borrowed[0] is not conn:
+        raise ValueError("Connection was not borrowed with create_postgresql_connection()")
+    _, db_pool, slots = borrowed
+
+    try:
+        if conn.closed:
+            _discard(db_pool, conn)
+            return
+
+        # Never return a connection with an open transaction to the pool
+        if not conn.autocommit:
+            conn.rollback()
+        conn.autocommit = False
+
+        with _stats_lock:
+            info = _connection_info.get(id(conn))
+            if info is not None:
+                info["last_used_at"] = time.monotonic()
+        db_pool.putconn(conn)
+    except psycopg2.Error:
+        _discard(db_pool, conn)
+    finally:
+        slots.release()
+
+
+@contextmanager
+def postgresql_connection():
+    """
+    Borrow a pooled connection for the duration of a with-block
+    """
+    conn = create_postgresql_connection()
+    try:
+        yield conn
+    finally:
+        release_postgresql_connection(conn)
+
+
+def iter_server_side(query, vars=None, chunk_size=SERVER_SIDE_ITERSIZE):
+    """
+    Run a query on a server-side (named) cursor and yield its rows in lists
+    of chunk_size, so only one chunk is ever held in memory.
+    The pooled connection stays borrowed until the generator is exhausted
+    or closed.
+    """
+    with postgresql_connection() as conn:
+        cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}")
+        cur.itersize = chunk_size
+        try:
+            cur.execute(query, vars)
+            chunk = []
+            for row in cur:
+                chunk.append(row)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            if not conn.closed:
+                cur.close()
+
+
+def get_pool_stats():
+    """
+    Return counters describing pool usage and wait times for this process
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["open_connections"] = len(_connection_info)
+    stats["pid"] = os.getpid()
+    stats["max_size"] = POOL_MAX_SIZE
+    stats["avg_wait_seconds"] = (
+        stats["wait_seconds_total"] / stats["borrowed"] if stats["borrowed"] else 0.0
+    )
+    return stats
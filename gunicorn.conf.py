@@ -0,0 +1,52 @@
+"""
+gunicorn settings for the sync app:
+
+    gunicorn -c gunicorn.conf.py
+
+The app is built once in the master (preload) and forked into the workers,
+which share its imported modules. Anything that holds sockets or threads is
+created per worker in post_fork.
+"""
+import os
+import shutil
+import multiprocessing
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+wsgi_app = f"main:create_app(start_job_workers=False, preload={preload_app})"
+
+# Samples left by a previous run would be summed with the new workers'.
+# This runs before the app is loaded, which with preload happens before
+# on_starting, and the directory must exist by then.
+_metrics_directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+if _metrics_directory:
+    shutil.rmtree(_metrics_directory, ignore_errors=True)
+    os.makedirs(_metrics_directory, exist_ok=True)
+
+
+def post_fork(server, worker):
+    from db.postgresql.postgresql_connection import reset_postgresql_pool
+    from db.mongodb.mongodb_connection import reset_mongodb_client
+    from jobs.queue import JOB_WORKER_MODE
+
+    # Never share a pool or client opened before the fork
+    reset_postgresql_pool()
+    reset_mongodb_client()
+    if JOB_WORKER_MODE == "thread":
+        from jobs.worker import ensure_worker_threads
+        ensure_worker_threads()
+
+
+def post_worker_init(worker):
+    # Startup as seen by this worker, the master's gauge isn't inherited
+    from actions.metrics import observe_startup
+    observe_startup(worker.wsgi.config.get('STARTUP_SECONDS', 0))
+
+
+def child_exit(server, worker):
+    from actions.metrics import mark_worker_dead
+    mark_worker_dead(worker.pid)
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# The store is a SQLite file on local disk, shared by every gunicorn worker
+# (and the standalone worker process) on the instance. Jobs are about files
+# that are already durable on the upload volume, so a lost instance only
+# loses follow-up work that the reconciler can redo.
+# The default lives next to the app rather than in /tmp, which is emptied
+# on reboot. Keep it off EFS: SQLite's WAL mode needs a local file system.
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "instance", "jobs.sqlite3"))
+# "thread" runs workers inside each app process, "external" leaves the
+# queue to `python -m jobs.worker`
+JOB_WORKER_MODE = os.getenv("JOB_WORKER_MODE", "thread")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+# A running job whose worker died is handed out again after this long
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_local = threading.local()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_after REAL NOT NULL,
+    locked_by TEXT,
+    locked_at REAL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+"""
+
+class PermanentJobError(Exception):
+    """
+    Raised by a task when retrying can't help
+    """
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None or getattr(_local, "pid", None) != os.getpid():
+        os.makedirs(os.path.dirname(JOB_QUEUE_PATH), exist_ok=True)
+        conn = sqlite3.connect(JOB_QUEUE_PATH, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _local.conn = conn
+        _local.pid = os.getpid()
+    return conn
+
+def enqueue(kind, payload, idempotency_key=None, max_attempts=JOB_MAX_ATTEMPTS, delay=0):
+    """
+    Add a job to the queue and return its id.
+    A job with the same idempotency_key is only ever enqueued once;
+    the id of the existing job is returned instead.
+    """
+    conn = _connection()
+    now = time.time()
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO jobs (kind, payload, idempotency_key, max_attempts, run_after, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (kind, json.dumps(payload), idempotency_key, max_attempts, now + delay, now, now)
+    )
+    if cursor.rowcount:
+        job_id = cursor.lastrowid
+    else:
+        job_id = conn.execute(
+            "SELECT id FROM jobs WHERE idempotency_key = ?", (idempotency_key,)
+        ).fetchone()["id"]
+
+    if JOB_WORKER_MODE == "thread":
+        from jobs.worker import ensure_worker_threads
+        ensure_worker_threads()
+    return job_id
+
+def claim(worker_id):
+    """
+    Take the next job that is due, or None.
+    Jobs left running by a worker that died are reclaimed after their lease.
+    """
+    conn = _connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT * FROM jobs "
+            "WHERE (status = ? AND run_after <= ?) OR (status = ? AND locked_at < ?) "
+            "ORDER BY run_after LIMIT 1",
+            (QUEUED, now, RUNNING, now - JOB_LEASE_SECONDS)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, locked_by = ?, locked_at = ?, updated_at = ? "
+            "WHERE id = ?",
+            (RUNNING, worker_id, now, now, row["id"])
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    job = dict(row)
+    job["attempts"] += 1
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+def complete(job_id):
+    now = time.time()
+    _connection().execute(
+        "UPDATE jobs SET status = ?, locked_by = NULL, locked_at = NULL, last_error = NULL, updated_at = ? "
+        "WHERE id = ?",
+        (DONE, now, job_id)
+    )
+
+def fail(job, error, permanent=False):
+    """
+    Record a failed attempt and schedule a retry with exponential backoff,
+    or give up once the job is out of attempts
+    """
+    now = time.time()
+    if permanent or job["attempts"] >= job["max_attempts"]:
+        status, run_after = FAILED, now
+    else:
+        backoff = min(JOB_RETRY_BASE_SECONDS * (2 ** (job["attempts"] - 1)), JOB_RETRY_MAX_SECONDS)
+        status, run_after = QUEUED, now + backoff
+    _connection().execute(
+        "UPDATE jobs SET status = ?, run_after = ?, locked_by = NULL, locked_at = NULL, last_error = ?, updated_at = ? "
+        "WHERE id = ?",
+        (status, run_after, str(error)[:2000], now, job["id"])
+    )
+
+def get_job(job_id):
+    row = _connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    return job
+
+def get_queue_stats():
+    rows = _connection().execute("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status").fetchall()
+    stats = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+    stats.update({row["status"]: row["count"] for row in rows})
+    return stats
+
+def purge_finished(older_than_seconds=7 * 24 * 3600):
+    """
+    Drop finished jobs; their idempotency keys can then be used again
+    """
+    cursor = _connection().execute(
+        "DELETE FROM jobs WHERE status = ? AND updated_at < ?",
+        (DONE, time.time() - older_than_seconds)
+    )
+    return cursor.rowcount
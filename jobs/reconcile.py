@@ -0,0 +1,472 @@
+"""
+Find what the upload volume, MongoDB and PostgreSQL disagree on, and clean it up.
+
+    python -m jobs.reconcile                        # dry run, prints a report
+    python -m jobs.reconcile --mode quarantine
+    python -m jobs.reconcile --mode delete --batch-size 200 --batch-delay 1
+
+A run makes four passes, each in bounded batches behind a cursor, so it
+can stop and resume anywhere:
+
+    mongodb   file-uploads documents that no product points at, and
+              documents whose product_id names a deleted product
+    files     files under UPLOAD_DIRECTORY that no document or product points
+              at, and .tmp files left behind by interrupted writes
+    products  products whose image_mongodb_id document is gone; these are
+              only reported, orders reference them
+    sessions  resumable upload sessions idle for longer than
+              UPLOAD_SESSION_TTL_SECONDS, finalized or not
+
+Anything younger than RECONCILE_GRACE_SECONDS is left alone, since an upload
+in progress writes its file before its document and product. "quarantine"
+moves orphaned files under .quarantine/ and documents to the
+file-uploads-quarantine collection instead of deleting them; expired
+upload sessions are deleted in both modes.
+
+In the app, POST /reconcile starts a run as a chain of background jobs, one
+batch per job, and /clear-mongodb purges the collection the same way.
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from db.mongodb.mongodb_connection import create_mongodb_connection  # noqa: E402
+from db.postgresql.postgresql_connection import postgresql_connection  # noqa: E402
+from actions.cache import invalidate_listings  # noqa: E402
+from jobs.queue import enqueue  # noqa: E402
+
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "200"))
+# Pause between batches, which caps the rate of deletes on the stores
+RECONCILE_BATCH_DELAY = float(os.getenv("RECONCILE_BATCH_DELAY", "1"))
+RECONCILE_GRACE_SECONDS = float(os.getenv("RECONCILE_GRACE_SECONDS", "3600"))
+# Orphans listed by name in a run's report, per category
+RECONCILE_SAMPLE_SIZE = 50
+
+# Run state lives on the upload volume, so any instance can report on a run
+RUN_DIRECTORY_NAME = ".reconcile"
+QUARANTINE_DIRECTORY_NAME = ".quarantine"
+QUARANTINE_COLLECTION_NAME = "file-uploads-quarantine"
+DUPLICATE_KEY_ERROR = 11000
+RUN_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+MODES = ("report", "quarantine", "delete")
+PASSES = ("mongodb", "files", "products", "sessions")
+
+def _run_path(upload_folder, run_id):
+    directory = os.path.join(upload_folder, RUN_DIRECTORY_NAME)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, run_id + ".json")
+
+def save_run(upload_folder, run):
+    path = _run_path(upload_folder, run["run_id"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(run, f)
+    os.replace(tmp_path, path)
+
+def load_run(upload_folder, run_id):
+    if not RUN_ID_PATTERN.match(run_id):
+        return None
+    try:
+        with open(_run_path(upload_folder, run_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def new_run(kind, mode="report"):
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of {', '.join(MODES)}")
+    return {
+        "run_id": uuid.uuid4().hex,
+        "kind": kind,
+        "mode": mode,
+        "status": "running",
+        "pass": PASSES[0] if kind == "reconcile" else None,
+        "cursor": None,
+        "batches": 0,
+        "counts": {},
+        "samples": {},
+        "started_at": time.time(),
+        "finished_at": None,
+    }
+
+def _record(run, category, orphans):
+    run["counts"][category] = run["counts"].get(category, 0) + len(orphans)
+    sample = run["samples"].setdefault(category, [])
+    sample.extend(orphans[:RECONCILE_SAMPLE_SIZE - len(sample)])
+
+def _referenced_mongodb_ids(mongodb_ids):
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT image_mongodb_id FROM products WHERE image_mongodb_id = ANY(%s)", (mongodb_ids,))
+        referenced = {row[0] for row in cur.fetchall()}
+        cur.close()
+    return referenced
+
+def _deleted_product_documents(docs):
+    """
+    Ids of the documents whose product_id no longer names a product
+    """
+    claimed = {}
+    for doc in docs:
+        try:
+            claimed[doc["_id"]] = int(doc["product_id"])
+        except (KeyError, TypeError, ValueError):
+            pass
+    if not claimed:
+        return []
+
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM products WHERE id = ANY(%s)", (sorted(set(claimed.values())),))
+        existing = {row[0] for row in cur.fetchall()}
+        cur.close()
+    return [_id for _id, product_id in claimed.items() if product_id not in existing]
+
+def _quarantine_documents(database, collection, ids):
+    """
+    Copy documents to the quarantine collection. Returns the ids that are
+    now there, the only ones safe to delete.
+    """
+    quarantine = database[QUARANTINE_COLLECTION_NAME]
+    documents = list(collection.find({"_id": {"$in": ids}}))
+    if documents:
+        try:
+            quarantine.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys were quarantined by an earlier attempt of this batch
+            if (e.details.get("writeConcernErrors")
+                    or any(error["code"] != DUPLICATE_KEY_ERROR for error in e.details["writeErrors"])):
+                raise
+    return [doc["_id"] for doc in quarantine.find({"_id": {"$in": ids}}, {"_id": 1})]
+
+def _mongodb_batch(run, batch_size):
+    """
+    Documents no product points at, in _id order
+    """
+    client, database, collection = create_mongodb_connection("file-uploads")
+    query = {"_id": {"$gt": ObjectId(run["cursor"])}} if run["cursor"] else {}
+    docs = list(collection.find(query, {"_id": 1, "product_id": 1}).sort("_id", 1).limit(batch_size))
+    if not docs:
+        return None
+    ids = [doc["_id"] for doc in docs]
+
+    # The gallery lists only documents without a product_id as unassociated
+    unlinked = _deleted_product_documents(docs)
+    _record(run, "deleted_product_ids", [str(_id) for _id in unlinked])
+    if unlinked and run["mode"] != "report":
+        collection.update_many({"_id": {"$in": unlinked}}, {"$unset": {"product_id": ""}})
+        invalidate_listings()
+
+    referenced = _referenced_mongodb_ids([str(_id) for _id in ids])
+    cutoff = time.time() - RECONCILE_GRACE_SECONDS
+    orphans = [_id for _id in ids
+               if str(_id) not in referenced and _id.generation_time.timestamp() < cutoff]
+    _record(run, "orphan_documents", [str(_id) for _id in orphans])
+
+    if orphans and run["mode"] != "report":
+        if run["mode"] == "quarantine":
+            orphans = _quarantine_documents(database, collection, orphans)
+        collection.delete_many({"_id": {"$in": orphans}})
+        invalidate_listings()
+    return str(ids[-1])
+
+def _directory_files(upload_folder, directory, offset, limit):
+    """
+    Up to limit (path, mtime) of the files in one directory, skipping the
+    first offset. Returns (files, whether the directory is exhausted).
+    """
+    found = []
+    seen = 0
+    try:
+        with os.scandir(os.path.join(upload_folder, directory)) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                    continue
+                seen += 1
+                if seen <= offset:
+                    continue
+                found.append((os.path.join(directory, entry.name), entry.stat(follow_symlinks=False).st_mtime))
+                if len(found) >= limit:
+                    return found, False
+    except FileNotFoundError:
+        pass
+    return found, True
+
+def _subdirectories(path):
+    # Dot directories (sessions, thumbnails, quarantine, run state) are the app's own
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries
+                          if not entry.name.startswith(".") and entry.is_dir(follow_symlinks=False))
+    except FileNotFoundError:
+        return []
+
+def _next_directory(upload_folder, directory):
+    """
+    The directory after this one in a depth-first walk in name order, or None
+    """
+    children = _subdirectories(os.path.join(upload_folder, directory))
+    if children:
+        return os.path.join(directory, children[0])
+    while directory:
+        parent, name = os.path.split(directory)
+        later = [sibling for sibling in _subdirectories(os.path.join(upload_folder, parent)) if sibling > name]
+        if later:
+            return os.path.join(parent, later[0])
+        directory = parent
+    return None
+
+def _remove_derivatives(upload_folder, file_path):
+    from actions.thumbnails import THUMBNAIL_WIDTHS, FALLBACK_FORMATS, thumbnail_path
+
+    output_formats = {"webp", FALLBACK_FORMATS.get(file_path.rsplit('.', 1)[-1].lower())} - {None}
+    for width in THUMBNAIL_WIDTHS:
+        for output_format in output_formats:
+            try:
+                os.remove(os.path.join(upload_folder, thumbnail_path(file_path, width, output_format)))
+            except FileNotFoundError:
+                pass
+
+def _modified_since(upload_folder, file_path, cutoff):
+    try:
+        return os.stat(os.path.join(upload_folder, file_path)).st_mtime >= cutoff
+    except FileNotFoundError:
+        return False
+
+def _dispose_file(upload_folder, file_path, mode):
+    source = os.path.join(upload_folder, file_path)
+    try:
+        if mode == "quarantine":
+            target = os.path.join(upload_folder, QUARANTINE_DIRECTORY_NAME, file_path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(source, target)
+        else:
+            os.remove(source)
+    except FileNotFoundError:
+        pass
+    _remove_derivatives(upload_folder, file_path)
+
+    # Content-addressed copies are never revalidated against the volume.
+    # This only reaches the cache of the instance running the batch, the
+    # others drop their copies through eviction.
+    from actions.file_cache import invalidate_cached_file
+    invalidate_cached_file(file_path)
+
+def _files_batch(run, upload_folder, batch_size):
+    """
+    Files nothing points at, walking the upload folder with os.scandir.
+    The cursor is a directory and how many of its files were already seen.
+    """
+    cursor = run["cursor"] or {"directory": "", "offset": 0}
+    directory, offset = cursor["directory"], cursor["offset"]
+
+    files = []
+    while directory is not None and len(files) < batch_size:
+        found, exhausted = _directory_files(upload_folder, directory, offset, batch_size - len(files))
+        files.extend(found)
+        if exhausted:
+            directory, offset = _next_directory(upload_folder, directory), 0
+        else:
+            offset += len(found)
+    if not files:
+        return None
+
+    cutoff = time.time() - RECONCILE_GRACE_SECONDS
+    old_files = [file_path for file_path, mtime in files if mtime < cutoff]
+    stale_temp_files = [file_path for file_path in old_files if file_path.endswith(".tmp")]
+    candidates = [file_path for file_path in old_files if not file_path.endswith(".tmp")]
+
+    orphans = []
+    if candidates:
+        client, database, collection = create_mongodb_connection("file-uploads")
+        referenced = {doc["file_path"] for doc in
+                      collection.find({"file_path": {"$in": candidates}}, {"file_path": 1})}
+        with postgresql_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT image_file_path FROM products WHERE image_file_path = ANY(%s)", (candidates,))
+            referenced.update(row[0] for row in cur.fetchall())
+            cur.close()
+        orphans = [file_path for file_path in candidates if file_path not in referenced]
+
+    _record(run, "orphan_files", orphans)
+    _record(run, "stale_temp_files", stale_temp_files)
+
+    if run["mode"] != "report":
+        for file_path in orphans:
+            # A duplicate upload touches the file it reuses, possibly after the
+            # reference check above, so look at the mtime once more
+            if _modified_since(upload_folder, file_path, cutoff):
+                continue
+            _dispose_file(upload_folder, file_path, run["mode"])
+        for file_path in stale_temp_files:
+            try:
+                os.remove(os.path.join(upload_folder, file_path))
+            except FileNotFoundError:
+                pass
+        # Files taken out of the current directory no longer count towards its offset
+        if directory is not None:
+            offset -= sum(1 for file_path in orphans + stale_temp_files
+                          if os.path.dirname(file_path) == directory)
+
+    if directory is None:
+        return {"directory": None, "offset": 0}
+    return {"directory": directory, "offset": max(offset, 0)}
+
+def _products_batch(run, upload_folder, batch_size):
+    """
+    Products whose file-uploads document no longer exists, in id order
+    """
+    with postgresql_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, image_mongodb_id, image_file_path FROM products WHERE id > %s ORDER BY id LIMIT %s",
+                    (run["cursor"] or 0, batch_size))
+        rows = cur.fetchall()
+        cur.close()
+    if not rows:
+        return None
+
+    client, database, collection = create_mongodb_connection("file-uploads")
+    object_ids = [ObjectId(row[1]) for row in rows if ObjectId.is_valid(row[1])]
+    existing = {str(doc["_id"]) for doc in collection.find({"_id": {"$in": object_ids}}, {"_id": 1})}
+
+    _record(run, "dangling_products", [
+        {"product_id": product_id, "image_mongodb_id": mongodb_id,
+         "file_exists": bool(file_path) and os.path.exists(os.path.join(upload_folder, file_path))}
+        for product_id, mongodb_id, file_path in rows if mongodb_id not in existing
+    ])
+    return rows[-1][0]
+
+def _sessions_batch(run, upload_folder, batch_size):
+    """
+    Upload sessions nobody touched within the TTL, in session id order
+    """
+    from actions.chunked_upload import UPLOAD_SESSION_TTL_SECONDS, upload_session_activity, expire_upload_session
+
+    last_activity = upload_session_activity(upload_folder)
+    session_ids = sorted(session_id for session_id in last_activity
+                         if run["cursor"] is None or session_id > run["cursor"])[:batch_size]
+    if not session_ids:
+        return None
+
+    cutoff = time.time() - UPLOAD_SESSION_TTL_SECONDS
+    expired = [session_id for session_id in session_ids if last_activity[session_id] < cutoff]
+    if run["mode"] != "report":
+        # One that is being written to right now is not idle after all
+        expired = [session_id for session_id in expired if expire_upload_session(upload_folder, session_id)]
+    _record(run, "expired_upload_sessions", expired)
+    return session_ids[-1]
+
+def _purge_batch(run, batch_size):
+    """
+    Delete one batch of file-uploads documents, for /clear-mongodb
+    """
+    client, database, collection = create_mongodb_connection("file-uploads")
+    ids = [doc["_id"] for doc in collection.find({}, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+    if not ids:
+        return None
+    result = collection.delete_many({"_id": {"$in": ids}})
+    run["counts"]["deleted_documents"] = run["counts"].get("deleted_documents", 0) + result.deleted_count
+    invalidate_listings()
+    return str(ids[-1])
+
+def run_batch(run, upload_folder, batch_size=RECONCILE_BATCH_SIZE):
+    """
+    Advance a run by one batch, updating its cursor, counts and status
+    """
+    if run["kind"] == "purge_mongodb":
+        cursor = _purge_batch(run, batch_size)
+    elif run["pass"] == "mongodb":
+        cursor = _mongodb_batch(run, batch_size)
+    elif run["pass"] == "files":
+        cursor = _files_batch(run, upload_folder, batch_size)
+    elif run["pass"] == "products":
+        cursor = _products_batch(run, upload_folder, batch_size)
+    else:
+        cursor = _sessions_batch(run, upload_folder, batch_size)
+
+    run["batches"] += 1
+    if isinstance(cursor, dict) and cursor["directory"] is None:
+        cursor = None
+        run["cursor"] = None
+        finished_pass = True
+    else:
+        run["cursor"] = cursor
+        finished_pass = cursor is None
+
+    if finished_pass:
+        if run["kind"] == "reconcile" and PASSES.index(run["pass"]) + 1 < len(PASSES):
+            run["pass"] = PASSES[PASSES.index(run["pass"]) + 1]
+        else:
+            run["status"] = "done"
+            run["finished_at"] = time.time()
+    return run
+
+def _enqueue_batch(run, batch, batch_size, delay):
+    return enqueue("reconcile_batch",
+                   {"run_id": run["run_id"], "batch": batch, "batch_size": batch_size, "delay": delay},
+                   idempotency_key=f"{run['kind']}:{run['run_id']}:{batch}",
+                   delay=delay if batch else 0)
+
+def start_run(upload_folder, kind="reconcile", mode="report",
+              batch_size=RECONCILE_BATCH_SIZE, delay=RECONCILE_BATCH_DELAY):
+    """
+    Start a run in the background, one job per batch. Returns the run.
+    """
+    run = new_run(kind, mode)
+    save_run(upload_folder, run)
+    _enqueue_batch(run, 0, batch_size, delay)
+    return run
+
+def run_batch_job(payload):
+    """
+    Handler of the reconcile_batch job: run one batch and queue the next
+    """
+    upload_folder = os.environ["UPLOAD_DIRECTORY"]
+    run = load_run(upload_folder, payload["run_id"])
+    if run is None or run["status"] != "running":
+        return
+
+    # A retry of a batch that already went through only needs to queue the next one
+    if run["batches"] == payload["batch"]:
+        run = run_batch(run, upload_folder, payload["batch_size"])
+        save_run(upload_folder, run)
+    if run["status"] == "running":
+        _enqueue_batch(run, run["batches"], payload["batch_size"], payload["delay"])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES, default="report")
+    parser.add_argument("--batch-size", type=int, default=RECONCILE_BATCH_SIZE)
+    parser.add_argument("--batch-delay", type=float, default=RECONCILE_BATCH_DELAY)
+    parser.add_argument("--background", action="store_true", help="queue the run as jobs instead of running it here")
+    args = parser.parse_args()
+
+    upload_folder = os.environ["UPLOAD_DIRECTORY"]
+    if args.background:
+        run = start_run(upload_folder, mode=args.mode, batch_size=args.batch_size, delay=args.batch_delay)
+        print(json.dumps({"run_id": run["run_id"]}))
+        return
+
+    run = new_run("reconcile", args.mode)
+    while run["status"] == "running":
+        current_pass = run["pass"]
+        run = run_batch(run, upload_folder, args.batch_size)
+        save_run(upload_folder, run)
+        if run["pass"] != current_pass or run["status"] != "running":
+            print(f"finished {current_pass} pass after {run['batches']} batches", file=sys.stderr, flush=True)
+        if run["status"] == "running":
+            time.sleep(args.batch_delay)
+    print(json.dumps(run, indent=2))
+
+if __name__ == "__main__":
+    main()
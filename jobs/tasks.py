@@ -0,0 +1,82 @@
+import os
+import hashlib
+from datetime import datetime
+from bson import ObjectId
+from db.mongodb.mongodb_connection import create_mongodb_connection
+from jobs.queue import PermanentJobError
+
+TASKS = {}
+
+def task(kind):
+    """
+    Register a function as the handler of a job kind.
+    Handlers must be idempotent: a job can run again after a crash.
+    """
+    def register(func):
+        TASKS[kind] = func
+        return func
+    return register
+
+@task("backfill_product_id")
+def backfill_product_id(payload):
+    """
+    Point the file-uploads document at the product created for it
+    """
+    client, database, collection = create_mongodb_connection("file-uploads")
+    result = collection.update_one(
+        {"_id": ObjectId(payload["mongodb_id"])},
+        {"$set": {"product_id": payload["product_id"]}}
+    )
+    client.close()
+    if result.matched_count == 0:
+        raise PermanentJobError(f"file-uploads document {payload['mongodb_id']} not found")
+
+@task("generate_derivatives")
+def generate_derivatives(payload):
+    from actions.thumbnails import generate_derivatives as generate
+    generate(os.environ["UPLOAD_DIRECTORY"], payload["file_path"])
+
+@task("verify_checksum")
+def verify_checksum(payload):
+    """
+    Re-read a stored upload and compare it with the hash taken while it streamed in.
+    A file stored by name that was modified after its upload was replaced by a
+    later upload with the same name; it is marked superseded, not mismatched.
+    """
+    from actions.storage import is_content_addressed
+
+    client, database, collection = create_mongodb_connection("file-uploads")
+    try:
+        document = collection.find_one({"_id": ObjectId(payload["mongodb_id"])}, {"upload_date": 1})
+        if document is None:
+            raise PermanentJobError(f"file-uploads document {payload['mongodb_id']} not found")
+
+        with open(os.path.join(os.environ["UPLOAD_DIRECTORY"], payload["file_path"]), "rb") as f:
+            modified_at = os.fstat(f.fileno()).st_mtime
+            digest = hashlib.sha256()
+            for buffer in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(buffer)
+        verified = digest.hexdigest() == payload["content_hash"]
+
+        # The file is written before its document, so a newer mtime means
+        # another upload has replaced it since
+        superseded = (not verified and not is_content_addressed(payload["file_path"])
+                      and document.get("upload_date") is not None
+                      and modified_at > document["upload_date"].timestamp())
+
+        collection.update_one(
+            {"_id": ObjectId(payload["mongodb_id"])},
+            {"$set": {"checksum_verified": None if superseded else verified,
+                      "checksum_status": "superseded" if superseded else ("ok" if verified else "mismatch"),
+                      "checksum_verified_at": datetime.now()}}
+        )
+    finally:
+        client.close()
+
+    if not verified and not superseded:
+        raise PermanentJobError(f"checksum mismatch for {payload['file_path']}")
+
+@task("reconcile_batch")
+def reconcile_batch(payload):
+    from jobs.reconcile import run_batch_job
+    run_batch_job(payload)
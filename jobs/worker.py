@@ -0,0 +1,103 @@
+"""
+Run background jobs from the local queue.
+
+    python -m jobs.worker --threads 2
+
+With JOB_WORKER_MODE=thread (the default) the app starts worker threads in
+each process by itself and this entry point is not needed.
+"""
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from jobs import queue  # noqa: E402
+from jobs.tasks import TASKS  # noqa: E402
+
+JOB_WORKER_THREADS = int(os.getenv("JOB_WORKER_THREADS", "1"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+logger = logging.getLogger("jobs.worker")
+
+_threads_pid = None
+_threads_lock = threading.Lock()
+_stop = threading.Event()
+
+def run_job(job):
+    handler = TASKS.get(job["kind"])
+    if handler is None:
+        queue.fail(job, f"unknown job kind {job['kind']}", permanent=True)
+        return
+    try:
+        handler(job["payload"])
+    except queue.PermanentJobError as e:
+        logger.error("job %s (%s) failed permanently: %s", job["id"], job["kind"], e)
+        queue.fail(job, e, permanent=True)
+    except Exception as e:
+        logger.warning("job %s (%s) attempt %s failed: %s", job["id"], job["kind"], job["attempts"], e)
+        queue.fail(job, e)
+    else:
+        queue.complete(job["id"])
+
+def run_worker(worker_id, poll_interval=JOB_POLL_INTERVAL, stop=_stop):
+    """
+    Claim and run jobs until stop is set, sleeping when the queue is empty
+    """
+    while not stop.is_set():
+        try:
+            job = queue.claim(worker_id)
+        except Exception as e:
+            logger.error("could not claim a job: %s", e)
+            job = None
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        run_job(job)
+
+def ensure_worker_threads(count=JOB_WORKER_THREADS):
+    """
+    Start the in-process worker threads once per process
+    """
+    global _threads_pid
+
+    pid = os.getpid()
+    if _threads_pid == pid:
+        return
+    with _threads_lock:
+        if _threads_pid == pid:
+            return
+        for n in range(count):
+            worker_id = f"{socket.gethostname()}:{pid}:{n}"
+            threading.Thread(target=run_worker, args=(worker_id,), name=f"job-worker-{n}", daemon=True).start()
+        _threads_pid = pid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=JOB_WORKER_THREADS)
+    parser.add_argument("--poll-interval", type=float, default=JOB_POLL_INTERVAL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    pid = os.getpid()
+    threads = [
+        threading.Thread(target=run_worker, args=(f"{socket.gethostname()}:{pid}:{n}", args.poll_interval))
+        for n in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("started %s worker threads on %s", args.threads, queue.JOB_QUEUE_PATH)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        _stop.set()
+        for thread in threads:
+            thread.join()
+
+if __name__ == "__main__":
+    main()
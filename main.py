@@ -1,100 +1,286 @@
+import time
+
+# Start of the startup budget, before anything else is imported
+_IMPORT_STARTED = time.perf_counter()
+
 import os
-import json
-from bson import ObjectId
-import psycopg2
-from datetime import datetime
-
-from flask import Flask, flash, request, redirect, url_for, render_template, send_from_directory, jsonify, send_file
-from werkzeug.utils import secure_filename
-from db.mongodb.mongodb_connection import create_mongodb_connection
-from aws_xray_sdk.core import xray_recorder, patch_all
-from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
-
-# Import action modules
-from actions.upload_image import handle_upload_file, render_upload_page
-from actions.view_images import render_images_page
-from actions.create_order import process_order, render_order_page
-from actions.utils import add_cache_headers, serve_file, get_image_by_id, clear_mongodb_collection
+import logging
+import importlib
+
+from flask import Flask, request, redirect, url_for, render_template, jsonify, current_app
+
+# Only light modules are imported here. The action modules, and with them
+# psycopg2, pymongo and Pillow, are imported by the views on first use, or
+# ahead of the fork by preload_views() when gunicorn preloads the app.
+from actions.utils import add_cache_headers
+from actions.metrics import start_request_timer, observe_request, observe_startup, render_metrics
+from actions.validation import UPLOAD_MAX_BYTES
+from jobs.queue import JOB_WORKER_MODE, get_job, get_queue_stats
 
 UPLOAD_FOLDER = os.getenv("UPLOAD_DIRECTORY")
-ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif'}
 ENV_MODE = os.getenv("ENV_MODE")
+# Tracing every request is expensive under load, so it can be sampled or turned off
+XRAY_ENABLED = os.getenv("XRAY_ENABLED", "true").lower() == "true"
+XRAY_SAMPLING_RATE = float(os.getenv("XRAY_SAMPLING_RATE", "0.05"))
+# A slower startup is logged as a warning, see benchmarks/bench_startup.py
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "1.5"))
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")  # Added secret key for flash messages
+# Modules the views import lazily
+VIEW_MODULES = [
+    "actions.upload_image",
+    "actions.view_images",
+    "actions.create_order",
+    "actions.thumbnails",
+    "actions.bulk_import",
+    "actions.chunked_upload",
+    "actions.reconcile",
+    "actions.analytics",
+    "actions.cache",
+    "db.postgresql.postgresql_connection",
+    "db.mongodb.mongodb_connection",
+    "jobs.tasks",
+]
 
-xray_recorder.configure(service='file-upload-flask') 
-XRayMiddleware(app, xray_recorder)
-patch_all() 
+logger = logging.getLogger(__name__)
 
-@app.route("/")
 def index():
     # Main landing page with navigation
     return render_template('index.html')
 
-@app.after_request
+def before_request_handler():
+    start_request_timer()
+
 def after_request_handler(response):
-    return add_cache_headers(response)
+    return observe_request(add_cache_headers(response))
 
-@app.route('/upload-file', methods=['GET', 'POST'])
 def upload_file():
+    from actions.upload_image import handle_upload_file, render_upload_page
+
     if request.method == 'POST':
-        result = handle_upload_file(request, app)
+        result = handle_upload_file(request, current_app)
         if result:
             return result
-    
+
     return render_upload_page()
 
-@app.route('/images', methods=['GET'])
+def create_upload_session():
+    from actions.chunked_upload import init_upload_session
+    return init_upload_session(current_app.config['UPLOAD_FOLDER'])
+
+def upload_session(session_id):
+    from actions.chunked_upload import upload_session_chunk, abort_upload_session, get_upload_session
+
+    if request.method == 'PUT':
+        return upload_session_chunk(current_app.config['UPLOAD_FOLDER'], session_id)
+    if request.method == 'DELETE':
+        return abort_upload_session(current_app.config['UPLOAD_FOLDER'], session_id)
+    return get_upload_session(current_app.config['UPLOAD_FOLDER'], session_id)
+
+def finalize_upload(session_id):
+    from actions.chunked_upload import finalize_upload_session
+    return finalize_upload_session(current_app.config['UPLOAD_FOLDER'], session_id)
+
+def bulk_import():
+    from actions.bulk_import import handle_bulk_import
+    return handle_bulk_import(current_app.config['UPLOAD_FOLDER'])
+
 def show_uploaded_images():
+    from actions.view_images import render_images_page
     return render_images_page()
 
-@app.route('/uploads/<name>')
 def download_file(name):
-    return serve_file(app.config, name)
+    from actions.utils import serve_file
+    return serve_file(current_app.config, name)
+
+def get_thumbnail(width, name):
+    from actions.thumbnails import serve_thumbnail
+    return serve_thumbnail(current_app.config['UPLOAD_FOLDER'], width, name)
 
-@app.route('/create-order', methods=['GET', 'POST'])
 def create_order():
+    from actions.create_order import process_order, render_order_page
+
     if request.method == 'POST':
-        result = process_order(request, app)
+        result = process_order(request, current_app)
         if result:
             return result
-    
-    return render_order_page(app)
 
-@app.route('/clear-mongodb', methods=['GET'])
+    return render_order_page(current_app)
+
+def create_bulk_order():
+    from actions.create_order import process_bulk_order
+    return process_bulk_order(request, current_app)
+
 def clear_mongodb():
+    from actions.utils import clear_mongodb_collection
     return clear_mongodb_collection()
 
-@app.route('/image/<image_id>')
+def reconcile():
+    from actions.reconcile import handle_reconcile
+    return handle_reconcile()
+
+def reconcile_status(run_id):
+    from actions.reconcile import get_reconcile_run
+    return get_reconcile_run(run_id)
+
+def sales_analytics():
+    from actions.analytics import handle_sales_analytics
+    return handle_sales_analytics()
+
 def get_image(image_id):
+    from actions.utils import get_image_by_id
     return get_image_by_id(image_id)
 
 # Simple redirect routes for better navigation
-@app.route('/home')
 def home():
     return redirect(url_for('index'))
 
-@app.route('/gallery')
 def gallery():
     return redirect(url_for('show_uploaded_images'))
 
-@app.route('/upload')
 def upload():
     return redirect(url_for('upload_file'))
 
-@app.route('/order')
 def order():
     return redirect(url_for('create_order'))
 
-@app.route("/health")
 def health():
     return "OK", 200
 
-@app.route("/xray-test")
+def job_queue_stats():
+    return jsonify(get_queue_stats())
+
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"message": "Job not found", "success": False}), 404
+    return jsonify(job)
+
+def pool_stats():
+    from db.postgresql.postgresql_connection import get_pool_stats
+    return jsonify(get_pool_stats())
+
+def cache_stats():
+    from actions.cache import get_cache_stats
+    return jsonify(get_cache_stats())
+
+def file_cache_stats():
+    from actions.file_cache import get_file_cache_stats
+    return jsonify(get_file_cache_stats())
+
+def metrics():
+    return render_metrics()
+
 def xray_test():
+    if not current_app.config['XRAY_ENABLED']:
+        return "X-Ray is disabled", 404
     from aws_xray_sdk.core import xray_recorder
     seg = xray_recorder.begin_subsegment("manual-test")
     xray_recorder.end_subsegment()
-    return "X-Ray test!", 200
\ No newline at end of file
+    return "X-Ray test!", 200
+
+# (rule, view, methods); the view's name is its endpoint for url_for
+ROUTES = [
+    ("/", index, ['GET']),
+    ('/upload-file', upload_file, ['GET', 'POST']),
+    ('/upload-sessions', create_upload_session, ['POST']),
+    ('/upload-sessions/<session_id>', upload_session, ['GET', 'PUT', 'DELETE']),
+    ('/upload-sessions/<session_id>/finalize', finalize_upload, ['POST']),
+    ('/import', bulk_import, ['POST']),
+    ('/images', show_uploaded_images, ['GET']),
+    ('/uploads/<path:name>', download_file, ['GET']),
+    ('/thumbnails/<int:width>/<path:name>', get_thumbnail, ['GET']),
+    ('/create-order', create_order, ['GET', 'POST']),
+    ('/create-order/bulk', create_bulk_order, ['POST']),
+    ('/clear-mongodb', clear_mongodb, ['GET']),
+    ('/reconcile', reconcile, ['POST']),
+    ('/reconcile/<run_id>', reconcile_status, ['GET']),
+    ('/analytics/sales', sales_analytics, ['GET']),
+    ('/image/<image_id>', get_image, ['GET']),
+    ('/home', home, ['GET']),
+    ('/gallery', gallery, ['GET']),
+    ('/upload', upload, ['GET']),
+    ('/order', order, ['GET']),
+    ("/health", health, ['GET']),
+    ("/jobs", job_queue_stats, ['GET']),
+    ("/jobs/<int:job_id>", job_status, ['GET']),
+    ("/pool-stats", pool_stats, ['GET']),
+    ("/cache-stats", cache_stats, ['GET']),
+    ("/file-cache-stats", file_cache_stats, ['GET']),
+    ("/metrics", metrics, ['GET']),
+    ("/xray-test", xray_test, ['GET']),
+]
+
+def configure_xray(app):
+    """
+    Trace a sample of requests; the SDK (and botocore with it) is only
+    imported when tracing is on
+    """
+    from aws_xray_sdk.core import xray_recorder, patch_all
+    from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
+
+    xray_recorder.configure(service='file-upload-flask', sampling_rules={
+        "version": 2,
+        "rules": [],
+        "default": {"fixed_target": 1 if XRAY_SAMPLING_RATE > 0 else 0, "rate": XRAY_SAMPLING_RATE},
+    })
+    XRayMiddleware(app, xray_recorder)
+    patch_all()
+
+def preload_views():
+    """
+    Import everything the views need up front, e.g. in the gunicorn master
+    so the forked workers share it
+    """
+    for module in VIEW_MODULES:
+        importlib.import_module(module)
+
+def create_app(start_job_workers=True, preload=False):
+    """
+    Build the Flask app.
+    With gunicorn --preload this runs once in the master: job worker threads
+    and database clients are then started per worker by the post_fork hook
+    in gunicorn.conf.py.
+    """
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    # Werkzeug enforces this while it reads the body, leaving room for the form fields
+    app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_BYTES + 1024 * 1024
+    app.config['XRAY_ENABLED'] = XRAY_ENABLED
+    app.secret_key = os.getenv("SECRET_KEY", "dev-secret-key")  # Added secret key for flash messages
+
+    if XRAY_ENABLED:
+        configure_xray(app)
+
+    app.before_request(before_request_handler)
+    app.after_request(after_request_handler)
+    for rule, view, methods in ROUTES:
+        app.add_url_rule(rule, view_func=view, methods=methods)
+
+    if preload:
+        preload_views()
+
+    # Pick up jobs left in the queue by a previous run
+    if start_job_workers and JOB_WORKER_MODE == "thread":
+        from jobs.worker import ensure_worker_threads
+        ensure_worker_threads()
+
+    report_startup(app)
+    return app
+
+def report_startup(app):
+    seconds = time.perf_counter() - _IMPORT_STARTED
+    app.config['STARTUP_SECONDS'] = seconds
+    observe_startup(seconds)
+    if seconds > STARTUP_BUDGET_SECONDS:
+        logger.warning("app ready in %.3fs, over the %.3fs startup budget", seconds, STARTUP_BUDGET_SECONDS)
+    else:
+        logger.info("app ready in %.3fs", seconds)
+
+def __getattr__(name):
+    # `main:app` (flask run, plain gunicorn, the benchmarks) builds the app on
+    # first access rather than at import, so importing main stays cheap
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
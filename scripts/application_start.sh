@@ -5,6 +5,25 @@ cd /home/ec2-user/file-upload-flask
 # Reload systemd configuration
 sudo systemctl daemon-reload
 
+# Apply pending schema migrations before the new code serves requests; the
+# order queries need the tables the migrations create. The database settings
+# are taken from the service's environment.
+echo "Applying database migrations..."
+(
+    set -a
+    for env_file in $(sudo systemctl show flask_app.service -p EnvironmentFiles --value | awk '{print $1}'); do
+        if sudo test -f "$env_file"; then
+            source <(sudo cat "$env_file")
+        fi
+    done
+    set +a
+    while IFS= read -r assignment; do
+        export "$assignment"
+    done < <(sudo systemctl show flask_app.service -p Environment --value | xargs -n1)
+    source venv/bin/activate
+    python -m db.postgresql.migrate
+) || { echo "Migrations failed, not restarting the application"; exit 1; }
+
 # Restart the Flask application
 sudo systemctl restart flask_app.service
 
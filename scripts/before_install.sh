@@ -14,12 +14,15 @@ if [ -d /home/ec2-user/file-upload-flask ]; then
     mkdir -p /home/ec2-user/backups
     cp -r /home/ec2-user/file-upload-flask /home/ec2-user/backups/file-upload-flask-$timestamp
     
-    # Clean the directory but preserve important files
+    # Clean the directory but preserve important files; instance/ holds the
+    # job queue (JOB_QUEUE_PATH), with jobs that have not run yet
     echo "Cleaning deployment directory..."
     find /home/ec2-user/file-upload-flask -mindepth 1 \
         -not -path "*/venv/*" \
         -not -path "*/global-bundle.pem" \
         -not -path "*/uploads/*" \
+        -not -path "*/instance" \
+        -not -path "*/instance/*" \
         -delete
 else
     # Create directory if it doesn't exist